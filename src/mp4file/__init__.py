@@ -16,3 +16,5 @@ from mp4file import (
     Mp4File,
     Atom
 )
+from stream import iterparse
+from tags import update_tags
@@ -0,0 +1,168 @@
+'''
+Access to mp4 files from an asyncio event loop.
+
+Mp4File does blocking reads.  The functions and methods here run them in
+a thread pool executor through loop.run_in_executor and return futures of
+the event loop, so the loop is never blocked:
+
+    mp4 = yield From(open_async(path))       # trollius
+    mp4 = await open_async(path)             # asyncio
+    stsz = await mp4.find('moov/trak/mdia/minf/stbl/stsz')
+
+The size of the executor bounds the number of files read at once.
+
+This module needs asyncio, or trollius on Python 2, which brings the
+futures package the executors come from; neither is needed by the rest
+of mp4file.
+'''
+import functools
+import mmap
+import threading
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+from mp4file import Mp4File
+from sources import BlockFile
+
+# Default number of files read at once
+MAX_WORKERS = 16
+
+_executor = []
+_executor_lock = threading.Lock()
+
+
+def _default_loop(loop):
+    '''Return the event loop to use, the current one by default.'''
+    if loop is not None:
+        return loop
+    if asyncio is None:
+        raise ImportError('mp4file.aio needs asyncio or trollius')
+    return asyncio.get_event_loop()
+
+
+def default_executor():
+    '''Return the executor shared by the calls given none, creating it
+    with MAX_WORKERS threads on first use.
+    '''
+    _executor_lock.acquire()
+    try:
+        if not _executor:
+            _executor.append(ThreadPoolExecutor(MAX_WORKERS))
+        return _executor[0]
+    finally:
+        _executor_lock.release()
+
+
+def _decoded(atom):
+    '''Return atom, or each atom of a list, with its attrs decoded.'''
+    if isinstance(atom, list):
+        for a in atom:
+            a.attrs
+    elif atom is not None:
+        atom.attrs
+    return atom
+
+
+class AsyncMp4File(object):
+    '''Asynchronous wrapper of an Mp4File.
+
+    Every method returns a future of the event loop.  Calls on a local
+    file run at once, as its reads are positional (see handles); calls on
+    a remote file or a memory mapped one run one at a time, since they
+    share the position of its sources.BlockFile or mapping.  The atoms
+    returned have their attrs decoded already; anything else that reads
+    the file, such as the children of a lazy atom, should go through these
+    methods.
+    '''
+    def __init__(self, mp4, loop, executor):
+        self.mp4 = mp4
+        self._loop = loop
+        self._executor = executor
+        self._lock = None
+        if isinstance(mp4.file, (BlockFile, mmap.mmap)):
+            self._lock = threading.Lock()
+
+    def _locked(self, function, *args):
+        self._lock.acquire()
+        try:
+            return function(*args)
+        finally:
+            self._lock.release()
+
+    def run(self, function, *args):
+        '''Return a future of function(*args), called in the executor,
+        while no other call reads the file if it has a shared position.
+        '''
+        if self._lock is None:
+            call = functools.partial(function, *args)
+        else:
+            call = functools.partial(self._locked, function, *args)
+        return self._loop.run_in_executor(self._executor, call)
+
+    def find(self, path):
+        return self.run(lambda: _decoded(self.mp4.find(path)))
+
+    def findall(self, path):
+        return self.run(lambda: _decoded(self.mp4.findall(path)))
+
+    def get_atoms(self, atom=None):
+        '''Return a future of the children of atom, the file by default.'''
+        if atom is None:
+            atom = self.mp4
+        return self.run(lambda: _decoded(atom.get_atoms()))
+
+    def read_data(self, atom, offset=0):
+        '''Return a future of the bytes of atom, see Atom.read_data.'''
+        return self.run(lambda: str(atom.read_data(offset)))
+
+    def close(self):
+        return self.run(self.mp4.close)
+
+
+def open_async(path, loop=None, executor=None, **kwargs):
+    '''Return a future of an AsyncMp4File of the file at path.
+
+    :param loop: the event loop, the current one by default.
+    :param executor: the executor doing the reads, see default_executor.
+    :param kwargs: passed on to Mp4File; lazy is true by default, so that
+        opening reads the top level atoms only.
+    '''
+    loop = _default_loop(loop)
+    if executor is None:
+        executor = default_executor()
+    kwargs.setdefault('lazy', True)
+
+    def open_file():
+        return AsyncMp4File(Mp4File(path, **kwargs), loop, executor)
+    return loop.run_in_executor(executor, open_file)
+
+
+def map_files(function, paths, max_workers=MAX_WORKERS, loop=None,
+              executor=None):
+    '''Return a future of the list of function(path) for every path.
+
+    function does blocking work, such as batch.extract_metadata; at most
+    max_workers calls run at once, in a thread pool of their own unless
+    executor is given.
+    '''
+    loop = _default_loop(loop)
+    own = executor is None
+    if own:
+        executor = ThreadPoolExecutor(max_workers)
+    result = asyncio.gather(*[loop.run_in_executor(executor, function, path)
+                              for path in paths])
+    if own:
+        result.add_done_callback(
+            lambda future: executor.shutdown(wait=False))
+    return result
@@ -0,0 +1,193 @@
+'''
+Tests for the asynchronous API: against a fake event loop running calls
+in place, and against the event loop of asyncio or trollius when
+installed.
+'''
+import os
+import sys
+import threading
+import unittest
+
+import aio
+from batch import extract_metadata
+from mp4file import Mp4File
+from testutil import build_movie, write_temp
+
+
+class FakeFuture(object):
+    '''Completed future of a call made by FakeLoop.'''
+    def __init__(self, result=None, exc_info=None):
+        self._result = result
+        self._exc_info = exc_info
+
+    def result(self):
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def add_done_callback(self, callback):
+        callback(self)
+
+
+class FakeLoop(object):
+    '''Event loop running every call in place, recording the executors
+    they are given.
+    '''
+    def __init__(self):
+        self.executors = []
+
+    def run_in_executor(self, executor, function, *args):
+        self.executors.append(executor)
+        try:
+            return FakeFuture(function(*args))
+        except Exception:
+            return FakeFuture(exc_info=sys.exc_info())
+
+
+class FakeAsyncio(object):
+    '''The part of asyncio used by aio, over a FakeLoop.'''
+    def __init__(self, loop):
+        self.loop = loop
+
+    def get_event_loop(self):
+        return self.loop
+
+    def gather(self, *futures):
+        try:
+            return FakeFuture([future.result() for future in futures])
+        except Exception:
+            return FakeFuture(exc_info=sys.exc_info())
+
+
+class FakeExecutor(object):
+    def __init__(self):
+        self.shut_down = False
+
+    def shutdown(self, wait=True):
+        self.shut_down = True
+
+
+class Base(object):
+    def setUp(self):
+        self.paths = [write_temp(build_movie()) for i in range(20)]
+
+    def tearDown(self):
+        for path in self.paths:
+            os.unlink(path)
+
+    def testOpen(self):
+        mp4 = self.wait(Mp4File.open_async(self.paths[0], self.loop,
+                                           self.executor))
+        self.assertEquals(['ftyp', 'moov', 'mdat'],
+                          [a.type for a in self.wait(mp4.get_atoms())])
+        stsz = self.wait(mp4.find('moov/trak/mdia/minf/stbl/stsz'))
+        self.assertEquals(10, stsz.get_attribute('Number_of_entries'))
+        datas = self.wait(mp4.findall('moov/udta/meta/ilst/*/data'))
+        self.assertEquals(u'Test title', datas[0].get_attribute('data'))
+        ftyp = self.wait(mp4.find('ftyp'))
+        data = self.wait(mp4.read_data(ftyp))
+        self.assertEquals('ftyp', data[4:8])
+        self.wait(mp4.close())
+
+    def testConcurrent(self):
+        mp4s = [self.wait(f) for f in
+                [aio.open_async(path, self.loop, self.executor)
+                 for path in self.paths]]
+        titles = [self.wait(f) for f in
+                  [mp4.find('.//title/data') for mp4 in mp4s]]
+        self.assertEquals([u'Test title'] * len(self.paths),
+                          [t.get_attribute('data') for t in titles])
+        for mp4 in mp4s:
+            self.wait(mp4.close())
+
+    def testMapFiles(self):
+        records = self.wait(aio.map_files(extract_metadata, self.paths,
+                                          max_workers=4, loop=self.loop,
+                                          executor=self.executor))
+        self.assertEquals(self.paths, [r['path'] for r in records])
+        self.assertEquals(120, records[0]['tags']['bpm'])
+
+    def testError(self):
+        future = aio.open_async(self.paths[0] + '.missing', self.loop,
+                                self.executor)
+        self.assertRaises(IOError, self.wait, future)
+
+
+class FakeLoopTest(Base, unittest.TestCase):
+    def setUp(self):
+        Base.setUp(self)
+        self.loop = FakeLoop()
+        self.executor = FakeExecutor()
+        self.asyncio = aio.asyncio
+        aio.asyncio = FakeAsyncio(self.loop)
+
+    def tearDown(self):
+        aio.asyncio = self.asyncio
+        Base.tearDown(self)
+
+    def wait(self, future):
+        return future.result()
+
+    def testLoopAndExecutor(self):
+        # the current loop by default, every call in the given executor
+        mp4 = self.wait(aio.open_async(self.paths[0],
+                                       executor=self.executor))
+        self.wait(mp4.find('moov'))
+        self.wait(mp4.close())
+        self.assertEquals([self.executor] * 3, self.loop.executors)
+
+    def testSharedPosition(self):
+        # calls on a mapping hold its lock, calls on a local file do not
+        mapped = self.wait(aio.open_async(self.paths[0], self.loop,
+                                          self.executor, use_mmap=True))
+        self.assertTrue(self.wait(mapped.run(mapped._lock.locked)))
+        self.assertFalse(mapped._lock.locked())
+        self.wait(mapped.close())
+        local = self.wait(aio.open_async(self.paths[0], self.loop,
+                                         self.executor))
+        self.assertEquals(None, local._lock)
+        self.wait(local.close())
+
+    def testMapFilesShutdown(self):
+        # an executor of its own is shut down once done
+        executor = FakeExecutor()
+        ThreadPoolExecutor = aio.ThreadPoolExecutor
+        aio.ThreadPoolExecutor = lambda max_workers: executor
+        try:
+            self.wait(aio.map_files(len, self.paths, loop=self.loop))
+        finally:
+            aio.ThreadPoolExecutor = ThreadPoolExecutor
+        self.assertTrue(executor.shut_down)
+        self.assertFalse(self.executor.shut_down)
+
+    def testNoLoop(self):
+        aio.asyncio = None
+        self.assertRaises(ImportError, aio.open_async, self.paths[0])
+
+
+@unittest.skipIf(aio.asyncio is None, 'asyncio or trollius is not installed')
+class AsyncioTest(Base, unittest.TestCase):
+    def setUp(self):
+        Base.setUp(self)
+        self.loop = aio.asyncio.new_event_loop()
+        self.executor = None
+
+    def tearDown(self):
+        self.loop.close()
+        Base.tearDown(self)
+
+    def wait(self, future):
+        return self.loop.run_until_complete(future)
+
+    def testParallelCalls(self):
+        # calls on a local file do not wait for each other
+        mp4 = self.wait(aio.open_async(self.paths[0], self.loop))
+        event = threading.Event()
+        first = mp4.run(event.wait, 5)
+        self.wait(mp4.run(event.set))
+        self.assertTrue(self.wait(first))
+        self.wait(mp4.close())
+
+
+if __name__ == "__main__":
+    unittest.main()
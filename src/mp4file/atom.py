@@ -5,12 +5,23 @@ Created on Dec 6, 2009
 
 @author: napier
 '''
+import array
 import logging
+import mmap
 import struct
+import sys
+import thread
+import threading
 import datetime
 from defs import *
 
-from atomsearch import find_path, findall_path
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from atomsearch import find_path, findall_path, build_index
+from transfer import Copier
 
 log = logging.getLogger("mp4file")
 
@@ -64,6 +75,7 @@ ATOM_WITH_CHILDREN = [ 'stik', 'moov', 'trak',
                        'mdia', 'minf',
                        'stbl', 'edts',
                        'moof', 'traf',
+                       'mvex', 'mfra', 'meta',
                       ]
 
 FULL_BOX = (
@@ -75,7 +87,8 @@ FULL_BOX = (
         'stsd', 'stss', 'stsz',
         'stts', 'tfra', 'tkhd',
         'vmhd', 'hdlr', 'saio',
-        'pssh',
+        'pssh', 'co64', 'tfdt',
+        'trex', 'mfro', 'meta',
         )
 
 
@@ -84,15 +97,6 @@ class EndOFFile(Exception):
         Exception.__init__(self)
 
 
-def read64(file):
-    '''Return a number by consuming 64 bits from the file's current position.
-    '''
-    data = file.read(8)
-    if (data is None or len(data) <> 8):
-        raise EndOFFile()
-    return struct.unpack(">Q", data)[0]
-
-
 def read32(file):
     '''Return a number by consuming 32 bits from the file's current position.
     '''
@@ -102,90 +106,480 @@ def read32(file):
     return struct.unpack(">I", data)[0]
 
 
-def read24(file):
-    '''Return a number by consuming 24 bits from the file's current position.
+def read_view(file, size):
+    '''Return size bytes consumed from the file's current position.
+
+    For memory mapped files the result is a zero-copy view of the mapping
+    instead of a new string.
     '''
-    data = file.read(3)
-    if (data is None or len(data) <> 3):
+    if isinstance(file, Window):
+        data = file.pread(file.pos, size)
+        file.pos += len(data)
+        return data
+    if isinstance(file, mmap.mmap):
+        pos = file.tell()
+        size = max(0, min(size, len(file) - pos))
+        file.seek(pos + size)
+        return buffer_view(file, pos, size)
+    return file.read(size)
+
+
+def _consume(file, size):
+    '''Return (data, pos): size bytes consumed from the file's current
+    position, found at data[pos:].  The bytes of windows and mapped files
+    are not copied.
+    '''
+    if isinstance(file, Window):
+        data = file.bytes
+        pos = file.pos - file.base
+        if pos + size > len(data):
+            raise EndOFFile()
+        file.pos += size
+        return data, pos
+    if isinstance(file, mmap.mmap):
+        pos = file.tell()
+        if pos + size > len(file):
+            raise EndOFFile()
+        file.seek(pos + size)
+        return file, pos
+    data = file.read(size)
+    if len(data) != size:
         raise EndOFFile()
-    return struct.unpack(">I", '\0'+data)[0]
+    return data, 0
+
 
+# The longest atom header: size, type, largesize and a 16 byte uuid
+MAX_HEADER_SIZE = 32
 
-def read16(file):
-    '''Return a number by consuming 16 bits from the file's current position.
+# Containers and payloads up to this size are read with a single read
+BLOCK_SIZE = 1 << 16
+
+
+class Window(object):
+    '''File-like object over bytes read from a file at a known offset, or
+    over the mapping of a memory mapped file, so that atoms can seek to
+    their absolute offsets within them.
+
+    Every window has a position of its own: read_block hands out a new
+    window over the same bytes for every decode, so that threads decoding
+    atoms of the same container do not move each other's position.
     '''
-    data = file.read(2)
-    if (data is None or len(data) <> 2):
-        raise EndOFFile()
-    return struct.unpack(">H", data)[0]
+    def __init__(self, data, offset=0):
+        self.bytes = data
+        self.base = offset
+        self.pos = offset
+
+    def pread(self, offset, size):
+        offset -= self.base
+        if isinstance(self.bytes, mmap.mmap):
+            size = max(0, min(size, len(self.bytes) - offset))
+            return buffer_view(self.bytes, offset, size)
+        return self.bytes[offset:offset + size]
+
+    def seek(self, pos, whence=SEEK_SET):
+        if whence == SEEK_CUR:
+            pos += self.pos
+        elif whence == SEEK_END:
+            pos += self.base + len(self.bytes)
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        start = self.pos - self.base
+        if size < 0:
+            data = self.bytes[start:]
+        else:
+            data = self.bytes[start:start + size]
+        self.pos += len(data)
+        return data
+
+
+def read_at(file, offset, size):
+    '''Return size bytes of file from offset.  Files with a pread()
+    method and mapped files are read without using their position, so that
+    several threads may read them at once; other files are read at offset
+    and positioned back.
+    '''
+    if isinstance(file, mmap.mmap):
+        size = max(0, min(size, file.size() - offset))
+        return buffer_view(file, offset, size)
+    pread = getattr(file, 'pread', None)
+    if pread is not None:
+        return pread(offset, size)
+    pos = file.tell()
+    file.seek(offset, SEEK_SET)
+    data = file.read(size)
+    file.seek(pos, SEEK_SET)
+    return data
+
+
+class Payload(object):
+    '''Bytes of a file recorded by offset and size, read on demand.
+
+    Large binary payloads, such as cover art, are kept as Payloads rather
+    than read while parsing.
+    '''
+    __slots__ = ('file', 'offset', 'size')
+
+    def __init__(self, file, offset, size):
+        self.file = file
+        self.offset = offset
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        return str(self.read())
+
+    def __repr__(self):
+        return '<Payload of %d bytes at %d>' % (self.size, self.offset)
+
+    def read(self):
+        '''Return the bytes, a view of the mapping for memory mapped
+        files.
+        '''
+        return read_at(self.file, self.offset, self.size)
+
+    def open(self):
+        '''Return a read-only file object over the bytes.'''
+        return PayloadReader(self)
+
+    def write(self, stream, copier=None):
+        '''Copy the bytes into stream, through copier or a default
+        transfer.Copier, which is returned.
+        '''
+        if copier is None:
+            copier = Copier()
+        copier.copy(self.file, self.offset, self.size, stream)
+        return copier
 
 
-def read8(file):
-    '''Return a number by consuming 8 bits from the file's current position.
+class PayloadReader(object):
+    '''File object reading a Payload, with positions relative to its
+    start.
+    '''
+    def __init__(self, payload):
+        self.payload = payload
+        self.pos = 0
+
+    def seek(self, pos, whence=SEEK_SET):
+        if whence == SEEK_CUR:
+            pos += self.pos
+        elif whence == SEEK_END:
+            pos += self.payload.size
+        if pos < 0:
+            raise IOError('negative seek position %d' % pos)
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        remaining = max(0, self.payload.size - self.pos)
+        if size < 0 or size > remaining:
+            size = remaining
+        if not size:
+            return ''
+        data = str(read_at(self.payload.file, self.payload.offset + self.pos,
+                           size))
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_block(file, offset, size):
+    '''Return a Window over size bytes of file from offset, fetched with
+    a single read, so that the fields of the atoms within are decoded from
+    memory.  Mapped files and windows are not copied: a new Window over
+    the same bytes is returned, positioned at offset.  For blocks over
+    BLOCK_SIZE bytes, file itself is returned, positioned at offset.
+    '''
+    if isinstance(file, Window):
+        window = Window(file.bytes, file.base)
+    elif isinstance(file, mmap.mmap):
+        window = Window(file)
+    else:
+        file.seek(offset, SEEK_SET)
+        if size is None or size > BLOCK_SIZE:
+            return file
+        return Window(file.read(size), offset)
+    window.pos = offset
+    return window
+
+
+def read_table(file, num_entries, fmt='I'):
+    '''Return a tuple of num_entries big endian numbers of the given
+    struct format, consumed from the file's current position.  A format
+    of several codes is that of an entry of several numbers: the tuple
+    holds the numbers of every entry in turn.
     '''
-    data = file.read(1)
-    if (data is None or len(data) <> 1):
+    if len(fmt) == 1:
+        fmt = '>%d%s' % (num_entries, fmt)
+    else:
+        fmt = '>' + fmt * num_entries
+    data, pos = _consume(file, struct.calcsize(fmt))
+    return struct.unpack_from(fmt, data, pos)
+
+
+EPOCH_1904 = datetime.datetime(1904, 1, 1)
+
+def todate(seconds):
+    '''Return the string of a date counted in seconds since 1904.'''
+    date = EPOCH_1904 + datetime.timedelta(seconds = seconds)
+    return date.strftime("%a, %d %b %Y %H:%M:%S GMT")
+
+def _array_typecode(fmt):
+    size = struct.calcsize(fmt)
+    if fmt.islower():
+        codes = 'bhilq'
+    else:
+        codes = 'BHILQ'
+    for code in codes:
+        try:
+            if array.array(code).itemsize == size:
+                return code
+        except ValueError:
+            # 'q' and 'Q' are not available everywhere
+            pass
+    return None
+
+# numpy dtypes and array.array typecodes of the table formats
+NUMPY_DTYPES = {'I': '>u4', 'i': '>i4', 'Q': '>u8'}
+ARRAY_TYPECODES = dict((fmt, _array_typecode(fmt)) for fmt in NUMPY_DTYPES)
+
+
+def read_array(file, num_entries, fmt='I'):
+    '''Return an array of num_entries big endian numbers of the given
+    struct format, consumed from the file's current position.
+
+    This is a big endian numpy array sharing the bytes read (the mapping
+    itself for memory mapped files) when numpy is installed, and an
+    array.array otherwise.  A tuple is returned if array.array has no
+    typecode for the format.
+    '''
+    typecode = ARRAY_TYPECODES[fmt]
+    if numpy is None and typecode is None:
+        return read_table(file, num_entries, fmt)
+    size = num_entries * struct.calcsize(fmt)
+    data = read_view(file, size)
+    if len(data) != size:
         raise EndOFFile()
-    return struct.unpack(">B", data)[0]
-
-def readdate(file):
-    data = read32(file)
-    d = datetime.datetime.strptime("01-01-1904", "%m-%d-%Y")
-    return (d + datetime.timedelta(seconds = data)).strftime("%a, %d %b %Y %H:%M:%S GMT")
-
-def readstr4(file):
-    return file.read(4)
-
-def read_layout(file, info):
-    ret = {}
-    for info, fmt in info.items():
-        ret[info] = eval("read%s(file)" % fmt)
-    return ret
-
-def create_atom(size, type, offset, file):
-    clz = type
-    # Possibly remap atom types that aren't valid
-    # python variable names
-    if (ATOM_TYPE_MAP.has_key(type)):
-        clz = ATOM_TYPE_MAP[type]
+    if numpy is not None:
+        return numpy.frombuffer(data, dtype=NUMPY_DTYPES[fmt])
+    table = array.array(typecode)
+    table.fromstring(data)
+    if sys.byteorder == 'little':
+        table.byteswap()
+    return table
+
+
+def to_array(values, fmt='I'):
+    '''Return a sequence of numbers of the given struct format as the
+    array read_array would return for them.
+    '''
+    if numpy is not None:
+        return numpy.array(values, dtype=NUMPY_DTYPES[fmt])
+    typecode = ARRAY_TYPECODES[fmt]
+    if typecode is None:
+        return tuple(values)
+    return array.array(typecode, values)
+
+
+# Struct codes of the field kinds used in layouts
+LAYOUT_KINDS = {'8':      'B',
+                '16':     'H',
+                '32':     'I',
+                's32':    'i',
+                '64':     'Q',
+                'date':   'I',
+                'date64': 'Q',
+                'str4':   '4s',
+                'matrix': '9I',
+                }
+
+MATRIX_KEYS = ('a', 'b', 'u', 'c', 'd', 'v', 'x', 'y', 'w')
+
+class Layout(object):
+    '''A fixed sequence of named big endian fields.
+
+    The fields are compiled once into a struct.Struct, so that the whole
+    layout decodes with one read and one unpack.  A field named None is
+    padding, and its kind is the number of bytes to skip.
+    '''
+    def __init__(self, *fields):
+        fmt = '>'
+        self.fields = []
+        for name, kind in fields:
+            if name is None:
+                fmt += '%dx' % kind
+            else:
+                fmt += LAYOUT_KINDS[kind]
+                self.fields.append((name, kind))
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+
+    def unpack_from(self, data, offset=0):
+        values = self.struct.unpack_from(data, offset)
+        ret = {}
+        i = 0
+        for name, kind in self.fields:
+            if kind == 'matrix':
+                ret[name] = dict(zip(MATRIX_KEYS, values[i:i + 9]))
+                i += 9
+                continue
+            value = values[i]
+            if kind == 'date' or kind == 'date64':
+                value = todate(value)
+            ret[name] = value
+            i += 1
+        return ret
+
+def read_layout(file, layout):
+    '''Return the dict of fields of layout, consumed from the file's
+    current position.
+    '''
+    data, pos = _consume(file, layout.size)
+    return layout.unpack_from(data, pos)
+
+# Errors of atoms whose fields cannot be decoded
+DECODE_ERRORS = (EndOFFile, struct.error, IndexError, ValueError)
+
+def create_atom(size, type, offset, file, lazy=False, arrays=False,
+                header=None):
+    # Possibly remap atom types to a readable name
+    name = ATOM_TYPE_MAP.get(type, type)
+    clz = ATOM_CLASSES.get(type, Atom)
     try:
-        # Try and eval the class into existance
-        return eval("%s(size, type, clz, offset, file)" % clz)
-    except Exception:
-        # Not defined, use generic Atom
-        return Atom(size, type, clz, offset, file)
+        return clz(size, type, name, offset, file, lazy, arrays, header)
+    except DECODE_ERRORS as e:
+        # Not decodable, use generic Atom
+        log.debug("failed to decode %r atom at %d: %s", type, offset, e)
+        return Atom(size, type, name, offset, file, lazy, arrays, header)
 
 
-def parse_atom(file):
+def parse_atom(file, lazy=False, arrays=False):
     '''Parse the stream to an atom, just from it's current stream position.
+
+    When `lazy` is true only the atom header is read; children and
+    attributes are decoded the first time they are accessed.  When
+    `arrays` is true, sample tables are decoded into arrays (see
+    read_array) instead of tuples.
     '''
     try:
         offset = file.tell()
-        size = read32(file)
-        type = file.read(4)
-        return create_atom(size, type, offset, file)
+        # the whole header in one read, decoded by the atom
+        header = file.read(MAX_HEADER_SIZE)
+        if len(header) < 8:
+            raise EndOFFile()
+        size, type = struct.unpack_from('>I4s', header)
+        return create_atom(size, type, offset, file, lazy, arrays, header)
     except EndOFFile:
         return None
 
 
-def parse_atoms(file, maxFileOffset):
+def parse_atoms(file, maxFileOffset, lazy=False, arrays=False):
     atoms = []
     while file.tell() < maxFileOffset:
-        atom = parse_atom(file)
+        atom = parse_atom(file, lazy, arrays)
+        if atom is None:
+            # truncated header
+            break
         atoms.append(atom)
 
+        size = atom.get_actual_size()
+        if size is None or size < 8:
+            # the atom runs to the end, or its size is broken
+            break
+        end = atom.offset + size
+        if end >= maxFileOffset or \
+                isinstance(file, mmap.mmap) and end > file.size():
+            break
         # Seek to the end of the atom
-        file.seek(atom.offset + atom.size, SEEK_SET)
+        file.seek(end, SEEK_SET)
 
     return atoms
 
 
+def complete_end(atoms, start, file_size):
+    '''Return the end offset of the run of atoms from start that lie
+    whole within file_size bytes; start if the first of them does not.
+    Atoms running to the end of the file are not complete.
+    '''
+    end = start
+    for atom in atoms:
+        if atom.offset < start:
+            continue
+        size = atom.get_actual_size()
+        if size is None or atom.offset != end or \
+                atom.offset + size > file_size:
+            break
+        end = atom.offset + size
+    return end
+
+
+class _NoAttrs(dict):
+    '''The read only, shared attrs of the atoms that have none.'''
+    __slots__ = ()
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('the atom has no attributes to change')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = \
+        update = _read_only
+
+class _PartialAttrs(dict):
+    '''The attrs of an atom while they are being decoded, by the thread
+    identified by owner.
+    '''
+    __slots__ = ('owner',)
+
+class _PendingChildren(object):
+    '''Stands for the children of an atom while they are being parsed,
+    by the thread identified by owner.
+    '''
+    __slots__ = ('owner',)
+
+# Shared by all the atoms without attributes or children, which are most
+# of the atoms of large trees
+NO_ATTRS = _NoAttrs()
+NO_CHILDREN = ()
+
+PENDING = (_PartialAttrs, _PendingChildren)
+
+# Guards the claiming and publishing of the children and attrs of lazy
+# atoms, so that threads sharing a tree decode every atom once and never
+# see it half decoded.  It is never held while reading: threads waiting
+# for an atom another thread decodes wait on it, and the reads of other
+# atoms, and other files, go on meanwhile.
+_decode_cond = threading.Condition(threading.Lock())
+
+
 class Atom(object):
-    def __init__(self, size, type, name, offset, file):
-        self.__init_pre__(size, type, name, offset, file)
+    # Atoms have no __dict__: trees of fragmented files hold hundreds of
+    # thousands of them.  Subclasses declare empty __slots__ too.
+    __slots__ = ('size', 'type', 'name', 'offset', 'header_size',
+                 'version', 'flags', 'largesize', 'uuids', 'file', 'lazy',
+                 'arrays', 'parent', '_children', '_attrs', '_index')
+
+    def __init__(self, size, type, name, offset, file, lazy=False,
+                 arrays=False, header=None):
+        self.lazy = lazy
+        self.arrays = arrays
+        self.__init_pre__(size, type, name, offset, file, header)
         self.__init_post__(size, type, name, offset, file)
 
-    def __init_pre__(self, size, type, name, offset, file):
+    def __init_pre__(self, size, type, name, offset, file, header=None):
         self.size = size
         self.type = type
         self.version = None
@@ -198,30 +592,69 @@ class Atom(object):
         self.header_size = 8
         self.file = file
 
-        self.children = []
-        self.attrs = {}
+        self._children = None
+        self._attrs = None
+        self._index = None
 
+        length = self.header_size
+        if size == 1:
+            length += 8
         if type in FULL_BOX:
-            file.seek(offset+self.header_size)
-            self.version = read8(file)
-            self.flags = read24(file)
-            self.header_size += 4
+            length += 4
+        if type == 'uuid':
+            length += 16
+        if length == self.header_size:
+            return
+        # decode the optional fields from the header bytes, read at once
+        # unless given
+        if header is None or len(header) < length:
+            file.seek(offset, SEEK_SET)
+            header = file.read(length)
+            if len(header) < length:
+                raise EndOFFile()
 
         if size == 1:
-            file.seek(offset+self.header_size)
-            self.largesize = read64(file)
+            self.largesize = struct.unpack_from('>Q', header,
+                                                self.header_size)[0]
             self.header_size += 8
 
+        if type in FULL_BOX:
+            value = struct.unpack_from('>I', header, self.header_size)[0]
+            self.version = value >> 24
+            self.flags = value & 0xFFFFFF
+            self.header_size += 4
+
         # TODO: handling of size == 0
 
         if type == 'uuid':
-            file.seek(offset+self.header_size)
-            self.uuids = file.read(16)
+            self.uuids = header[self.header_size:self.header_size + 16]
             self.header_size += 16
 
     def __init_post__(self, size, type, name, offset, file):
-        if type in ATOM_WITH_CHILDREN:
-            self._set_children(parse_atoms(file, offset + self.get_actual_size()))
+        if not self.lazy:
+            self._get_children()
+            self._get_attrs()
+
+    def _parse_children(self, file):
+        '''Return the list of child atoms.  Called once, on first access.
+        '''
+        if self.type in ATOM_WITH_CHILDREN:
+            start = self.offset + self.header_size
+            end = self.offset + self.get_actual_size()
+            file = read_block(file, start, end - start)
+            return parse_atoms(file, end, self.lazy, self.arrays)
+        return NO_CHILDREN
+
+    def _parse_attrs(self, file):
+        '''Decode the atom specific fields into attrs.  Called once, on
+        first access, with the file positioned just after the header.
+        '''
+        pass
+
+    def _read_table(self, file, num_entries, fmt='I'):
+        if self.arrays:
+            return read_array(file, num_entries, fmt)
+        return read_table(file, num_entries, fmt)
 
     def __str__(self):
         return self.type
@@ -229,13 +662,100 @@ class Atom(object):
     __repr__ = __str__
 
     def _set_attr(self, key, value):
-        self.attrs[key] = value
+        if self.attrs is NO_ATTRS:
+            self._attrs = {}
+        self._attrs[key] = value
 
     def _set_children(self, children):
         # Tell the children who their parents are
         for child in children:
             child.parent = self
-        self.children = children
+        self._children = children or NO_CHILDREN
+
+    def _claim(self, slot, pending):
+        '''Return the value of slot once decoded, waiting while another
+        thread decodes it.  If it is not decoded yet, pending is stored
+        in it and returned: the calling thread decodes it, then calls
+        _publish.  pending is also returned to the thread decoding the
+        slot.
+        '''
+        me = thread.get_ident()
+        _decode_cond.acquire()
+        try:
+            while True:
+                value = getattr(self, slot)
+                if value is None:
+                    pending.owner = me
+                    setattr(self, slot, pending)
+                    return pending
+                if value.__class__ not in PENDING or value.owner == me:
+                    return value
+                _decode_cond.wait()
+        finally:
+            _decode_cond.release()
+
+    def _publish(self, slot, value):
+        _decode_cond.acquire()
+        try:
+            setattr(self, slot, value)
+            _decode_cond.notify_all()
+        finally:
+            _decode_cond.release()
+
+    def _get_children(self):
+        children = self._children
+        if children is not None and \
+                children.__class__ is not _PendingChildren:
+            return children
+        pending = _PendingChildren()
+        children = self._claim('_children', pending)
+        if children is not pending:
+            return children
+        try:
+            children = self._parse_children(self.file)
+        except:
+            self._publish('_children', None)
+            raise
+        for child in children:
+            child.parent = self
+        children = children or NO_CHILDREN
+        self._publish('_children', children)
+        return children
+
+    children = property(_get_children, _set_children)
+
+    def _get_attrs(self):
+        attrs = self._attrs
+        if attrs is not None and attrs.__class__ is not _PartialAttrs:
+            return attrs
+        if self.__class__._parse_attrs.im_func is Atom._parse_attrs.im_func:
+            # nothing to decode, nothing to read
+            self._attrs = NO_ATTRS
+            return NO_ATTRS
+        pending = _PartialAttrs()
+        attrs = self._claim('_attrs', pending)
+        if attrs is not pending:
+            # decoded, or being decoded by this thread
+            return attrs
+        start = self.offset + self.header_size
+        size = self.get_actual_size()
+        if size is not None:
+            size -= self.header_size
+        try:
+            self._parse_attrs(read_block(self.file, start, size))
+        except DECODE_ERRORS as e:
+            # not decodable, as create_atom does for eager atoms
+            log.debug("failed to decode %r atom at %d: %s", self.type,
+                      self.offset, e)
+            pending.clear()
+        except:
+            self._publish('_attrs', None)
+            raise
+        attrs = dict(pending) or NO_ATTRS
+        self._publish('_attrs', attrs)
+        return attrs
+
+    attrs = property(_get_attrs)
 
     def get_attribute(self, key):
         if self.attrs.has_key(key):
@@ -257,43 +777,59 @@ class Atom(object):
     def findall(self, path):
         return findall_path(self, path)
 
+    def build_index(self):
+        '''Index the tree below this atom by type and name, so that
+        './/type' queries on this atom no longer walk the tree.  The index
+        is not updated when the tree changes; call again to rebuild it.
+        '''
+        self._index = build_index(self)
+        return self._index
+
     def read_data(self, offset=0):
-        f = self.file
-        pos = f.tell()
-        f.seek(self.offset + offset)
-        d = f.read(self.size - offset)
-        f.seek(pos)
-        return d
+        '''Return the bytes of the atom, starting at offset from the
+        beginning of its header.  A view of the mapping is returned for
+        memory mapped files.
+        '''
+        return read_at(self.file, self.offset + offset, self.size - offset)
 
     def _write_header(self, stream):
         stream.write(struct.pack('>I', self.size))
         stream.write(self.type)
+        if self.largesize is not None:
+            stream.write(struct.pack('>Q', self.largesize))
         if self.version is not None:
             stream.write(struct.pack('>B', self.version))
         if self.flags is not None:
             stream.write(struct.pack('>I', self.flags)[1:])
-        if self.largesize is not None:
-            stream.write(self.largesize)
         if self.uuids is not None:
             stream.write(self.uuids)
 
-    def _write_data(self, stream):
+    def _write_data(self, stream, copier):
         if self.children:
             for child in self.children:
-                child.write(stream)
+                child.write(stream, copier)
         else:
-            self.file.seek(self.offset+self.header_size, SEEK_SET)
-            stream.write(self.file.read(self.get_actual_size()-self.header_size))
+            size = self.get_actual_size()
+            if size is not None:
+                size -= self.header_size
+            copier.copy(self.file, self.offset + self.header_size, size,
+                        stream)
 
-    def write(self, stream):
+    def write(self, stream, copier=None):
         '''Write out the box into the given stream.
 
         :param stream: a writable stream object.
+        :param copier: the transfer.Copier copying the payloads, a default
+            one if None.
+        :return: the copier, counting the bytes copied.
         '''
+        if copier is None:
+            copier = Copier()
         # header
         self._write_header(stream)
         # data
-        self._write_data(stream)
+        self._write_data(stream, copier)
+        return copier
 
 #    def writeFile(self, filename):
 #        with open(filename, 'w') as fout:
@@ -301,203 +837,466 @@ class Atom(object):
 
 
 class ftyp(Atom):
-    def __init__(self, size, type, name, offset, file):
-        Atom.__init__(self, size, type, name, offset, file)
+    __slots__ = ()
+
+    layout = Layout(('Major_Brand',   'str4'),
+                    ('Minor_version', '32'))
 
-        self.attrs.update(read_layout(file,
-                                  {'Major_Brand':   'str4',
-                                   'Minor_version': '32'}))
+    def _parse_attrs(self, file):
+        self.attrs.update(read_layout(file, self.layout))
 
         cbrands = []
-        for i in range((size - 16) / 4):
+        for i in range((self.size - 16) / 4):
             cbrands.append(file.read(4))
         self._set_attr('Compatible_Brands', cbrands)
 
 class mvhd(Atom):
     "Movie Header Atoms"
-    def __init__(self, size, type, name, offset, file):
-        Atom.__init__(self, size, type, name, offset, file)
-
-        self.attrs.update(read_layout(file,
-                                      {'Creation time':     'date',
-                                       'Modification time': 'date',
-                                       'Time scale':        '32',
-                                       'Duration':          '32',
-                                       'Preferred rate':    '16',
-                                       'Preferred volume':  '16',}))
-
-        # reserved (10 bytes)
-        file.read(10)
-
-        mstruct = {}
-
-        for k in ['a', 'b', 'u', 'c', 'd', 'v', 'x', 'y', 'w']:
-            mstruct[k] = read32(file)
-
-        self._set_attr('Matrix structure', mstruct)
-
-        self.attrs.update(read_layout(file,
-                                      {'Preview time':       '32',
-                                       'Preview duration':   '32',
-                                       'Poster time':        '32',
-                                       'Selection time':     '32',
-                                       'Selection duration': '32',
-                                       'Current time':       '32',
-                                       'Next track ID':      '32'}))
+    __slots__ = ()
+
+    # indexed by version
+    layouts = (Layout(('Creation time',      'date'),
+                      ('Modification time',  'date'),
+                      ('Time scale',         '32'),
+                      ('Duration',           '32'),
+                      ('Preferred rate',     '32'),
+                      ('Preferred volume',   '16'),
+                      (None,                 10),
+                      ('Matrix structure',   'matrix'),
+                      ('Preview time',       '32'),
+                      ('Preview duration',   '32'),
+                      ('Poster time',        '32'),
+                      ('Selection time',     '32'),
+                      ('Selection duration', '32'),
+                      ('Current time',       '32'),
+                      ('Next track ID',      '32')),
+               Layout(('Creation time',      'date64'),
+                      ('Modification time',  'date64'),
+                      ('Time scale',         '32'),
+                      ('Duration',           '64'),
+                      ('Preferred rate',     '32'),
+                      ('Preferred volume',   '16'),
+                      (None,                 10),
+                      ('Matrix structure',   'matrix'),
+                      ('Preview time',       '32'),
+                      ('Preview duration',   '32'),
+                      ('Poster time',        '32'),
+                      ('Selection time',     '32'),
+                      ('Selection duration', '32'),
+                      ('Current time',       '32'),
+                      ('Next track ID',      '32')))
+
+    def _parse_attrs(self, file):
+        self.attrs.update(read_layout(file, self.layouts[self.version]))
 
 class tkhd(Atom):
     "Track Header Atoms"
-    def __init__(self, size, type, name, offset, file):
-        Atom.__init__(self, size, type, name, offset, file)
-        self.attrs.update(read_layout(file,
-                                  {'Creation time':     'date',
-                                   'Modification time': 'date',
-                                   'Track ID':          '32',
-                                   'reserved0':         '32',
-                                   'Duration':          '32',
-                                   'reserved1':         '64',
-                                   'Layer':             '16',
-                                   'Alternate group':   '16',
-                                   'Volume':            '16',
-                                   'reserved2':         '16'}))
-
-        mstruct = {}
-
-        for k in ['a', 'b', 'u', 'c', 'd', 'v', 'x', 'y', 'w']:
-            mstruct[k] = read32(file)
-
-        self._set_attr('Matrix structure', mstruct)
-
-        self.attrs.update(read_layout(file,
-                                  {'Track width':  '32',
-                                   'Track height': '32'}))
+    __slots__ = ()
+
+    # indexed by version
+    layouts = (Layout(('Creation time',     'date'),
+                      ('Modification time', 'date'),
+                      ('Track ID',          '32'),
+                      ('reserved0',         '32'),
+                      ('Duration',          '32'),
+                      ('reserved1',         '64'),
+                      ('Layer',             '16'),
+                      ('Alternate group',   '16'),
+                      ('Volume',            '16'),
+                      ('reserved2',         '16'),
+                      ('Matrix structure',  'matrix'),
+                      ('Track width',       '32'),
+                      ('Track height',      '32')),
+               Layout(('Creation time',     'date64'),
+                      ('Modification time', 'date64'),
+                      ('Track ID',          '32'),
+                      ('reserved0',         '32'),
+                      ('Duration',          '64'),
+                      ('reserved1',         '64'),
+                      ('Layer',             '16'),
+                      ('Alternate group',   '16'),
+                      ('Volume',            '16'),
+                      ('reserved2',         '16'),
+                      ('Matrix structure',  'matrix'),
+                      ('Track width',       '32'),
+                      ('Track height',      '32')))
+
+    def _parse_attrs(self, file):
+        self.attrs.update(read_layout(file, self.layouts[self.version]))
 
 class mdhd(Atom):
     "Media Header Atoms"
-    def __init__(self, size, type, name, offset, file):
-        Atom.__init__(self, size, type, name, offset, file)
-        self.attrs.update(read_layout(file,
-                                      {'Creation time':     'date',
-                                       'Modification time': 'date',
-                                       'Time scale':        '32',
-                                       'Duration':          '32',
-                                       'Language':          '16',
-                                       'Quality':           '16'}))
+    __slots__ = ()
+
+    # indexed by version
+    layouts = (Layout(('Creation time',     'date'),
+                      ('Modification time', 'date'),
+                      ('Time scale',        '32'),
+                      ('Duration',          '32'),
+                      ('Language',          '16'),
+                      ('Quality',           '16')),
+               Layout(('Creation time',     'date64'),
+                      ('Modification time', 'date64'),
+                      ('Time scale',        '32'),
+                      ('Duration',          '64'),
+                      ('Language',          '16'),
+                      ('Quality',           '16')))
+
+    def _parse_attrs(self, file):
+        self.attrs.update(read_layout(file, self.layouts[self.version]))
 
 class vmhd(Atom):
     "Video Media Information Header Atoms"
-    def __init__(self, size, type, name, offset, file):
-        Atom.__init__(self, size, type, name, offset, file)
-        self.attrs.update(read_layout(file,
-                                      {'Graphics mode':   '16',
-                                       'Opcolor (red)':   '16',
-                                       'Opcolor (green)': '16',
-                                       'Opcolor (blue)' : '16'}))
+    __slots__ = ()
+
+    layout = Layout(('Graphics mode',   '16'),
+                    ('Opcolor (red)',   '16'),
+                    ('Opcolor (green)', '16'),
+                    ('Opcolor (blue)',  '16'))
+
+    def _parse_attrs(self, file):
+        self.attrs.update(read_layout(file, self.layout))
 
 class hdlr(Atom):
     "Handler Reference Atoms"
-    def __init__(self, size, type, name, offset, file):
-        Atom.__init__(self, size, type, name, offset, file)
-        self.attrs.update(read_layout(file,
-                                      {'Component type':        'str4',
-                                       'Component subtype':     '32',
-                                       'Component manufacture': '32',
-                                       'Component flags':       '32',
-                                       'Component flags mask':  '32'}))
+    __slots__ = ()
 
-        # Component name... (string)
+    layout = Layout(('Component type',        'str4'),
+                    ('Component subtype',     '32'),
+                    ('Component manufacture', '32'),
+                    ('Component flags',       '32'),
+                    ('Component flags mask',  '32'))
 
-class meta(Atom):
-    def __init__(self, size, type, name, offset, file):
-        Atom.__init__(self, size, type, name, offset, file)
-        # meta has an extra null after the atom header.  consume it here
-        read32(file)
-        self._set_children(parse_atoms(file, offset + size))
+    def _parse_attrs(self, file):
+        self.attrs.update(read_layout(file, self.layout))
+
+        # Component name... (string)
 
 class saio(Atom):
-    def write(self, stream):
+    __slots__ = ()
+
+    def write(self, stream, copier=None):
+        if copier is None:
+            copier = Copier()
         if self.flags:
             # TODO: special treatment to remove 8 bytes from saio
             version, flags = self.version, self.flags
             self.version = self.flags = None
             self._write_header(stream)
             self.version, self.flags = version, flags
-            self.file.seek(self.offset+self.header_size+4, SEEK_SET)
-            stream.write(self.file.read(self.get_actual_size()-4-self.header_size))
+            copier.copy(self.file, self.offset+self.header_size+4,
+                        self.get_actual_size()-4-self.header_size, stream)
             stream.write(struct.pack('>I', 0))
             stream.write(struct.pack('>I', 0))
         else:
-            super(saio, self).write(stream)
+            super(saio, self).write(stream, copier)
+        return copier
 
 class pssh(Atom):
-    def __init__(self, size, type, name, offset, file):
-        super(pssh, self).__init__(size, type, name, offset, file)
+    __slots__ = ()
+
+    def _parse_attrs(self, file):
         self._set_attr('system_id', file.read(16))
         self._set_attr('content_size', read32(file))
-        self._set_attr('content', file.read(self.get_attribute('content_size')))
+        self._set_attr('content',
+                       read_view(file, self.get_attribute('content_size')))
 
 class data(Atom):
-    def __init__(self, size, type, name, offset, file):
-        Atom.__init__(self, size, type, name, offset, file)
+    __slots__ = ()
+
+    def _parse_attrs(self, file):
         # Mask off the version field
-        self.type = read32(file) & 0xFFFFFF
+        data_type = read32(file) & 0xFFFFFF
+        self._set_attr("data_type", data_type)
         data = None
-        if self.type == 1:
-            data = self.parse_string()
+        if data_type == 1:
+            data = self.parse_string(file)
             self._set_attr("data", data)
-        elif self.type == 21 or self.type == 0:
+        elif data_type == 21:
             # Another random null padding
-            read32(self.file)
-            data = read32(self.file)
+            read32(file)
+            # signed integer of 1 to 8 bytes
+            size = self.size - 16
+            data = 0
+            for c in file.read(size):
+                data = (data << 8) | ord(c)
+            if size and data >> (size * 8 - 1):
+                data -= 1 << (size * 8)
             self._set_attr("data", data)
-        elif self.type == 13 or self.type == 14:
+        elif data_type == 0:
             # Another random null padding
-            read32(self.file)
-            data = self.file.read(self.size - 16)
+            read32(file)
+            data = read32(file)
+            self._set_attr("data", data)
+        elif data_type == 13 or data_type == 14:
+            # JPEG or PNG images, read on demand
+            data = Payload(self.file, self.offset + 16, self.size - 16)
             self._set_attr("data", data)
         else:
-            print self.type
+            log.debug("unknown data type %d at %d", data_type, self.offset)
 
-    def parse_string(self):
+    def parse_string(self, file):
         # consume extra null?
-        read32(self.file)
+        read32(file)
         howMuch = self.size - 16
-        return unicode(self.file.read(howMuch), "utf-8")
+        return unicode(read_view(file, howMuch), "utf-8")
 
 class stsz(Atom):
-    def __init__(self, size, type, name, offset, file):
-        Atom.__init__(self, size, type, name, offset, file)
+    "Sample Size Atoms"
+    __slots__ = ()
+
+    def _parse_attrs(self, file):
         sample_size = read32(file)
         self._set_attr('Sample_size', sample_size)
+        num_entries = read32(file)
+        self._set_attr('Number_of_entries', num_entries)
 
-        if sample_size <> 0:
-            num_entries = read32(file)
-            self._set_attr('Number_of_entries', num_entries)
-            table = struct.unpack(">" + "I" * num_entries, file.read(4 * num_entries))
+        # the table is only present when samples differ in size
+        if sample_size == 0:
+            table = self._read_table(file, num_entries)
             self._set_attr('Sample_size_table', table)
 
 class stco(Atom):
-    def __init__(self, size, type, name, offset, file):
-        Atom.__init__(self, size, type, name, offset, file)
+    "Chunk Offset Atoms"
+    __slots__ = ()
+
+    def _parse_attrs(self, file):
+        num_entries = read32(file)
+        self._set_attr('Number_of_entries', num_entries)
+        table = self._read_table(file, num_entries)
+        self._set_attr("Chunk_offset_table", table)
+
+class co64(Atom):
+    "64-bit Chunk Offset Atoms"
+    __slots__ = ()
+
+    def _parse_attrs(self, file):
         num_entries = read32(file)
         self._set_attr('Number_of_entries', num_entries)
-        table = struct.unpack(">" + "I" * num_entries, file.read(4 * num_entries))
+        table = self._read_table(file, num_entries, 'Q')
         self._set_attr("Chunk_offset_table", table)
 
 class stts(Atom):
     "Time-to-Sample Atoms"
-    def __init__(self, size, type, name, offset, file):
-        Atom.__init__(self, size, type, name, offset, file)
+    __slots__ = ()
+
+    def _parse_attrs(self, file):
         num_entries = read32(file)
         self._set_attr('Number_of_entries', num_entries)
-        table = struct.unpack(">" + "I" * num_entries, file.read(4 * num_entries))
+        # flat (sample count, sample delta) pairs
+        table = self._read_table(file, 2 * num_entries)
         self._set_attr("Time_to_sample_table", table)
 
+class ctts(Atom):
+    "Composition Offset Atoms"
+    __slots__ = ()
+
+    def _parse_attrs(self, file):
+        num_entries = read32(file)
+        self._set_attr('Number_of_entries', num_entries)
+        # flat (sample count, composition offset) pairs; the offsets are
+        # signed in version 1
+        if self.version:
+            fmt = 'i'
+        else:
+            fmt = 'I'
+        table = self._read_table(file, 2 * num_entries, fmt)
+        self._set_attr("Composition_offset_table", table)
+
+class stsc(Atom):
+    "Sample-to-Chunk Atoms"
+    __slots__ = ()
+
+    def _parse_attrs(self, file):
+        num_entries = read32(file)
+        self._set_attr('Number_of_entries', num_entries)
+        # flat (first chunk, samples per chunk, sample description id)
+        # triples
+        table = self._read_table(file, 3 * num_entries)
+        self._set_attr("Sample_to_chunk_table", table)
+
+class stss(Atom):
+    "Sync Sample Atoms"
+    __slots__ = ()
+
+    def _parse_attrs(self, file):
+        num_entries = read32(file)
+        self._set_attr('Number_of_entries', num_entries)
+        table = self._read_table(file, num_entries)
+        self._set_attr("Sync_sample_table", table)
+
 class stsd(Atom):
     "Sample Description Atoms"
-    def __init__(self, size, type, name, offset, file):
-        Atom.__init__(self, size, type, name, offset, file)
+    __slots__ = ()
+
+    def _parse_attrs(self, file):
         num_entries = read32(file)
         self._set_attr('Number_of_entries', num_entries)
-        table = struct.unpack(">" + "I" * num_entries, file.read(4 * num_entries))
+        table = read_table(file, num_entries)
         self._set_attr("Sample_description_table", table)
+
+
+class mehd(Atom):
+    "Movie Extends Header Atoms"
+    __slots__ = ()
+
+    # indexed by version
+    layouts = (Layout(('Fragment duration', '32')),
+               Layout(('Fragment duration', '64')))
+
+    def _parse_attrs(self, file):
+        self.attrs.update(read_layout(file, self.layouts[self.version]))
+
+class trex(Atom):
+    "Track Extends Atoms"
+    __slots__ = ()
+
+    layout = Layout(('Track ID',                         '32'),
+                    ('Default sample description index', '32'),
+                    ('Default sample duration',          '32'),
+                    ('Default sample size',              '32'),
+                    ('Default sample flags',             '32'))
+
+    def _parse_attrs(self, file):
+        self.attrs.update(read_layout(file, self.layout))
+
+class mfhd(Atom):
+    "Movie Fragment Header Atoms"
+    __slots__ = ()
+
+    layout = Layout(('Sequence number', '32'))
+
+    def _parse_attrs(self, file):
+        self.attrs.update(read_layout(file, self.layout))
+
+class tfhd(Atom):
+    "Track Fragment Header Atoms"
+    __slots__ = ()
+
+    # optional fields, in order, with the flag announcing them
+    optional = ((0x01, 'Base data offset',         '64'),
+                (0x02, 'Sample description index', '32'),
+                (0x08, 'Default sample duration',  '32'),
+                (0x10, 'Default sample size',      '32'),
+                (0x20, 'Default sample flags',     '32'))
+    # layouts by flags, compiled on first use
+    layouts = {}
+
+    def _parse_attrs(self, file):
+        flags = self.flags & 0x3b
+        layout = self.layouts.get(flags)
+        if layout is None:
+            fields = [('Track ID', '32')]
+            fields += [(key, kind) for flag, key, kind in self.optional
+                       if flags & flag]
+            layout = self.layouts[flags] = Layout(*fields)
+        self.attrs.update(read_layout(file, layout))
+
+class tfdt(Atom):
+    "Track Fragment Decode Time Atoms"
+    __slots__ = ()
+
+    # indexed by version
+    layouts = (Layout(('Base media decode time', '32')),
+               Layout(('Base media decode time', '64')))
+
+    def _parse_attrs(self, file):
+        self.attrs.update(read_layout(file, self.layouts[self.version]))
+
+class trun(Atom):
+    "Track Fragment Run Atoms"
+    __slots__ = ()
+
+    # optional header fields, with the flag announcing them
+    optional = ((0x01, 'Data offset',       's32'),
+                (0x04, 'First sample flags', '32'))
+    # per sample fields, in order, with the flag announcing them
+    columns = ((0x100, 'Sample_duration_table'),
+               (0x200, 'Sample_size_table'),
+               (0x400, 'Sample_flags_table'),
+               (0x800, 'Sample_composition_offset_table'))
+    # header layouts by flags, compiled on first use
+    layouts = {}
+
+    def _parse_attrs(self, file):
+        flags = self.flags & 0x05
+        layout = self.layouts.get(flags)
+        if layout is None:
+            fields = [('Sample count', '32')]
+            fields += [(key, kind) for flag, key, kind in self.optional
+                       if flags & flag]
+            layout = self.layouts[flags] = Layout(*fields)
+        self.attrs.update(read_layout(file, layout))
+
+        # The per sample fields are read as one table and split into one
+        # table per field.  Composition offsets are signed in version 1.
+        keys = [key for flag, key in self.columns if self.flags & flag]
+        if not keys:
+            return
+        if self.version and self.flags & 0x800:
+            fmt = 'i'
+        else:
+            fmt = 'I'
+        count = self.get_attribute('Sample count')
+        table = self._read_table(file, count * len(keys), fmt)
+        for i, key in enumerate(keys):
+            self._set_attr(key, table[i::len(keys)])
+
+class tfra(Atom):
+    "Track Fragment Random Access Atoms"
+    __slots__ = ()
+
+    keys = ('Time_table', 'Moof_offset_table', 'Traf_number_table',
+            'Trun_number_table', 'Sample_number_table')
+    # struct codes of the numbers 1 to 4 bytes long, by length - 1; 3 byte
+    # numbers are read as a byte and a short
+    number_codes = ('B', 'H', 'BH', 'I')
+
+    def _parse_attrs(self, file):
+        track_id, lengths, num_entries = read_table(file, 3)
+        self._set_attr('Track ID', track_id)
+        self._set_attr('Number_of_entries', num_entries)
+
+        # time and moof offset are 64 bits in version 1, traf, trun and
+        # sample numbers are 1 to 4 bytes long
+        if self.version:
+            wide = 'Q'
+        else:
+            wide = 'I'
+        codes = [wide, wide] + [self.number_codes[(lengths >> shift) & 3]
+                                for shift in (4, 2, 0)]
+        entry = ''.join(codes)
+        table = read_table(file, num_entries, entry)
+
+        # one table per field, every entry holding len(entry) numbers
+        pos = 0
+        fmts = (wide, wide, 'I', 'I', 'I')
+        for key, code, fmt in zip(self.keys, codes, fmts):
+            if code == 'BH':
+                column = tuple((high << 16) | low for high, low in
+                               zip(table[pos::len(entry)],
+                                   table[pos + 1::len(entry)]))
+            else:
+                column = table[pos::len(entry)]
+            pos += len(code)
+            if self.arrays:
+                column = to_array(column, fmt)
+            self._set_attr(key, column)
+
+class mfro(Atom):
+    "Movie Fragment Random Access Offset Atoms"
+    __slots__ = ()
+
+    layout = Layout(('Size', '32'))
+
+    def _parse_attrs(self, file):
+        self.attrs.update(read_layout(file, self.layout))
+
+
+# Map of atom type to the class decoding it.  Atoms of other types are
+# plain Atom instances.
+ATOM_CLASSES = dict((clz.__name__, clz) for clz in (
+        ftyp, mvhd, tkhd, mdhd, vmhd, hdlr, saio, pssh, data,
+        stsz, stco, co64, stts, ctts, stsc, stss, stsd,
+        mehd, trex, mfhd, tfhd, tfdt, trun, tfra, mfro,
+        ))
@@ -4,56 +4,134 @@ Created on Dec 26, 2009
 @author: napier
 '''
 
-import re
+# Compiled queries, keyed by their path
+_cache = {}
+_MAXCACHE = 100
+
+
+class PathQuery(object):
+    '''A find path compiled once into a list of steps.
+
+    A path is a '/' separated list of atom types or names, relative to the
+    atom it is applied to.  '*' matches any single atom and '//' any
+    number of levels.  Once an atom matches, its children are not
+    searched any further.
+    '''
+    def __init__(self, findpath):
+        self.path = findpath
+        if findpath[0] != '.':
+            findpath = './' + findpath
+        # Each step is a (descendant, test) pair; descendant is true when
+        # the step may skip any number of levels ('//').
+        self.steps = []
+        descendant = False
+        for part in findpath.split('/')[1:]:
+            if part == '':
+                descendant = True
+                continue
+            self.steps.append((descendant, part))
+            descendant = False
+        self.steps = tuple(self.steps)
+
+    def index_key(self):
+        '''Return the type looked up by a './/type' query, None for any
+        other kind of query.
+        '''
+        if len(self.steps) == 1:
+            descendant, test = self.steps[0]
+            if descendant and test != '*':
+                return test
+        return None
+
+    def iter_matches(self, atom):
+        '''Yield the atoms below atom matched by the query, in document
+        order.
+        '''
+        stack = [(child, (0,)) for child in reversed(atom.children)]
+        while stack:
+            node, states = stack.pop()
+            matched, pending = self.advance(states, node)
+            if matched:
+                yield node
+            elif pending:
+                for child in reversed(node.children):
+                    stack.append((child, pending))
+
+    def advance(self, states, node):
+        '''Match node against the steps in states, the indexes of the
+        steps its parent left pending.  Returns whether the query matches
+        node, and the steps left pending for its children.
+        '''
+        steps = self.steps
+        last = len(steps)
+        name, type = node.name, str(node.type)
+        pending = []
+        for i in states:
+            descendant, test = steps[i]
+            if descendant:
+                pending.append(i)
+            if test == '*' or test == type or test == name:
+                if i + 1 == last:
+                    return True, ()
+                pending.append(i + 1)
+        if len(pending) > 1:
+            return False, tuple(sorted(set(pending)))
+        return False, tuple(pending)
+
+    def find(self, atom):
+        if not self.steps:
+            return atom
+        key = self.index_key()
+        index = getattr(atom, '_index', None)
+        if key is not None and index is not None:
+            found = index.get(key)
+            return found[0] if found else None
+        for match in self.iter_matches(atom):
+            return match
+        return None
+
+    def findall(self, atom):
+        if not self.steps:
+            return atom
+        key = self.index_key()
+        index = getattr(atom, '_index', None)
+        if key is not None and index is not None:
+            return list(index.get(key, ()))
+        return list(self.iter_matches(atom))
+
+
+def compile_path(findpath):
+    '''Return the compiled query of a find path.'''
+    if isinstance(findpath, PathQuery):
+        return findpath
+    query = _cache.get(findpath)
+    if query is None:
+        if len(_cache) >= _MAXCACHE:
+            _cache.clear()
+        query = _cache[findpath] = PathQuery(findpath)
+    return query
+
+
+def build_index(atom):
+    '''Return a map from atom type (and name) to the atoms below atom
+    that a './/type' query returns, in document order.
+    '''
+    index = {}
+    stack = [(child, frozenset()) for child in reversed(atom.children)]
+    while stack:
+        node, above = stack.pop()
+        keys = frozenset((node.name, str(node.type)))
+        for key in keys - above:
+            index.setdefault(key, []).append(node)
+        above = above | keys
+        for child in reversed(node.children):
+            stack.append((child, above))
+    return index
 
-def path_compare(path, pattern):
-    # Handle the simple case
-    if pattern.find('*') == -1 and pattern.find('//') == -1:
-        return path == pattern
-    # Convert pattern into regexp
-    regexp = pattern.replace('*', '[^/]+').replace('//', '.*')
-    return re.match(regexp, path)
 
 def find_path(atom, findpath):
-    if findpath == '.':
-        return atom
-    if (findpath[0] != '.'):
-        findpath = './' + findpath
-    for child in atom.children:
-        res = find_path_helper(child, findpath, '.', '.')
-        if res:
-            return res
-
-def find_path_helper(atom, findpath,
-                     typepath, namepath,
-                     all=False):
-    typepath = typepath + '/' + str(atom.type)
-    namepath = namepath + '/' + atom.name
-    if path_compare(typepath, findpath):
-        if all:
-            return [atom]
-        return atom
-    if path_compare(namepath, findpath):
-        if all:
-            return [atom]
-        return atom
-    all_res = []
-    for child in atom.children:
-        res = find_path_helper(child, findpath, typepath, namepath, all)
-        if not all and res:
-            return res
-        if all:
-            all_res += res
-    if all:
-        return all_res
-    return None
+    return compile_path(findpath).find(atom)
+
 
 def findall_path(atom, findpath):
-    if findpath == '.':
-        return atom
-    if (findpath[0] != '.'):
-        findpath = './' + findpath
-    all_res = []
-    for child in atom.children:
-        all_res += find_path_helper(child, findpath, '.', '.', True)
-    return all_res
\ No newline at end of file
+    return compile_path(findpath).findall(atom)
@@ -3,7 +3,7 @@ Created on Dec 26, 2009
 
 @author: napier
 '''
-from atomsearch import find_path, findall_path
+from atomsearch import find_path, findall_path, compile_path, build_index
 import unittest
 
 
@@ -49,6 +49,28 @@ class Test(unittest.TestCase):
         all = findall_path(self.mp4, './/gc')
         self.assertEquals(2, len(all))
 
+    def testFindNone(self):
+        self.assertEquals(None, find_path(self.mp4, './child2/gc'))
+        self.assertEquals([], findall_path(self.mp4, './/nothing'))
+
+    def testCompiled(self):
+        query = compile_path('.//gc')
+        self.assertTrue(query is compile_path('.//gc'))
+        self.assertEquals(2, len(findall_path(self.mp4, query)))
+        self.assertEquals('grandchild', find_path(self.mp4, query).name)
+
+    def testIndex(self):
+        self.mp4._index = build_index(self.mp4)
+        self.assertEquals(['grandchild', 'granchild'],
+                          [a.name for a in findall_path(self.mp4, './/gc')])
+        self.assertEquals('child2', find_path(self.mp4, './/child2').name)
+        self.assertEquals(None, find_path(self.mp4, './/nothing'))
+        # nested matches are not returned, as without the index
+        self.mp4.children[0].children[0].children = [FakeAtom('gc3', 'gc')]
+        walked = list(compile_path('.//gc').iter_matches(self.mp4))
+        self.assertEquals(walked, build_index(self.mp4)['gc'])
+
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,135 @@
+'''
+Metadata extraction over many files at once.
+
+    python -m mp4file.batch [-j PROCESSES] PATH...
+
+prints one JSON record per file, in completion order.  Directories are
+searched for mp4 files recursively.
+'''
+import json
+import multiprocessing
+import optparse
+import os
+import sys
+
+from atom import ATOM_TYPE_MAP, Payload
+from mp4file import Mp4File
+
+EXTENSIONS = ('.mp4', '.m4a', '.m4v', '.m4b', '.mov', '.3gp')
+
+
+def extract_metadata(path):
+    '''Return the metadata of the file at path as a compact, picklable
+    dict, or an error record if the file cannot be read.
+
+    The record holds the ilst items named in ATOM_TYPE_MAP under 'tags',
+    the movie duration in seconds and, for every track, its ID, duration
+    in seconds and dimensions.  Binary items, such as cover art, are
+    reported by their size in bytes.
+    '''
+    try:
+        mp4 = Mp4File(path, lazy=True)
+        try:
+            return _extract(mp4, path)
+        finally:
+            mp4.close()
+    except Exception as e:
+        return {'path': path, 'error': '%s: %s' % (type(e).__name__, e)}
+
+
+def _extract(mp4, path):
+    if mp4.is_truncated():
+        raise IOError('truncated file')
+    record = {'path': path, 'tags': {}, 'tracks': []}
+    timescale = None
+    mvhd = mp4.find('moov/mvhd')
+    if mvhd is not None:
+        timescale = mvhd.get_attribute('Time scale')
+        if timescale:
+            record['duration'] = \
+                float(mvhd.get_attribute('Duration')) / timescale
+
+    for item in mp4.findall('moov/udta/meta/ilst/*'):
+        if item.type not in ATOM_TYPE_MAP:
+            continue
+        data = item.find('data')
+        if data is None:
+            continue
+        value = data.get_attribute('data')
+        if isinstance(value, (str, buffer, Payload)):
+            value = len(value)
+        record['tags'][item.name] = value
+
+    for tkhd in mp4.findall('moov/trak/tkhd'):
+        track = {'id': tkhd.get_attribute('Track ID'),
+                 'width': tkhd.get_attribute('Track width') / 65536.0,
+                 'height': tkhd.get_attribute('Track height') / 65536.0}
+        if timescale:
+            track['duration'] = \
+                float(tkhd.get_attribute('Duration')) / timescale
+        record['tracks'].append(track)
+    return record
+
+
+def find_files(paths, extensions=EXTENSIONS):
+    '''Yield the given file paths, and the files with one of the given
+    extensions found below the given directories.
+    '''
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if os.path.splitext(filename)[1].lower() in extensions:
+                    yield os.path.join(dirpath, filename)
+
+
+def iter_metadata(paths, processes=None, chunksize=16):
+    '''Extract the metadata of many files with a pool of processes.
+
+    Yields the records of extract_metadata in completion order.  A file
+    that cannot be read yields an error record and does not stop the
+    batch.
+
+    :param paths: file paths and directories, see find_files.
+    :param processes: number of worker processes, one per CPU by default.
+        With 1, files are read in this process.
+    :param chunksize: number of files handed to a worker at once.
+    '''
+    paths = find_files(paths)
+    if processes == 1:
+        for path in paths:
+            yield extract_metadata(path)
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        for record in pool.imap_unordered(extract_metadata, paths,
+                                          chunksize):
+            yield record
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage='%prog [-j PROCESSES] PATH...',
+        description='Print the metadata of mp4 files as JSON lines.')
+    parser.add_option('-j', '--processes', type='int', default=None,
+                      help='number of worker processes (default: CPUs)')
+    options, args = parser.parse_args(argv)
+    if not args:
+        parser.error('no path given')
+    failed = 0
+    for record in iter_metadata(args, options.processes):
+        if 'error' in record:
+            failed += 1
+        sys.stdout.write(json.dumps(record, sort_keys=True) + '\n')
+    return failed and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
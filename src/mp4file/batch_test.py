@@ -0,0 +1,45 @@
+'''
+Tests for batch metadata extraction.
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from batch import iter_metadata
+from testutil import Track, build_movie
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        data = build_movie([Track(1), Track(2, width=640, height=480)])
+        for name, content in (('a.mp4', data), ('b.m4a', data),
+                              ('broken.mp4', data[:40]),
+                              ('notes.txt', 'not an mp4')):
+            open(os.path.join(self.dir, name), 'wb').write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check(self, records):
+        records = dict((os.path.basename(r['path']), r) for r in records)
+        self.assertEquals(['a.mp4', 'b.m4a', 'broken.mp4'], sorted(records))
+        self.assertTrue('error' in records['broken.mp4'])
+        record = records['a.mp4']
+        self.assertEquals(u'Test title', record['tags']['title'])
+        self.assertEquals(120, record['tags']['bpm'])
+        self.assertEquals(260, record['tags']['coverart'])
+        self.assertEquals(1.0, record['duration'])
+        self.assertEquals([1, 2], [t['id'] for t in record['tracks']])
+        self.assertEquals(640.0, record['tracks'][1]['width'])
+
+    def testSerial(self):
+        self.check(iter_metadata([self.dir], processes=1))
+
+    def testPool(self):
+        self.check(iter_metadata([self.dir], processes=2, chunksize=1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,259 @@
+'''
+Benchmarks of opening, searching, decoding and writing synthetic files.
+
+    python -m mp4file.benchmark [-n REPEAT] [-s SCALE] [-o RESULTS]
+                                [-c BASELINE] [SHAPE...]
+
+Every shape is generated deterministically and written to a temporary
+file, then every operation on it is measured in a fresh worker process,
+so that its peak memory is its own.  Results are printed, and written to
+RESULTS, as JSON lines; given the results of an earlier run as BASELINE,
+the ratio of every timing to the baseline is printed as well.
+'''
+import json
+import multiprocessing
+import optparse
+import os
+import resource
+import sys
+import tempfile
+import traceback
+from timeit import default_timer
+
+from mp4file import Mp4File
+from synthetic import DEFAULT_TAGS, Track, build_fragmented, build_movie, \
+     write_temp
+
+
+def _many_tracks(scale):
+    return build_movie([Track(i + 1, sample_sizes=[32] * 50)
+                        for i in range(8 * scale)])
+
+
+def _large_tables(scale):
+    # one chunk per sample: stsz and stco hold an entry per sample
+    sizes = [16 + i % 64 for i in range(20000 * scale)]
+    return build_movie([Track(1, sample_sizes=sizes, samples_per_chunk=1)])
+
+
+def _fragments(scale):
+    sizes = [16 + i % 16 for i in range(2000 * scale)]
+    return build_fragmented(Track(1, sample_sizes=sizes),
+                            samples_per_fragment=2)
+
+
+def _deep_ilst(scale):
+    tags = list(DEFAULT_TAGS) + [('\xa9cmt', 'comment %d' % i)
+                                 for i in range(500 * scale)]
+    return build_movie(tags=tags)
+
+
+# shape name -> generator of the file bytes, given a scale factor
+SHAPES = {
+    'many_tracks': _many_tracks,
+    'large_tables': _large_tables,
+    'fragments': _fragments,
+    'deep_ilst': _deep_ilst,
+}
+
+# shape name -> (find path, findall path, paths of the atoms whose attrs
+# are decoded)
+QUERIES = {
+    'many_tracks': ('moov/trak/mdia/minf/stbl/stsz', './/stco',
+                    'moov/trak/mdia/minf/stbl/*'),
+    'large_tables': ('moov/trak/mdia/minf/stbl/stsz', './/stco',
+                     'moov/trak/mdia/minf/stbl/*'),
+    'fragments': ('moof/traf/trun', './/trun', 'moof/traf/*'),
+    'deep_ilst': ('.//title/data', './/data', 'moov/udta/meta/ilst/*/data'),
+}
+
+# operations measured on every shape, in order
+OPERATIONS = ('open', 'open_lazy', 'find', 'findall', 'attrs', 'write')
+
+
+def _timed(function, repeat, number=1):
+    '''Return the best and the median time of number calls of function,
+    over repeat runs.
+    '''
+    times = []
+    for i in range(repeat):
+        start = default_timer()
+        for j in xrange(number):
+            function()
+        times.append(default_timer() - start)
+    times.sort()
+    return times[0], times[len(times) // 2]
+
+
+def _peak_memory():
+    '''Return the peak resident memory of this process, in kilobytes.'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+def measure(shape, path, operation, repeat=5):
+    '''Return the results of an operation on the file of the given shape
+    at path, as a dict.
+
+    peak_memory_kb is the peak memory of the process, its own for the
+    operation only when measured in a fresh process (see run), and
+    memory_delta_kb the growth of that peak over the timed runs.
+    '''
+    find_path, findall_path, attrs_path = QUERIES[shape]
+    out_fd, out_path = tempfile.mkstemp(suffix='.mp4')
+    os.close(out_fd)
+    mp4 = None
+
+    def open_eager():
+        mp4 = Mp4File(path)
+        mp4.close()
+
+    def open_lazy():
+        mp4 = Mp4File(path, lazy=True)
+        mp4.get_atoms()
+        mp4.close()
+
+    def attrs():
+        mp4 = Mp4File(path, lazy=True)
+        for atom in mp4.findall(attrs_path):
+            atom.attrs
+        mp4.close()
+
+    def write():
+        mp4 = Mp4File(path, lazy=True)
+        out = open(out_path, 'wb')
+        try:
+            mp4.write(out)
+        finally:
+            out.close()
+            mp4.close()
+
+    try:
+        if operation in ('find', 'findall'):
+            mp4 = Mp4File(path)
+        function, number = {
+            'open': (open_eager, 1),
+            'open_lazy': (open_lazy, 1),
+            'find': (lambda: mp4.find(find_path), 100),
+            'findall': (lambda: mp4.findall(findall_path), 10),
+            'attrs': (attrs, 1),
+            'write': (write, 1),
+        }[operation]
+        before = _peak_memory()
+        best, median = _timed(function, repeat, number)
+        peak = _peak_memory()
+        return {'shape': shape, 'operation': operation, 'number': number,
+                'repeat': repeat, 'best': best, 'median': median,
+                'file_size': os.path.getsize(path),
+                'peak_memory_kb': peak, 'memory_delta_kb': peak - before}
+    finally:
+        if mp4 is not None:
+            mp4.close()
+        os.unlink(out_path)
+
+
+def _send(connection, function, args):
+    try:
+        connection.send((True, function(*args)))
+    except Exception:
+        connection.send((False, traceback.format_exc()))
+    connection.close()
+
+
+def _isolated(function, args):
+    '''Return function(*args), called in a new process.'''
+    reader, writer = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=_send,
+                                      args=(writer, function, args))
+    process.start()
+    writer.close()
+    try:
+        ok, value = reader.recv()
+    finally:
+        reader.close()
+        process.join()
+    if not ok:
+        raise RuntimeError('measure failed:\n' + value)
+    return value
+
+
+def run(shapes=None, scale=1, repeat=5, isolate=True):
+    '''Yield the results of measure for every operation on every shape,
+    each measured in a fresh process unless isolate is false.
+    '''
+    if shapes is None:
+        shapes = sorted(SHAPES)
+    for shape in shapes:
+        if shape not in SHAPES:
+            raise ValueError('unknown shape %r' % shape)
+    for shape in shapes:
+        # generated before forking, so that the workers do not inherit
+        # the bytes of the file
+        path = write_temp(SHAPES[shape](scale))
+        try:
+            for operation in OPERATIONS:
+                args = (shape, path, operation, repeat)
+                if isolate:
+                    result = _isolated(measure, args)
+                else:
+                    result = measure(*args)
+                result['scale'] = scale
+                yield result
+        finally:
+            os.unlink(path)
+
+
+def load_results(path):
+    '''Return the results stored in a JSON lines file, keyed by shape,
+    scale and operation.
+    '''
+    results = {}
+    f = open(path)
+    try:
+        for line in f:
+            if line.strip():
+                result = json.loads(line)
+                results[result['shape'], result['scale'],
+                        result['operation']] = result
+    finally:
+        f.close()
+    return results
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage='%prog [-n REPEAT] [-s SCALE] [-o RESULTS] [-c BASELINE] '
+              '[SHAPE...]',
+        description='Benchmark mp4file on synthetic files.  Shapes: ' +
+                    ', '.join(sorted(SHAPES)) + '.')
+    parser.add_option('-n', '--repeat', type='int', default=5,
+                      help='number of runs of every operation (default: 5)')
+    parser.add_option('-s', '--scale', type='int', default=1,
+                      help='size factor of the generated files (default: 1)')
+    parser.add_option('-o', '--output', help='write the results to OUTPUT')
+    parser.add_option('-c', '--compare', metavar='BASELINE',
+                      help='compare with the results of an earlier run')
+    options, args = parser.parse_args(argv)
+    baseline = options.compare and load_results(options.compare) or {}
+    output = options.output and open(options.output, 'w')
+    try:
+        for result in run(args or None, options.scale, options.repeat):
+            line = json.dumps(result, sort_keys=True)
+            if output:
+                output.write(line + '\n')
+            old = baseline.get((result['shape'], result['scale'],
+                                result['operation']))
+            if old is not None and old['best']:
+                result['ratio'] = result['best'] / old['best']
+                line = json.dumps(result, sort_keys=True)
+            sys.stdout.write(line + '\n')
+    finally:
+        if output:
+            output.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+'''
+Smoke tests for the benchmark suite.
+'''
+import json
+import os
+import tempfile
+import unittest
+from StringIO import StringIO
+
+import benchmark
+from mp4file import Mp4File
+from testutil import write_temp
+
+
+class Test(unittest.TestCase):
+    def testShapesAreDeterministic(self):
+        for shape, generate in benchmark.SHAPES.items():
+            data = generate(1)
+            self.assertEquals(data, generate(1))
+            path = write_temp(data)
+            try:
+                mp4 = Mp4File(path)
+                self.assertTrue(mp4.findall(benchmark.QUERIES[shape][1]))
+                mp4.close()
+            finally:
+                os.unlink(path)
+
+    def testRun(self):
+        results = list(benchmark.run(['deep_ilst'], repeat=1, isolate=False))
+        self.assertEquals(['open', 'open_lazy', 'find', 'findall', 'attrs',
+                           'write'], [r['operation'] for r in results])
+        for result in results:
+            self.assertTrue(result['best'] >= 0)
+            self.assertTrue(result['peak_memory_kb'] > 0)
+            self.assertTrue(result['memory_delta_kb'] >= 0)
+            self.assertEquals(1, result['scale'])
+        self.assertRaises(ValueError, list, benchmark.run(['nosuchshape']))
+
+    def testIsolated(self):
+        # every operation runs in a process of its own
+        self.assertNotEquals(os.getpid(), benchmark._isolated(os.getpid, ()))
+        self.assertRaises(RuntimeError, benchmark._isolated,
+                          benchmark.measure, ('deep_ilst', '/nonexistent',
+                                              'open', 1))
+
+    def testCompare(self):
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        stdout = benchmark.sys.stdout
+        try:
+            benchmark.sys.stdout = StringIO()
+            benchmark.main(['-n', '1', '-o', path, 'many_tracks'])
+            benchmark.sys.stdout = out = StringIO()
+            benchmark.main(['-n', '1', '-c', path, 'many_tracks'])
+        finally:
+            benchmark.sys.stdout = stdout
+            baseline = benchmark.load_results(path)
+            os.unlink(path)
+        self.assertEquals(6, len(baseline))
+        for line in out.getvalue().splitlines():
+            self.assertTrue('ratio' in json.loads(line))
+
+
+if __name__ == "__main__":
+    unittest.main()
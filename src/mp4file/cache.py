@@ -0,0 +1,246 @@
+'''
+Persistent cache of parsed atom trees.
+
+A TreeCache stores the parsed tree of a file (offsets, sizes, types and
+decoded attrs of every atom) in a directory, keyed by the path, size and
+modification time of the file and by whether tables are arrays.  Opening
+the file again with the cache loads the tree with a single read instead
+of parsing it.
+
+Trees are stored with marshal, which is not secure against data built
+to attack it: a crafted cache file can crash the process loading it.
+Only use a cache directory that no untrusted user can write to.
+'''
+import array
+import errno
+import hashlib
+import marshal
+import os
+import struct
+import sys
+import tempfile
+from cStringIO import StringIO
+
+from atom import ATOM_CLASSES, ARRAY_TYPECODES, NO_ATTRS, NUMPY_DTYPES, \
+    Atom, Payload, numpy, read_array
+
+# Bumped whenever the stored format changes
+FORMAT_VERSION = 3
+
+# Atom fields stored for every atom, besides its class, attrs and
+# children
+FIELDS = ('type', 'name', 'offset', 'size', 'header_size',
+          'version', 'flags', 'largesize', 'uuids')
+
+SUFFIX = '.tree'
+
+
+# Formats of the arrays of tables, by numpy dtype and array.array typecode
+_ARRAY_FORMATS = dict((dtype, fmt) for fmt, dtype in NUMPY_DTYPES.iteritems())
+_ARRAY_FORMATS.update((code, fmt) for fmt, code in ARRAY_TYPECODES.iteritems()
+                      if code is not None)
+
+
+def _plain(value):
+    '''Return value, with buffers of mapped files copied to strings.'''
+    if isinstance(value, buffer):
+        return str(value)
+    if isinstance(value, dict):
+        return dict((k, _plain(v)) for k, v in value.iteritems())
+    return value
+
+
+def _dump_attrs(attrs):
+    '''Return (plain, special): the attrs marshal stores as they are, and
+    the payloads and arrays as ('payload', offset, size) and ('array',
+    fmt, big endian bytes).
+    '''
+    plain = {}
+    special = {}
+    for key, value in attrs.iteritems():
+        if isinstance(value, Payload):
+            special[key] = ('payload', value.offset, value.size)
+        elif isinstance(value, array.array):
+            table = array.array(value.typecode, value)
+            if sys.byteorder == 'little':
+                table.byteswap()
+            special[key] = ('array', _ARRAY_FORMATS[value.typecode],
+                            table.tostring())
+        elif numpy is not None and isinstance(value, numpy.ndarray):
+            fmt = _ARRAY_FORMATS[value.dtype.str]
+            special[key] = ('array', fmt, value.tostring())
+        else:
+            plain[key] = _plain(value)
+    return plain, special
+
+
+def _load_attrs(plain, special, file):
+    '''Return the attrs stored by _dump_attrs, with their payloads
+    reading from file.
+    '''
+    for key, value in special.iteritems():
+        if value[0] == 'payload':
+            plain[key] = Payload(file, value[1], value[2])
+        elif value[0] == 'array':
+            fmt, data = value[1], value[2]
+            plain[key] = read_array(StringIO(data),
+                                    len(data) // struct.calcsize(fmt), fmt)
+        else:
+            raise ValueError('unknown value %r' % (value[0],))
+    return plain
+
+
+def dump_tree(children):
+    '''Return a list of atoms and their descendants as a flat list of
+    nodes in document order, made of values marshal can store.  Every
+    node holds the class key, FIELDS, attrs (see _dump_attrs) and number
+    of children of an atom.  All the atoms are
+    parsed and decoded on the way.
+    '''
+    nodes = []
+    stack = list(reversed(children))
+    while stack:
+        atom = stack.pop()
+        kids = atom.children
+        attrs = atom.attrs
+        clz = atom.__class__.__name__
+        if ATOM_CLASSES.get(clz) is not atom.__class__:
+            clz = None
+        plain, special = _dump_attrs(attrs)
+        nodes.append((clz, tuple(getattr(atom, f) for f in FIELDS),
+                      plain, special, len(kids)))
+        stack.extend(reversed(kids))
+    return nodes
+
+
+def load_tree(nodes, file, lazy=False, arrays=False):
+    '''Return the list of top level atoms rebuilt from dump_tree nodes,
+    reading from file.
+    '''
+    def build(pos):
+        clz, values, plain, special, count = nodes[pos]
+        atom = Atom.__new__(ATOM_CLASSES.get(clz, Atom))
+        for field, value in zip(FIELDS, values):
+            setattr(atom, field, value)
+        atom.file = file
+        atom.lazy = lazy
+        atom.arrays = arrays
+        atom._attrs = _load_attrs(plain, special, file) or NO_ATTRS
+        atom._index = None
+        pos += 1
+        children = []
+        for i in xrange(count):
+            child, pos = build(pos)
+            children.append(child)
+        atom._set_children(children)
+        return atom, pos
+
+    atoms = []
+    pos = 0
+    while pos < len(nodes):
+        atom, pos = build(pos)
+        atoms.append(atom)
+    return atoms
+
+
+class TreeCache(object):
+    '''Directory of parsed trees, bounded to max_size bytes.
+
+    Trees are evicted least recently used first; using a tree updates the
+    modification time of its cache file.  Cache files are replaced
+    atomically, so a directory may be shared between processes.
+    '''
+    def __init__(self, directory, max_size=256 << 20):
+        self.directory = directory
+        self.max_size = max_size
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            # another process may have created it first
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _cache_path(self, path, arrays=False):
+        key = '%s\0%d' % (os.path.abspath(path), bool(arrays))
+        return os.path.join(self.directory,
+                            hashlib.sha1(key).hexdigest() + SUFFIX)
+
+    def _key(self, path, arrays):
+        st = os.stat(path)
+        return (os.path.abspath(path), st.st_size, st.st_mtime, bool(arrays))
+
+    def load(self, path, file, lazy=False, arrays=False):
+        '''Return the cached top level atoms of the file at path, or None
+        if the file is not cached or has changed since.
+        '''
+        cache_path = self._cache_path(path, arrays)
+        try:
+            f = open(cache_path, 'rb')
+        except IOError:
+            return None
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        try:
+            version, key, nodes = marshal.loads(data)
+        except Exception:
+            return None
+        if version != FORMAT_VERSION or key != self._key(path, arrays):
+            return None
+        try:
+            atoms = load_tree(nodes, file, lazy, arrays)
+        except Exception:
+            # a damaged cache file
+            return None
+        try:
+            os.utime(cache_path, None)
+        except OSError:
+            pass
+        return atoms
+
+    def store(self, path, children, arrays=False):
+        '''Store the tree of the file at path, given its top level atoms
+        parsed with the given arrays option, then evict old trees if the
+        cache is over its size limit.
+        '''
+        key = self._key(path, arrays)
+        data = marshal.dumps((FORMAT_VERSION, key, dump_tree(children)))
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            os.rename(tmp, self._cache_path(path, arrays))
+        except:
+            os.unlink(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        '''Remove the least recently used trees until the cache holds no
+        more than max_size bytes.
+        '''
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(SUFFIX):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, name in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            total -= size
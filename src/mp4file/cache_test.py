@@ -0,0 +1,114 @@
+'''
+Tests for the persistent tree cache.
+'''
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mp4file
+from cache import TreeCache
+from mp4file import Mp4File
+from mp4file_test import dump
+from testutil import build_movie, write_temp
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = write_temp(build_movie())
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        os.unlink(self.path)
+
+    def testHit(self):
+        cache = TreeCache(self.dir)
+        expected = dump(Mp4File(self.path))
+        self.assertEquals(expected, dump(Mp4File(self.path, cache=cache)))
+        # a hit must not parse
+        parse_atoms = mp4file.parse_atoms
+        mp4file.parse_atoms = None
+        try:
+            mp4 = Mp4File(self.path, cache=cache)
+        finally:
+            mp4file.parse_atoms = parse_atoms
+        self.assertEquals(expected, dump(mp4))
+        mdat = mp4.find('mdat')
+        self.assertEquals(mdat.size, len(mdat.read_data()))
+        self.assertTrue(mp4.find('moov/trak').parent is mp4.find('moov'))
+
+    def testArrays(self):
+        cache = TreeCache(self.dir)
+        plain = Mp4File(self.path, cache=cache)
+        table = plain.find('.//stsz').get_attribute('Sample_size_table')
+        self.assertTrue(isinstance(table, tuple))
+        # tables are cached as arrays separately from tuples
+        for i in range(2):
+            mp4 = Mp4File(self.path, cache=cache, arrays=True)
+            stsz = mp4.find('.//stsz').get_attribute('Sample_size_table')
+            self.assertFalse(isinstance(stsz, tuple))
+            self.assertEquals(list(table), [int(n) for n in stsz])
+        self.assertTrue(os.path.exists(cache._cache_path(self.path, True)))
+        self.assertEquals(dump(plain), dump(Mp4File(self.path, cache=cache)))
+
+    def testDamaged(self):
+        cache = TreeCache(self.dir)
+        expected = dump(Mp4File(self.path, cache=cache))
+        tree = cache._cache_path(self.path)
+        open(tree, 'wb').write(open(tree, 'rb').read()[:-10])
+        self.assertEquals(expected, dump(Mp4File(self.path, cache=cache)))
+        # pickles are not loaded
+        open(tree, 'wb').write(
+            "cos\nsystem\n(S'touch %s'\ntR." % os.path.join(self.dir, 'x'))
+        self.assertEquals(expected, dump(Mp4File(self.path, cache=cache)))
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'x')))
+
+    def testChanged(self):
+        cache = TreeCache(self.dir)
+        Mp4File(self.path, cache=cache)
+        open(self.path, 'wb').write(build_movie(tags=None))
+        os.utime(self.path, (time.time() + 10, time.time() + 10))
+        mp4 = Mp4File(self.path, cache=cache)
+        self.assertEquals(None, mp4.find('moov/udta'))
+
+    def testStoreFails(self):
+        cache = TreeCache(self.dir)
+        # the tree cannot be renamed over a directory
+        os.mkdir(cache._cache_path(self.path))
+        with Mp4File(self.path, cache=cache) as mp4:
+            self.assertEquals(dump(Mp4File(self.path)), dump(mp4))
+        self.assertEquals([os.path.basename(cache._cache_path(self.path))],
+                          os.listdir(self.dir))
+
+    def testSelect(self):
+        cache = TreeCache(self.dir)
+        with Mp4File(self.path, cache=cache, select=['//tkhd']) as mp4:
+            self.assertEquals(1, mp4.find('moov/trak/tkhd')
+                              .get_attribute('Track ID'))
+            # storing would decode every atom
+            self.assertEquals(None, mp4.find('moov/trak/mdia')._attrs)
+        self.assertEquals([], os.listdir(self.dir))
+
+    def testEviction(self):
+        cache = TreeCache(self.dir)
+        paths = [write_temp(build_movie()) for i in range(3)]
+        try:
+            for i, path in enumerate(paths):
+                Mp4File(path, cache=cache)
+                tree = cache._cache_path(path)
+                os.utime(tree, (i, i))
+            cache.max_size = 2 * os.path.getsize(tree)
+            # using the first tree makes the second one the oldest
+            Mp4File(paths[0], cache=cache)
+            cache.evict()
+            cached = [os.path.exists(cache._cache_path(p)) for p in paths]
+            self.assertEquals([True, False, True], cached)
+        finally:
+            for path in paths:
+                os.unlink(path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -9,3 +9,10 @@ except:
     SEEK_SET = 0
     SEEK_CUR = 1
     SEEK_END = 2
+
+try:
+    # python 2 mmap objects only implement the old buffer interface
+    buffer_view = buffer
+except NameError:
+    def buffer_view(obj, offset, size):
+        return memoryview(obj)[offset:offset + size]
@@ -0,0 +1,87 @@
+'''
+Sample iteration in file order.
+
+iter_samples() merges the samples of several tracks by file offset, so
+that walking them reads the media data front to back.  read_samples()
+reads the samples in batches of consecutive bytes, one read per batch,
+and hands out the payload of every sample:
+
+    for sample, data in mp4.iter_sample_data():
+        if sample.is_sync:
+            ...
+
+Extracting every sample of an interleaved file is then a single forward
+pass over mdat, with one read per batch_size bytes.
+'''
+import heapq
+from collections import namedtuple
+
+from atom import EndOFFile, read_at
+
+# Largest number of bytes read at once by default
+BATCH_SIZE = 1 << 20
+
+# A sample: dts is its decoding time in media ticks of its track,
+# sample_index counts from 0
+Sample = namedtuple('Sample', 'track_id sample_index dts offset size is_sync')
+
+
+def _track_samples(index):
+    '''Yield (offset, Sample) for the samples of a SampleIndex, in
+    offset order.
+    '''
+    chunk_offset = index.chunk_offset
+    chunk_sample = index.chunk_sample
+    # chunks are usually stored in order already
+    chunks = sorted(xrange(len(chunk_offset)), key=chunk_offset.__getitem__)
+    for chunk in chunks:
+        offset = chunk_offset[chunk]
+        last = min(chunk_sample[chunk + 1], index.sample_count)
+        for n in xrange(chunk_sample[chunk], last):
+            size = index.sample_size(n)
+            yield offset, Sample(index.track_id, n, index.sample_time(n),
+                                 offset, size, index.is_sync(n))
+            offset += size
+
+
+def iter_samples(indexes):
+    '''Yield the Samples of the given SampleIndexes, merged in file
+    offset order.
+    '''
+    for offset, sample in heapq.merge(*[_track_samples(index)
+                                        for index in indexes]):
+        yield sample
+
+
+def read_samples(file, samples, batch_size=BATCH_SIZE):
+    '''Yield (sample, data) for every Sample of samples, read from file.
+
+    Samples are read batch_size bytes at a time: a batch is the run of
+    samples, in the given order, spanning at most batch_size bytes
+    forward, gaps included.  A larger sample is read on its own.
+    '''
+    batch = []
+    start = end = 0
+    for sample in samples:
+        sample_end = sample.offset + sample.size
+        if batch and (sample.offset < start or
+                      sample_end - start > batch_size):
+            for item in _read_batch(file, batch, start, end):
+                yield item
+            batch = []
+        if not batch:
+            start = end = sample.offset
+        batch.append(sample)
+        end = max(end, sample_end)
+    if batch:
+        for item in _read_batch(file, batch, start, end):
+            yield item
+
+
+def _read_batch(file, batch, start, end):
+    data = read_at(file, start, end - start)
+    if len(data) < end - start:
+        raise EndOFFile()
+    for sample in batch:
+        pos = sample.offset - start
+        yield sample, data[pos:pos + sample.size]
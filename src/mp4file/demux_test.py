@@ -0,0 +1,71 @@
+'''
+Tests for sample iteration in file order.
+'''
+import os
+import unittest
+
+from demux import read_samples
+from instrument import CountingFile
+from mp4file import Mp4File
+from testutil import Track, build_movie, write_temp
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.tracks = [Track(1, sample_sizes=range(10, 21), delta=100,
+                             samples_per_chunk=3, sync_every=4),
+                       Track(2, sample_sizes=[7] * 8, delta=250,
+                             samples_per_chunk=2, timescale=2000)]
+        self.path = write_temp(build_movie(self.tracks))
+        self.mp4 = Mp4File(self.path)
+
+    def tearDown(self):
+        self.mp4.close()
+        os.unlink(self.path)
+
+    def testOrder(self):
+        samples = list(self.mp4.iter_samples())
+        self.assertEquals(11 + 8, len(samples))
+        offsets = [s.offset for s in samples]
+        self.assertEquals(sorted(offsets), offsets)
+        # interleaved chunks: 3 samples of track 1, then 2 of track 2
+        self.assertEquals([1, 1, 1, 2, 2, 1],
+                          [s.track_id for s in samples[:6]])
+        first = samples[3]
+        self.assertEquals((2, 0, 0, 7, True),
+                          (first.track_id, first.sample_index, first.dts,
+                           first.size, first.is_sync))
+        track1 = [s for s in samples if s.track_id == 1]
+        self.assertEquals(range(11), [s.sample_index for s in track1])
+        self.assertEquals([100 * n for n in range(11)],
+                          [s.dts for s in track1])
+        self.assertEquals([0, 4, 8],
+                          [s.sample_index for s in track1 if s.is_sync])
+        self.assertEquals([2], list(set(s.track_id for s in
+                                        self.mp4.iter_samples([2]))))
+
+    def testSampleData(self):
+        counter = self.mp4.file = CountingFile(self.mp4.file)
+        count = 0
+        for sample, data in self.mp4.iter_sample_data():
+            track = self.tracks[sample.track_id - 1]
+            self.assertEquals(track.sample_data(sample.sample_index), data)
+            count += 1
+        self.assertEquals(19, count)
+        # the whole mdat in one read
+        self.assertEquals(1, counter.reads)
+
+    def testBatches(self):
+        counter = CountingFile(self.mp4.file, record=True)
+        samples = list(self.mp4.iter_samples())
+        pairs = list(read_samples(counter, samples, batch_size=40))
+        self.assertEquals(samples, [sample for sample, data in pairs])
+        for offset, size in counter.ranges:
+            self.assertTrue(size <= 40)
+        # forward only
+        self.assertEquals(sorted(counter.ranges), counter.ranges)
+        self.assertEquals(samples[0].offset, counter.ranges[0][0])
+
+
+if __name__ == "__main__":
+    unittest.main()
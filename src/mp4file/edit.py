@@ -0,0 +1,99 @@
+'''
+Building blocks for rewriting parts of the atom tree.
+
+render() serializes an atom with some of its descendants replaced, and
+shift_chunk_offsets() rebuilds the chunk offset tables when the media
+data they point to moves within the file.
+'''
+import struct
+from bisect import bisect_right
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Atom types holding padding only
+FREE_TYPES = ('free', 'skip')
+
+
+def header_bytes(atom, payload_size):
+    '''Return the header of atom for the given payload size.  A large
+    size is used when the atom no longer fits a 32 bit size.
+    '''
+    extra = ''
+    if atom.version is not None:
+        extra += struct.pack('>I', (atom.version << 24) | atom.flags)
+    if atom.uuids is not None:
+        extra += atom.uuids
+    size = 8 + len(extra) + payload_size
+    if size > 0xFFFFFFFF:
+        return struct.pack('>I4sQ', 1, atom.type, size + 8) + extra
+    return struct.pack('>I4s', size, atom.type) + extra
+
+
+def free_atom(size):
+    '''Return a free atom of size bytes; size must be at least 8.'''
+    return struct.pack('>I4s', size, 'free') + '\0' * (size - 8)
+
+
+def render(atom, replace=None):
+    '''Return the bytes of atom.
+
+    replace(atom) is called for atom and its descendants; when it returns
+    a string, that string replaces the atom and everything below it.
+    Sizes of the enclosing atoms are recomputed.  Atoms without children
+    are copied from the file as they are.
+    '''
+    if replace is not None:
+        data = replace(atom)
+        if data is not None:
+            return data
+    children = atom.children
+    if not children:
+        return str(atom.read_data())
+    payload = ''.join(render(child, replace) for child in children)
+    return header_bytes(atom, len(payload)) + payload
+
+
+def shift_chunk_offsets(atom, shifts):
+    '''Return the bytes of an stco or co64 atom with its offsets moved.
+
+    shifts is a sorted list of (start, delta) pairs: offsets at or after
+    start, and before the next start, move by delta.  An stco atom is
+    promoted to co64 when a moved offset no longer fits 32 bits.
+
+    Raises ValueError when the table cannot be decoded, or when its entry
+    count does not match the size of the atom, rather than write out
+    offsets that are wrong.
+    '''
+    offsets = atom.get_attribute('Chunk_offset_table')
+    if offsets is None:
+        raise ValueError('%s atom at %d cannot be decoded' %
+                         (atom.type, atom.offset))
+    count = len(offsets)
+    entry_size = atom.type == 'co64' and 8 or 4
+    if atom.header_size + 4 + count * entry_size != atom.get_actual_size():
+        raise ValueError('%s atom at %d holds %d bytes, not %d entries' %
+                         (atom.type, atom.offset, atom.get_actual_size(),
+                          count))
+    type = atom.type
+    starts = [start for start, delta in shifts]
+    if numpy is not None:
+        table = numpy.asarray(offsets, dtype=numpy.int64)
+        deltas = numpy.asarray([0] + [delta for start, delta in shifts],
+                               dtype=numpy.int64)
+        table = table + deltas[numpy.searchsorted(starts, table, 'right')]
+        if type == 'stco' and count and table.max() > 0xFFFFFFFF:
+            type = 'co64'
+        payload = table.astype(type == 'co64' and '>u8' or '>u4').tostring()
+    else:
+        deltas = [0] + [delta for start, delta in shifts]
+        table = [o + deltas[bisect_right(starts, o)] for o in offsets]
+        if type == 'stco' and count and max(table) > 0xFFFFFFFF:
+            type = 'co64'
+        fmt = type == 'co64' and 'Q' or 'I'
+        payload = struct.pack('>%d%s' % (count, fmt), *table)
+    payload = struct.pack('>II', (atom.version << 24) | atom.flags,
+                          count) + payload
+    return struct.pack('>I4s', 8 + len(payload), type) + payload
@@ -0,0 +1,84 @@
+'''
+Moving the moov atom in front of the media data.
+
+A player can only start a progressive download once it has read moov.
+When moov is stored after mdat, write_faststart writes the file with moov
+moved in front of the first mdat, and the chunk offsets in stco and co64
+shifted to the new position of the media data.  Only moov is held in
+memory; the other atoms are copied through Atom.write, so mdat is read
+once, sequentially, in bounded chunks.
+'''
+from edit import render, shift_chunk_offsets
+from transfer import BUFFER_SIZE, Copier
+
+
+def _layout(mp4):
+    '''Return the index of moov and of the first mdat among the top level
+    atoms of mp4; the latter is None when there is no mdat.
+    '''
+    moov = mdat = None
+    for index, atom in enumerate(mp4.children):
+        if atom.type == 'moov' and moov is None:
+            moov = index
+        elif atom.type == 'mdat' and mdat is None:
+            mdat = index
+    if moov is None:
+        raise ValueError('no moov atom')
+    return moov, mdat
+
+
+def is_faststart(mp4):
+    '''Return whether moov comes before the media data of mp4.'''
+    moov, mdat = _layout(mp4)
+    return mdat is None or moov < mdat
+
+
+def render_moov(moov, insert, end):
+    '''Return the bytes of moov moved to offset insert, from its old place
+    ending at offset end, with the chunk offsets shifted to match.
+    '''
+    old_size = end - moov.offset
+
+    def replace(atom):
+        if atom.type in ('stco', 'co64'):
+            # media data in front of the old moov moves by the new moov
+            # size, media data after it by the growth of moov
+            return shift_chunk_offsets(atom, [(insert, size),
+                                              (end, size - old_size)])
+
+    size = old_size
+    while True:
+        data = render(moov, replace)
+        if len(data) == size:
+            return data
+        # moov grew, e.g. when offsets no longer fit stco
+        size = len(data)
+
+
+def write_faststart(mp4, stream, copier=None, buffer_size=BUFFER_SIZE):
+    '''Write out the file with moov in front of the media data.  Files
+    that already have it there are written unchanged.
+
+    :param mp4: the Mp4File to write out.
+    :param stream: a writable stream object.
+    :param copier: the transfer.Copier to use instead of a new one.
+    :return: the copier; its bytes_copied counts the payload bytes.
+    '''
+    if copier is None:
+        copier = Copier(buffer_size)
+    moov_index, mdat_index = _layout(mp4)
+    if mdat_index is None or moov_index < mdat_index:
+        return mp4.write(stream, copier)
+    atoms = mp4.children
+    moov = atoms[moov_index]
+    size = moov.get_actual_size()
+    if size is None:
+        # moov runs to the end of the file
+        size = mp4.size - moov.offset
+    data = render_moov(moov, atoms[mdat_index].offset, moov.offset + size)
+    for index, atom in enumerate(atoms):
+        if index == mdat_index:
+            stream.write(data)
+        if index != moov_index:
+            atom.write(stream, copier)
+    return copier
@@ -0,0 +1,69 @@
+'''
+Tests for moving moov in front of the media data.
+'''
+import os
+import struct
+import unittest
+from StringIO import StringIO
+
+from edit import shift_chunk_offsets
+from faststart import is_faststart
+from mp4file import Mp4File
+from testutil import Track, build_movie, full_box, open_counting, u32, \
+     write_temp
+from transfer import Copier
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.paths = []
+
+    def tearDown(self):
+        for path in self.paths:
+            os.unlink(path)
+
+    def open(self, data, **kwargs):
+        path = write_temp(data)
+        self.paths.append(path)
+        return Mp4File(path, **kwargs)
+
+    def testMoveMoov(self):
+        tracks = [Track(1), Track(2, sample_sizes=[40] * 7)]
+        path = write_temp(build_movie(tracks, moov_first=False))
+        self.paths.append(path)
+        mp4, counter = open_counting(path, lazy=True)
+        self.assertFalse(is_faststart(mp4))
+        # moov is read at once while parsing
+        mp4.find('moov').get_atoms()
+        counter.reads = counter.largest = 0
+        out = StringIO()
+        copier = mp4.write_faststart(out, Copier(64, use_kernel=False))
+        # the offsets shift exactly as if the file was built moov first
+        self.assertEquals(build_movie(tracks, moov_first=True),
+                          out.getvalue())
+        self.assertTrue(counter.reads > mp4.find('mdat').size / 64)
+        self.assertEquals(64, counter.largest)
+        self.assertTrue(copier.bytes_copied > mp4.find('mdat').size - 8)
+        self.assertTrue(is_faststart(self.open(out.getvalue())))
+
+    def testAlreadyFaststart(self):
+        data = build_movie()
+        mp4 = self.open(data)
+        self.assertTrue(is_faststart(mp4))
+        out = StringIO()
+        mp4.write_faststart(out)
+        self.assertEquals(data, out.getvalue())
+
+    def testShiftChunkOffsets(self):
+        mp4 = self.open(full_box('stco', u32(4, 10, 100, 200, 0xFFFFFF00)))
+        stco = mp4.find('stco')
+        self.assertEquals(full_box('stco', u32(4, 10, 150, 190, 0xFFFFFEF6)),
+                          shift_chunk_offsets(stco, [(100, 50), (200, -10)]))
+        # offsets over 32 bits promote the table to co64
+        self.assertEquals(full_box('co64', u32(4) + struct.pack(
+                              '>4Q', 10, 100, 200, 0x100000000)),
+                          shift_chunk_offsets(stco, [(0xFFFFFF00, 0x100)]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+'''
+Random access into fragmented mp4 files.
+
+A fragmented file may close with an mfra atom, indexing the moof atoms of
+every track by time, and an mfro atom giving the size of the mfra.  Both
+are read from the end of the file, so a fragment can be located without
+walking the (possibly tens of thousands of) moof atoms before it.
+'''
+from bisect import bisect_right
+
+from defs import *
+from atom import parse_atom
+
+
+def read_mfra(file, file_size, lazy=False, arrays=False):
+    '''Return the mfra atom closing the file, located through the mfro
+    atom of its last 16 bytes, or None when the file has none.
+    '''
+    if file_size < 16:
+        return None
+    file.seek(file_size - 16, SEEK_SET)
+    mfro = parse_atom(file)
+    if mfro is None or mfro.type != 'mfro':
+        return None
+    size = mfro.get_attribute('Size')
+    if not 16 <= size <= file_size:
+        return None
+    file.seek(file_size - size, SEEK_SET)
+    mfra = parse_atom(file, lazy, arrays)
+    if mfra is None or mfra.type != 'mfra':
+        return None
+    return mfra
+
+
+class FragmentIndex(object):
+    '''Random access points of every track, read from an mfra atom.
+
+    Times are in media ticks of the track.
+    '''
+    def __init__(self, mfra):
+        # track id -> (times, moof offsets), sorted by time
+        self.tracks = {}
+        for tfra in mfra.findall('tfra'):
+            points = sorted(zip(tfra.get_attribute('Time_table'),
+                                tfra.get_attribute('Moof_offset_table')))
+            self.tracks[tfra.get_attribute('Track ID')] = (
+                [time for time, offset in points],
+                [offset for time, offset in points])
+
+    def lookup(self, track_id, time):
+        '''Return the offset of the moof atom of the last random access
+        point of the track at or before time, or None.
+        '''
+        if track_id not in self.tracks:
+            return None
+        times, offsets = self.tracks[track_id]
+        i = bisect_right(times, time) - 1
+        if i < 0:
+            # before the first random access point
+            return None
+        return offsets[i]
@@ -0,0 +1,106 @@
+'''
+Tests for fragmented files.
+'''
+import os
+import struct
+import unittest
+from cStringIO import StringIO
+
+from atom import parse_atom
+from mp4file import Mp4File
+from testutil import Track, build_fragmented, full_box, u32, write_temp
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.track = Track(sample_sizes=range(10, 30), delta=40)
+        self.data = build_fragmented(self.track, samples_per_fragment=4)
+        self.path = write_temp(self.data)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def testFragments(self):
+        mp4 = Mp4File(self.path)
+        moofs = mp4.findall('moof')
+        self.assertEquals(5, len(moofs))
+        moof = moofs[1]
+        self.assertEquals(2, moof.find('mfhd')
+                          .get_attribute('Sequence number'))
+        tfhd = moof.find('traf/tfhd')
+        self.assertEquals(1, tfhd.get_attribute('Track ID'))
+        self.assertEquals(40, tfhd.get_attribute('Default sample duration'))
+        self.assertEquals(None, tfhd.get_attribute('Base data offset'))
+        self.assertEquals(160, moof.find('traf/tfdt')
+                          .get_attribute('Base media decode time'))
+        trun = moof.find('traf/trun')
+        self.assertEquals(4, trun.get_attribute('Sample count'))
+        self.assertEquals((14, 15, 16, 17),
+                          trun.get_attribute('Sample_size_table'))
+        self.assertEquals(None, trun.get_attribute('Sample_duration_table'))
+        # the payload of the first sample follows the moof
+        offset = moof.offset + trun.get_attribute('Data offset')
+        self.assertEquals(self.track.sample_data(4),
+                          self.data[offset:offset + 14])
+
+    def testArrays(self):
+        trun = Mp4File(self.path, arrays=True).find('moof/traf/trun')
+        self.assertEquals([10, 11, 12, 13],
+                          list(trun.get_attribute('Sample_size_table')))
+
+    def testRandomAccessArrays(self):
+        mp4 = Mp4File(self.path, lazy=True)
+        tfra = mp4.find('mfra/tfra')
+        arrays = Mp4File(self.path, lazy=True, arrays=True).find('mfra/tfra')
+        for key in tfra.keys:
+            self.assertTrue(isinstance(tfra.get_attribute(key), tuple))
+            self.assertFalse(isinstance(arrays.get_attribute(key), tuple))
+            self.assertEquals(list(tfra.get_attribute(key)),
+                              [int(n) for n in arrays.get_attribute(key)])
+        self.assertEquals([0, 160, 320, 480, 640],
+                          list(tfra.get_attribute('Time_table')))
+
+    def testNumberLengths(self):
+        # 3 byte traf, 2 byte trun and 4 byte sample numbers
+        entries = [(100, 2000, 0x010203, 0x0405, 0x06070809),
+                   (200, 3000, 1, 2, 3)]
+        payload = u32(1, (2 << 4) | (1 << 2) | 3, len(entries))
+        for time, offset, traf, trun, sample in entries:
+            payload += struct.pack('>II', time, offset)
+            payload += struct.pack('>I', traf)[1:]
+            payload += struct.pack('>HI', trun, sample)
+        tfra = parse_atom(StringIO(full_box('tfra', payload)))
+        self.assertEquals(entries, zip(*[tfra.get_attribute(key)
+                                         for key in tfra.keys]))
+
+    def testRandomAccess(self):
+        mp4 = Mp4File(self.path, lazy=True)
+        index = mp4.get_fragment_index()
+        self.assertEquals(5, len(index.tracks[1][0]))
+        moof = mp4.find_fragment(1, 400)
+        # random access points are every 160 ticks
+        self.assertEquals(mp4.findall('moof')[2].offset, moof.offset)
+        self.assertEquals(320, moof.find('traf/tfdt')
+                          .get_attribute('Base media decode time'))
+        self.assertEquals(None, mp4.find_fragment(2, 400))
+        # nothing before the first random access point
+        self.assertEquals(mp4.findall('moof')[0].offset,
+                          mp4.find_fragment(1, 0).offset)
+        self.assertEquals(None, mp4.find_fragment(1, -1))
+        times, offsets = index.tracks[1]
+        index.tracks[1] = (times[1:], offsets[1:])
+        self.assertEquals(None, index.lookup(1, 100))
+        self.assertEquals(offsets[1], index.lookup(1, 160))
+
+    def testNoMfra(self):
+        path = write_temp(build_fragmented(self.track, mfra=False))
+        try:
+            mp4 = Mp4File(path, lazy=True)
+            self.assertEquals(None, mp4.get_fragment_index())
+            self.assertEquals(None, mp4.find_fragment(1, 0))
+        finally:
+            os.unlink(path)
+
+
+if __name__ == "__main__":
+    unittest.main()
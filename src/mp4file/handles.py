@@ -0,0 +1,219 @@
+'''
+File handles that many threads can read at once.
+
+All the atoms of a tree read through one file object.  The file objects
+here keep a position per thread and read with positional reads, pread(),
+so that readers in different threads never move each other's position.
+os.pread is used where the platform has it; elsewhere the seek and read
+pair runs under a lock.
+
+A HandlePool bounds the number of descriptors held by the files opened
+through it: when over its limit, it closes the least recently used
+descriptors that are not being read, and files reopen theirs on demand.
+'''
+import os
+import threading
+from collections import OrderedDict
+
+from defs import *
+
+_pread = getattr(os, 'pread', None)
+
+# Default number of descriptors kept open by a HandlePool
+MAX_OPEN = 64
+
+
+def _read_at(file, lock, offset, size):
+    '''Read size bytes of an open file from offset.'''
+    if _pread is not None:
+        chunks = []
+        fd = file.fileno()
+        while size > 0:
+            data = _pread(fd, size, offset)
+            if not data:
+                break
+            chunks.append(data)
+            offset += len(data)
+            size -= len(data)
+        return ''.join(chunks)
+    lock.acquire()
+    try:
+        file.seek(offset, SEEK_SET)
+        return file.read(size)
+    finally:
+        lock.release()
+
+
+class PositionalFile(object):
+    '''Read-only file object with a position per thread.
+
+    Subclasses provide pread(offset, size) and size().
+    '''
+    def __init__(self):
+        self._local = threading.local()
+
+    def seek(self, pos, whence=SEEK_SET):
+        if whence == SEEK_CUR:
+            pos += self.tell()
+        elif whence == SEEK_END:
+            pos += self.size()
+        if pos < 0:
+            raise IOError('negative seek position %d' % pos)
+        self._local.pos = pos
+
+    def tell(self):
+        return getattr(self._local, 'pos', 0)
+
+    def read(self, size=-1):
+        pos = self.tell()
+        if size < 0:
+            size = max(0, self.size() - pos)
+        data = self.pread(pos, size)
+        self._local.pos = pos + len(data)
+        return data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SharedFile(PositionalFile):
+    '''PositionalFile over a file opened by path.'''
+    def __init__(self, path):
+        PositionalFile.__init__(self)
+        self.name = path
+        self.file = open(path, 'rb')
+        self._lock = threading.Lock()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def size(self):
+        return os.fstat(self.file.fileno()).st_size
+
+    def pread(self, offset, size):
+        return _read_at(self.file, self._lock, offset, size)
+
+    @property
+    def closed(self):
+        return self.file.closed
+
+    def close(self):
+        self.file.close()
+
+
+class HandlePool(object):
+    '''Bounded set of open descriptors, shared by the PooledFiles opened
+    through it.
+
+    :param max_open: number of descriptors kept open, unless more files
+        are being read at the same moment.
+    '''
+    def __init__(self, max_open=MAX_OPEN):
+        self.max_open = max_open
+        self._lock = threading.Lock()
+        # path -> [file, lock, number of reads in progress]
+        self._handles = OrderedDict()
+        # number of descriptors opened so far
+        self.opened = 0
+
+    def open(self, path):
+        '''Return a PooledFile of the file at path.'''
+        return PooledFile(path, self)
+
+    def _acquire(self, path):
+        self._lock.acquire()
+        try:
+            entry = self._handles.pop(path, None)
+            if entry is None:
+                entry = [open(path, 'rb'), threading.Lock(), 0]
+                self.opened += 1
+            entry[2] += 1
+            # most recently used last
+            self._handles[path] = entry
+            self._trim()
+            return entry
+        finally:
+            self._lock.release()
+
+    def _release(self, entry):
+        self._lock.acquire()
+        try:
+            entry[2] -= 1
+            self._trim()
+        finally:
+            self._lock.release()
+
+    def _trim(self):
+        excess = len(self._handles) - self.max_open
+        for path in list(self._handles):
+            if excess <= 0:
+                break
+            entry = self._handles[path]
+            if entry[2] == 0:
+                entry[0].close()
+                del self._handles[path]
+                excess -= 1
+
+    def pread(self, path, offset, size):
+        entry = self._acquire(path)
+        try:
+            return _read_at(entry[0], entry[1], offset, size)
+        finally:
+            self._release(entry)
+
+    def size(self, path):
+        entry = self._acquire(path)
+        try:
+            return os.fstat(entry[0].fileno()).st_size
+        finally:
+            self._release(entry)
+
+    def discard(self, path):
+        '''Close the descriptor of path, unless it is being read.'''
+        self._lock.acquire()
+        try:
+            entry = self._handles.get(path)
+            if entry is not None and entry[2] == 0:
+                entry[0].close()
+                del self._handles[path]
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._handles)
+
+    def close(self):
+        '''Close every descriptor not being read.'''
+        self._lock.acquire()
+        try:
+            for path, entry in list(self._handles.items()):
+                if entry[2] == 0:
+                    entry[0].close()
+                    del self._handles[path]
+        finally:
+            self._lock.release()
+
+
+class PooledFile(PositionalFile):
+    '''PositionalFile reading through a descriptor of a HandlePool.'''
+    def __init__(self, path, pool):
+        PositionalFile.__init__(self)
+        self.name = path
+        self.pool = pool
+        self.closed = False
+
+    def size(self):
+        return self.pool.size(self.name)
+
+    def pread(self, offset, size):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        return self.pool.pread(self.name, offset, size)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.pool.discard(self.name)
@@ -0,0 +1,185 @@
+'''
+Tests for concurrent reads and the lifecycle of file handles.
+'''
+import os
+import sys
+import threading
+import time
+import unittest
+
+from handles import HandlePool, SharedFile
+from mp4file import Mp4File
+from sampleindex import SampleIndex
+from testutil import Track, build_movie, write_temp
+
+
+class SlowFile(object):
+    '''Wrap a file object, delaying its positional reads and recording
+    how many are in progress at once.
+    '''
+    lock = threading.Lock()
+    active = [0, 0]
+
+    def __init__(self, file):
+        self.file = file
+
+    def _slow(self, function, *args):
+        active = self.active
+        self.lock.acquire()
+        active[0] += 1
+        active[1] = max(active)
+        self.lock.release()
+        time.sleep(0.05)
+        try:
+            return function(*args)
+        finally:
+            self.lock.acquire()
+            active[0] -= 1
+            self.lock.release()
+
+    def read(self, size=-1):
+        return self._slow(self.file.read, size)
+
+    def pread(self, offset, size):
+        return self._slow(self.file.pread, offset, size)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.track = Track(sample_sizes=[500 + i for i in range(200)])
+        self.path = write_temp(build_movie([self.track]))
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def testSharedFile(self):
+        data = open(self.path, 'rb').read()
+        f = SharedFile(self.path)
+        self.assertEquals(len(data), f.size())
+        self.assertEquals(data[100:150], f.pread(100, 50))
+        f.seek(10)
+        self.assertEquals(data[10:20], f.read(10))
+        self.assertEquals(20, f.tell())
+        # positions are per thread
+        positions = []
+        thread = threading.Thread(target=lambda: positions.append(f.tell()))
+        thread.start()
+        thread.join()
+        self.assertEquals([0], positions)
+        f.seek(-5, 2)
+        self.assertEquals(data[-5:], f.read())
+        f.close()
+        self.assertTrue(f.closed)
+
+    def testConcurrentReads(self):
+        with Mp4File(self.path, lazy=True) as mp4:
+            index = SampleIndex(mp4.find('moov/trak'))
+            mdat = mp4.find('mdat')
+            errors = []
+
+            def worker(first):
+                try:
+                    for n in range(first, 200, 4):
+                        data = mdat.read_data(index.sample_offset(n) -
+                                              mdat.offset)
+                        data = str(data)[:self.track.sample_sizes[n]]
+                        if data != self.track.sample_data(n):
+                            errors.append(n)
+                        # lazy atoms decoded from several threads at once
+                        mp4.find('moov/trak/mdia/minf/stbl/stsz').attrs
+                except Exception as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=worker, args=(n,))
+                       for n in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEquals([], errors)
+        self.assertTrue(mp4.file.closed)
+
+    def testParallelDecodes(self):
+        # lazy decodes of different files read at the same time
+        files = [Mp4File(self.path, lazy=True) for i in range(4)]
+        SlowFile.active[:] = [0, 0]
+        moovs = []
+        for mp4 in files:
+            moov = mp4.find('moov')
+            moov.file = SlowFile(moov.file)
+            moovs.append(moov)
+        threads = [threading.Thread(target=lambda moov=moov: moov.find(
+            'trak/mdia/minf/stbl/stsz').attrs) for moov in moovs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(SlowFile.active[1] > 1)
+        for moov in moovs:
+            self.assertEquals(
+                self.track.sample_sizes,
+                list(moov.find('trak/mdia/minf/stbl/stsz').get_attribute(
+                    'Sample_size_table')))
+        for mp4 in files:
+            mp4.close()
+
+    def testSiblingDecodes(self):
+        # atoms of one container decoded at once, from the same bytes
+        tracks = [Track(i + 1, sample_sizes=[16 + i] * 200) for i in range(8)]
+        path = write_temp(build_movie(tracks))
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            for options in ({'lazy': True}, {'lazy': True, 'use_mmap': True}):
+                for run in range(20):
+                    mp4 = Mp4File(path, **options)
+                    results = {}
+
+                    def decode(trak):
+                        try:
+                            stsz = trak.find('mdia/minf/stbl/stsz')
+                            results[trak.offset] = list(
+                                stsz.get_attribute('Sample_size_table'))
+                        except Exception as e:
+                            results[trak.offset] = e
+
+                    threads = [threading.Thread(target=decode, args=(trak,))
+                               for trak in mp4.findall('moov/trak')]
+                    for thread in threads:
+                        thread.start()
+                    for thread in threads:
+                        thread.join()
+                    self.assertEquals([t.sample_sizes for t in tracks],
+                                      [results[k] for k in sorted(results)])
+                    mp4.close()
+        finally:
+            sys.setcheckinterval(interval)
+            os.unlink(path)
+
+    def testPool(self):
+        paths = [self.path] + [write_temp(open(self.path, 'rb').read())
+                               for i in range(4)]
+        try:
+            pool = HandlePool(max_open=2)
+            files = [Mp4File(path, lazy=True, pool=pool) for path in paths]
+            self.assertTrue(len(pool) <= 2)
+            # descriptors are reopened on demand
+            for mp4 in files:
+                stsz = mp4.find('moov/trak/mdia/minf/stbl/stsz')
+                self.assertEquals(
+                    self.track.sample_sizes,
+                    list(stsz.get_attribute('Sample_size_table')))
+                self.assertTrue(len(pool) <= 2)
+            self.assertTrue(pool.opened > 2)
+            for mp4 in files:
+                mp4.close()
+            self.assertEquals(0, len(pool))
+        finally:
+            for path in paths[1:]:
+                os.unlink(path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,319 @@
+'''
+Optional instrumentation of atom parsing.
+
+    stats = Instrumentation()
+    with stats:
+        mp4 = Mp4File(filename)
+    print stats.report()
+
+While an Instrumentation is active, create_atom, the read helpers of the
+atom module (read_block, which fetches the bytes of an atom, and the
+helpers decoding them, such as read_layout and read_table) and the
+attrs and children properties of Atom are replaced
+by wrappers that record, per atom type, the number of atoms created and
+the time spent creating and decoding them.  The files opened by Mp4File
+meanwhile are wrapped too, to count the reads actually issued on them
+and the bytes they return: most read helper calls decode bytes already
+in memory, so helper calls are counted separately.  Memory mapped files
+issue no reads.  Hooks get every atom and every read as it happens, for
+export to other metrics systems.  Nothing is wrapped while no
+Instrumentation is active, so the parser then runs at full speed.
+
+Instrumentation patches the atom module, so it covers every thread and
+only one may be active at a time.
+'''
+import mmap
+import threading
+from timeit import default_timer
+
+import atom as _atom
+import mp4file as _mp4file
+from sources import BlockFile
+
+# read helpers of the atom module that are counted
+READ_FUNCTIONS = ('read_block', 'read_layout', 'read_table', 'read_array',
+                  'read_view', 'read32')
+
+_lock = threading.Lock()
+_active = [None]
+
+
+class TypeStats(object):
+    '''Figures of one atom type.
+
+    seconds excludes the time spent on child atoms; reads and bytes count
+    the file reads made while parsing atoms of the type, helper_calls and
+    helper_bytes the read helper calls: the bytes of a read_block call
+    are those of the block, decoded by the other helpers afterwards.
+    '''
+    __slots__ = ('count', 'seconds', 'reads', 'bytes', 'helper_calls',
+                 'helper_bytes')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.reads = 0
+        self.bytes = 0
+        self.helper_calls = 0
+        self.helper_bytes = 0
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+class CountingFile(object):
+    '''Wrap a file object and count the reads issued on it: read(), and
+    pread() when the file has it.
+
+    reads, bytes and largest count the reads, the bytes they returned and
+    the most returned by one.  When record is true, ranges lists the
+    (offset, size) of every read as well.  Reads are also reported to
+    stats, an Instrumentation, when given.
+    '''
+    def __init__(self, file, stats=None, record=False):
+        self.file = file
+        self._stats = stats
+        self.reads = 0
+        self.bytes = 0
+        self.largest = 0
+        self.ranges = None
+        if record:
+            self.ranges = []
+        if hasattr(file, 'pread'):
+            self.pread = self._pread
+
+    def _count(self, name, offset, size, data):
+        self.reads += 1
+        self.bytes += len(data)
+        self.largest = max(self.largest, len(data))
+        if self.ranges is not None:
+            self.ranges.append((offset, size))
+        if self._stats is not None:
+            self._stats._count_read(name, len(data))
+
+    def read(self, size=-1):
+        offset = None
+        if self.ranges is not None:
+            offset = self.file.tell()
+        data = self.file.read(size)
+        self._count('read', offset, size, data)
+        return data
+
+    def _pread(self, offset, size):
+        data = self.file.pread(offset, size)
+        self._count('pread', offset, size, data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+class CountingSource(object):
+    '''Wrap the byte source of a BlockFile, reporting its range reads to
+    an Instrumentation; reads served by the block cache are not counted.
+    '''
+    def __init__(self, source, stats):
+        self.source = source
+        self._stats = stats
+
+    def read_range(self, offset, length):
+        data = self.source.read_range(offset, length)
+        self._stats._count_read('read_range', len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.source, name)
+
+
+class Instrumentation(object):
+    '''Collects parse figures while active.
+
+    :param atom_hook: called as atom_hook(atom, seconds) after an atom is
+        created or decoded, seconds excluding its children.
+    :param read_hook: called as read_hook(function, type, nbytes) after
+        every file read, with the name of the file method ('read', 'pread'
+        or 'read_range') and the type of the atom being parsed, or None.
+    '''
+    def __init__(self, atom_hook=None, read_hook=None):
+        self.atom_hook = atom_hook
+        self.read_hook = read_hook
+        self.reset()
+
+    def reset(self):
+        '''Clear the figures collected so far.'''
+        # atom type -> TypeStats
+        self.types = {}
+        # file reads and bytes read
+        self.reads = 0
+        self.bytes = 0
+        # read helper name -> [calls, bytes]
+        self.helpers = dict((name, [0, 0]) for name in READ_FUNCTIONS)
+        self._local = threading.local()
+
+    def _stack(self):
+        # per thread stack of [type, child seconds] of the atoms in progress
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _type_stats(self, type):
+        stats = self.types.get(type)
+        if stats is None:
+            stats = self.types[type] = TypeStats()
+        return stats
+
+    def _timed(self, atom_type, function, *args):
+        '''Call function, accounting the time to atom_type.  Returns the
+        result and the exclusive time.
+        '''
+        stack = self._stack()
+        frame = [atom_type, 0.0]
+        stack.append(frame)
+        start = default_timer()
+        try:
+            result = function(*args)
+        finally:
+            elapsed = default_timer() - start
+            stack.pop()
+            if stack:
+                stack[-1][1] += elapsed
+        seconds = elapsed - frame[1]
+        return result, seconds
+
+    def _wrap_create_atom(self, create_atom):
+        def wrapper(size, type, *args, **kwargs):
+            result, seconds = self._timed(
+                type, lambda: create_atom(size, type, *args, **kwargs))
+            stats = self._type_stats(type)
+            stats.count += 1
+            stats.seconds += seconds
+            if self.atom_hook is not None:
+                self.atom_hook(result, seconds)
+            return result
+        return wrapper
+
+    def _wrap_property(self, prop, slot):
+        getter = prop.fget
+
+        def wrapper(atom):
+            if getattr(atom, slot) is not None:
+                return getter(atom)
+            # first access: the atom is decoded now
+            result, seconds = self._timed(atom.type, getter, atom)
+            self._type_stats(atom.type).seconds += seconds
+            if self.atom_hook is not None:
+                self.atom_hook(atom, seconds)
+            return result
+        return property(wrapper, prop.fset)
+
+    def _count_read(self, name, nbytes):
+        self.reads += 1
+        self.bytes += nbytes
+        stack = self._stack()
+        type = stack and stack[-1][0] or None
+        if type is not None:
+            stats = self._type_stats(type)
+            stats.reads += 1
+            stats.bytes += nbytes
+        if self.read_hook is not None:
+            self.read_hook(name, type, nbytes)
+
+    def _wrap_open_file(self, open_file):
+        def wrapper(*args, **kwargs):
+            file = open_file(*args, **kwargs)
+            if isinstance(file, BlockFile):
+                file.source = CountingSource(file.source, self)
+                return file
+            if isinstance(file, mmap.mmap):
+                # no reads to count
+                return file
+            return CountingFile(file, self)
+        return wrapper
+
+    def _wrap_read(self, name, function):
+        figures = self.helpers[name]
+        local = self._local
+
+        def wrapper(file, *args):
+            if getattr(local, 'reading', False):
+                # called from another read helper, counted there
+                return function(file, *args)
+            local.reading = True
+            try:
+                if name == 'read_block':
+                    # positions the file, or a new window, at the block
+                    result = function(file, *args)
+                    nbytes = args[1] or 0
+                else:
+                    start = file.tell()
+                    result = function(file, *args)
+                    nbytes = file.tell() - start
+            finally:
+                local.reading = False
+            figures[0] += 1
+            figures[1] += nbytes
+            stack = self._stack()
+            type = stack and stack[-1][0] or None
+            if type is not None:
+                stats = self._type_stats(type)
+                stats.helper_calls += 1
+                stats.helper_bytes += nbytes
+            return result
+        return wrapper
+
+    def start(self):
+        '''Install the wrappers.  Raises RuntimeError if an
+        Instrumentation is already active.
+        '''
+        _lock.acquire()
+        try:
+            if _active[0] is not None:
+                raise RuntimeError('instrumentation is already active')
+            _active[0] = self
+        finally:
+            _lock.release()
+        self._saved = {}
+        for name in READ_FUNCTIONS + ('create_atom',):
+            self._saved[name] = getattr(_atom, name)
+        for name in ('attrs', 'children'):
+            self._saved[name] = _atom.Atom.__dict__[name]
+        self._saved['open_file'] = _mp4file.open_file
+        _mp4file.open_file = self._wrap_open_file(self._saved['open_file'])
+        _atom.create_atom = self._wrap_create_atom(self._saved['create_atom'])
+        for name in READ_FUNCTIONS:
+            setattr(_atom, name, self._wrap_read(name, self._saved[name]))
+        _atom.Atom.attrs = self._wrap_property(self._saved['attrs'], '_attrs')
+        _atom.Atom.children = self._wrap_property(self._saved['children'],
+                                                  '_children')
+
+    def stop(self):
+        '''Restore the original functions.'''
+        for name in READ_FUNCTIONS + ('create_atom',):
+            setattr(_atom, name, self._saved[name])
+        for name in ('attrs', 'children'):
+            setattr(_atom.Atom, name, self._saved[name])
+        _mp4file.open_file = self._saved['open_file']
+        _active[0] = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def report(self):
+        '''Return the figures as a dict of plain values: 'types' maps atom
+        types to their TypeStats as dicts, 'io' holds the number of file
+        reads and the bytes they returned, 'helpers' maps read helpers to
+        their calls and bytes.
+        '''
+        return {
+            'types': dict((type, stats.as_dict())
+                          for type, stats in self.types.iteritems()),
+            'io': {'reads': self.reads, 'bytes': self.bytes},
+            'helpers': dict((name, {'calls': calls, 'bytes': nbytes})
+                            for name, (calls, nbytes) in
+                            self.helpers.iteritems()),
+        }
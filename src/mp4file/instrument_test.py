@@ -0,0 +1,114 @@
+'''
+Tests for the parse instrumentation.
+'''
+import os
+import unittest
+
+import atom
+from instrument import Instrumentation
+from mp4file import Mp4File
+from testutil import build_movie, write_temp
+
+
+def decode(atom):
+    for child in atom.children:
+        child.attrs
+        decode(child)
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.path = write_temp(build_movie())
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def testEager(self):
+        atoms = []
+        reads = []
+        stats = Instrumentation(lambda a, seconds: atoms.append(a.type),
+                                lambda name, type, n: reads.append(name))
+        with stats:
+            mp4 = Mp4File(self.path)
+        report = stats.report()
+        self.assertEquals(1, report['types']['stsz']['count'])
+        self.assertEquals(1, report['types']['moov']['count'])
+        # the block of the atom, then its sample size, entry count and
+        # the 10 sizes, decoded from memory
+        self.assertEquals(4, report['types']['stsz']['helper_calls'])
+        self.assertEquals(48 + 8 + 40,
+                          report['types']['stsz']['helper_bytes'])
+        self.assertEquals(0, report['types']['stsz']['reads'])
+        self.assertTrue(report['types']['moov']['seconds'] >= 0)
+        self.assertTrue(report['helpers']['read32']['calls'] > 0)
+        self.assertEquals(report['types']['trak']['count'],
+                          atoms.count('trak'))
+        # the file reads: a header per top level atom, the payload of
+        # ftyp and all of moov
+        size = os.path.getsize(self.path)
+        moov = mp4.find('moov')
+        self.assertEquals(5, report['io']['reads'])
+        self.assertEquals(len(reads), report['io']['reads'])
+        self.assertEquals(1, report['types']['moov']['reads'])
+        self.assertEquals(moov.size - 8, report['types']['moov']['bytes'])
+        self.assertTrue(report['io']['bytes'] < size)
+        mp4.close()
+
+    def testHelpersCounted(self):
+        for options in ({}, {'lazy': True}, {'use_mmap': True}):
+            with Instrumentation() as stats:
+                mp4 = Mp4File(self.path, **options)
+                decode(mp4)
+                mp4.close()
+            helpers = stats.report()['helpers']
+            for name in ('read_block', 'read_layout', 'read_table'):
+                self.assertTrue(helpers[name]['calls'] > 0, name)
+                self.assertTrue(helpers[name]['bytes'] > 0, name)
+
+    def testReadsCounted(self):
+        # reads issued after opening go through the wrapped file
+        with Instrumentation() as stats:
+            mp4 = Mp4File(self.path, lazy=True)
+            mdat = mp4.find('mdat')
+            reads, nbytes = stats.reads, stats.bytes
+            data = mdat.read_data()
+        self.assertEquals(reads + 1, stats.reads)
+        self.assertEquals(nbytes + len(data), stats.bytes)
+        mp4.close()
+
+    def testNestedReads(self):
+        with Instrumentation() as stats:
+            Mp4File(self.path, arrays=True)
+        report = stats.report()
+        self.assertTrue(report['helpers']['read_array']['calls'] > 0)
+        # read_array reads through read_view, counted once
+        self.assertEquals(4, report['types']['stsz']['helper_calls'])
+        self.assertEquals(48 + 8 + 40,
+                          report['types']['stsz']['helper_bytes'])
+
+    def testLazyDecode(self):
+        mp4 = Mp4File(self.path, lazy=True)
+        with Instrumentation() as stats:
+            mp4.find('moov/trak/mdia/minf/stbl/stco').attrs
+        types = stats.report()['types']
+        self.assertEquals(1, types['stco']['count'])
+        self.assertEquals(3, types['stco']['helper_calls'])
+        # the payload of mdat is never read
+        self.assertEquals(0, types['mdat']['reads'])
+        self.assertEquals(0, types['mdat']['helper_calls'])
+
+    def testOffRestores(self):
+        create_atom = atom.create_atom
+        attrs = atom.Atom.__dict__['attrs']
+        stats = Instrumentation()
+        with stats:
+            self.assertNotEquals(create_atom, atom.create_atom)
+            self.assertRaises(RuntimeError, Instrumentation().start)
+        self.assertEquals(create_atom, atom.create_atom)
+        self.assertTrue(atom.Atom.__dict__['attrs'] is attrs)
+        Mp4File(self.path)
+        self.assertEquals({}, stats.report()['types'])
+
+
+if __name__ == "__main__":
+    unittest.main()
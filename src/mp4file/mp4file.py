@@ -8,12 +8,24 @@ Created on Dec 6, 2009
 
 # built-in modules
 import logging
+import mmap
+import os
 
 # definitions
 from defs import *
 
 # local modules
-from atom import parse_atoms, Atom
+from atom import parse_atom, parse_atoms, complete_end, Atom
+from demux import BATCH_SIZE, iter_samples, read_samples
+from faststart import write_faststart
+from fragments import FragmentIndex, read_mfra
+from handles import SharedFile
+from sampleindex import SampleIndex
+from segment import DURATION, Segmenter
+from selection import as_selection
+from sources import BLOCK_SIZE, CACHE_BLOCKS, READ_AHEAD, BlockFile, \
+     is_remote, open_source
+from transfer import BUFFER_SIZE, Copier
 
 
 log = logging.getLogger("mp4file")
@@ -26,16 +38,272 @@ def getFileSize(file):
     return endFile
 
 
+def open_file(filename, use_mmap=False, pool=None, block_size=BLOCK_SIZE,
+              cache_blocks=CACHE_BLOCKS, read_ahead=READ_AHEAD):
+    '''Return the file object an Mp4File reads filename through, see
+    Mp4File.
+    '''
+    if is_remote(filename):
+        return BlockFile(open_source(filename), block_size, cache_blocks,
+                         read_ahead)
+    if use_mmap:
+        f = open(filename, "rb")
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+    if pool is not None:
+        return pool.open(filename)
+    return SharedFile(filename)
+
+
 class Mp4File(Atom):
-    def __init__(self, filename):
-        file = open(filename, "rb")
-        Atom.__init__(self, getFileSize(file), '', '', 0, file)
-        self._set_children(parse_atoms(file, getFileSize(file)))
+    def __init__(self, filename, lazy=False, use_mmap=False, arrays=False,
+                 cache=None, pool=None, select=None, block_size=BLOCK_SIZE,
+                 cache_blocks=CACHE_BLOCKS, read_ahead=READ_AHEAD):
+        '''Open and parse an mp4 file.
+
+        :param filename: path of the file to open, an http(s) URL or a
+            byte source (see sources), read through a sources.BlockFile.
+        :param lazy: when true, atoms are parsed on demand: a container's
+            children are read the first time `children` is accessed, and
+            `attrs` are decoded the first time they are read.
+        :param use_mmap: when true, the file is memory mapped.  Payloads
+            (`read_data`, cover art, pssh content) are then returned as
+            zero-copy views of the mapping and tables are decoded in place.
+        :param arrays: when true, the sample tables (stsz, stco, co64,
+            stts, ctts, stsc, stss) are decoded into numpy arrays, or
+            array.array when numpy is not installed, instead of tuples.
+        :param cache: a cache.TreeCache.  The tree is loaded from it when
+            the file has not changed since it was stored; otherwise the
+            whole tree is parsed and stored, unless select is given.
+            Failing to store the tree is logged, not raised.  Not used for
+            URLs and byte sources.
+        :param pool: a handles.HandlePool the local file is read through,
+            to bound the descriptors held by many open files.
+        :param select: a selection.Selection, or find paths of the atoms
+            to decode, e.g. ['moov/udta/meta/ilst'].  The file is then
+            parsed lazily and only the selected atoms, with their
+            descendants, are decoded on opening; the containers not on
+            the way to them are not read.
+        :param block_size: size of the blocks URLs and byte sources are
+            fetched and cached by, see sources.BlockFile.
+        :param cache_blocks: number of blocks kept in the cache.
+        :param read_ahead: number of blocks fetched after a missing block.
+
+        Local files are read with positional reads (see handles), so that
+        threads may share the tree.  close() releases the file; an Mp4File
+        is also a context manager closing it on exit.
+        '''
+        self.filename = filename
+        self._cache = cache
+        if is_remote(filename):
+            self._cache = None
+        # storing decodes the whole tree
+        self._store_tree = select is None
+        file = open_file(filename, use_mmap, pool, block_size, cache_blocks,
+                         read_ahead)
+        if select is not None:
+            lazy = True
+        try:
+            Atom.__init__(self, getFileSize(file), '', '', 0, file, lazy,
+                          arrays)
+            self._sample_indexes = None
+            self._fragment_index = None
+            # end of the complete top level atoms, see refresh
+            self._complete_end = None
+            # mappings replaced by refresh, still read by the atoms parsed
+            # before; closed with the file
+            self._old_files = []
+            if select is not None:
+                as_selection(select).apply(self)
+        except:
+            # nothing holds the file to close it later
+            file.close()
+            raise
+
+    def _parse_children(self, file):
+        if self._cache is not None:
+            children = self._cache.load(self.filename, file, self.lazy,
+                                        self.arrays)
+            if children is not None:
+                return children
+        file.seek(0, SEEK_SET)
+        children = parse_atoms(file, self.size, self.lazy, self.arrays)
+        if self._cache is not None and self._store_tree:
+            try:
+                self._cache.store(self.filename, children, self.arrays)
+            except (OSError, IOError, ValueError) as e:
+                # the file parsed, the cache is only an optimization
+                log.warning('cannot store the tree of %s in the cache: %s',
+                            self.filename, e)
+        return children
+
+    def refresh(self):
+        '''Parse the top level atoms appended since the file was opened
+        or last refreshed, for files that are still being written, such
+        as fragmented recordings.
+
+        Parsing resumes after the last complete top level atom, so the
+        cost depends on the new data only.  A trailing atom cut short, or
+        running to the end of the file, is parsed again on the next
+        refresh.  Returns the list of atoms parsed.
+        '''
+        file = self.file
+        if isinstance(file, mmap.mmap) and \
+                os.path.getsize(self.filename) != len(file):
+            # map the file again at its new size; the atoms parsed so far
+            # keep the old mapping
+            self._old_files.append(file)
+            file = self.file = open_file(self.filename, True)
+        refresh = getattr(file, 'refresh', None)
+        if refresh is not None:
+            refresh()
+        children = self.children
+        if self._complete_end is None:
+            self._complete_end = complete_end(children, 0, self.size)
+        start = self._complete_end
+        size = getFileSize(file)
+        kept = [atom for atom in children if atom.offset < start]
+        file.seek(start, SEEK_SET)
+        atoms = parse_atoms(file, size, self.lazy, self.arrays)
+        self.size = size
+        self._set_children(kept + atoms)
+        self._complete_end = complete_end(atoms, start, size)
+        # built from the old tree
+        self._index = None
+        self._sample_indexes = None
+        self._fragment_index = None
+        return atoms
+
+    def is_truncated(self):
+        '''Return whether the last top level atom is cut short by the end
+        of the file.
+        '''
+        children = self.children
+        if not children:
+            return False
+        last = children[-1]
+        size = last.get_actual_size()
+        return size is not None and last.offset + size > self.size
+
+    def close(self):
+        '''Close the file.  Atoms not decoded yet can no longer be read.'''
+        self.file.close()
+        for file in self._old_files:
+            file.close()
+        self._old_files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @classmethod
+    def open_async(cls, filename, loop=None, executor=None, **kwargs):
+        '''Return a future of an aio.AsyncMp4File of the file, opened
+        without blocking the event loop; see aio.open_async.
+        '''
+        # aio imports this module
+        from aio import open_async
+        return open_async(filename, loop, executor, **kwargs)
+
+    def get_sample_indexes(self):
+        '''Return the SampleIndex of every track, in file order.  They
+        are built on the first call and kept for later ones.
+        '''
+        if self._sample_indexes is None:
+            self._sample_indexes = [SampleIndex(trak)
+                                    for trak in self.findall('moov/trak')]
+        return self._sample_indexes
 
-    def write(self, stream):
-        '''Write out the box into the given stream.
+    def get_sample_index(self, track_id):
+        '''Return the SampleIndex of the track with the given ID, or None.
+        '''
+        for index in self.get_sample_indexes():
+            if index.track_id == track_id:
+                return index
+        return None
+
+    def _indexes(self, track_ids):
+        indexes = self.get_sample_indexes()
+        if track_ids is None:
+            return indexes
+        return [index for index in indexes if index.track_id in track_ids]
+
+    def iter_samples(self, track_ids=None):
+        '''Yield a demux.Sample, (track_id, sample_index, dts, offset,
+        size, is_sync), for every sample of the tracks, in file offset
+        order.
+
+        :param track_ids: the IDs of the tracks, all of them by default.
+        '''
+        return iter_samples(self._indexes(track_ids))
+
+    def iter_sample_data(self, track_ids=None, batch_size=BATCH_SIZE):
+        '''Yield (sample, data) for every sample of the tracks, in file
+        offset order.  The media data is read forward in batches of up to
+        batch_size bytes; see demux.read_samples.
+        '''
+        return read_samples(self.file, self.iter_samples(track_ids),
+                            batch_size)
+
+    def get_fragment_index(self):
+        '''Return the FragmentIndex read from the mfra atom closing the
+        file, or None if the file has none.  The top level atoms are not
+        walked, so this is cheap on files opened with lazy=True.
+        '''
+        if self._fragment_index is None:
+            mfra = read_mfra(self.file, self.size, self.lazy, self.arrays)
+            if mfra is None:
+                return None
+            self._fragment_index = FragmentIndex(mfra)
+        return self._fragment_index
+
+    def find_fragment(self, track_id, time):
+        '''Return the moof atom of the last random access point of the
+        track at or before time (in media ticks), or None.
+
+        The moof is parsed straight from its offset in the mfra; it is not
+        attached to this tree.
+        '''
+        index = self.get_fragment_index()
+        if index is None:
+            return None
+        offset = index.lookup(track_id, time)
+        if offset is None:
+            return None
+        self.file.seek(offset, SEEK_SET)
+        return parse_atom(self.file, self.lazy, self.arrays)
+
+    def write(self, stream, copier=None, buffer_size=BUFFER_SIZE):
+        '''Write out the file into the given stream.
+
+        Payloads are copied buffer_size bytes at a time, by the kernel when
+        both the file and the stream are regular files and the platform
+        supports it.
 
         :param stream: a writable stream object.
+        :param copier: the transfer.Copier to use instead of a new one.
+        :return: the copier; its bytes_copied counts the payload bytes.
         '''
+        if copier is None:
+            copier = Copier(buffer_size)
         for atom in self.children:
-            atom.write(stream)
+            atom.write(stream, copier)
+        return copier
+
+    def write_faststart(self, stream, copier=None, buffer_size=BUFFER_SIZE):
+        '''Write out the file with moov moved in front of the media data,
+        see faststart.write_faststart.
+        '''
+        return write_faststart(self, stream, copier, buffer_size)
+
+    def write_fragmented(self, stream, duration=DURATION, track_ids=None):
+        '''Write out the file fragmented into segments of about duration
+        seconds, see segment.Segmenter.
+        '''
+        segmenter = Segmenter(self, duration, track_ids)
+        segmenter.write(stream)
+        return segmenter
@@ -0,0 +1,294 @@
+'''
+Tests for Mp4File against synthetic files.
+'''
+import os
+import unittest
+from StringIO import StringIO
+
+import mp4file
+from atom import Payload
+from mp4file import Mp4File
+from testutil import break_stsz, build_fragmented, build_movie, \
+     open_counting, write_temp
+from transfer import Copier
+
+
+def dump(atom):
+    return [(plain(a.attrs), a.type, a.name, a.offset, a.size, dump(a))
+            for a in atom.get_atoms()]
+
+
+def plain(attrs):
+    '''Return attrs, with payloads replaced by their bytes.'''
+    attrs = dict(attrs)
+    for key, value in attrs.iteritems():
+        if isinstance(value, Payload):
+            attrs[key] = str(value)
+    return attrs
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.path = write_temp(build_movie())
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def testEager(self):
+        mp4 = Mp4File(self.path)
+        self.assertEquals(['ftyp', 'moov', 'mdat'],
+                          [a.type for a in mp4.get_atoms()])
+        self.assertEquals('isom',
+                          mp4.find('ftyp').get_attribute('Major_Brand'))
+        self.assertEquals(u'Test title',
+                          mp4.find('.//title/data').get_attribute('data'))
+
+    def testHeaders(self):
+        mp4 = Mp4File(self.path)
+        mvhd = mp4.find('moov/mvhd')
+        self.assertEquals(1000, mvhd.get_attribute('Time scale'))
+        self.assertEquals(1000, mvhd.get_attribute('Duration'))
+        self.assertEquals(0x10000, mvhd.get_attribute('Preferred rate'))
+        self.assertEquals(2, mvhd.get_attribute('Next track ID'))
+        self.assertEquals('Fri, 01 Jan 1904 00:00:00 GMT',
+                          mvhd.get_attribute('Creation time'))
+        tkhd = mp4.find('moov/trak/tkhd')
+        self.assertEquals(1, tkhd.get_attribute('Track ID'))
+        self.assertEquals(320 << 16, tkhd.get_attribute('Track width'))
+        self.assertEquals(0x40000000,
+                          tkhd.get_attribute('Matrix structure')['w'])
+        self.assertEquals(0x55c4,
+                          mp4.find('.//mdhd').get_attribute('Language'))
+        # 'vide'
+        self.assertEquals(0x76696465, mp4.find('.//hdlr')
+                          .get_attribute('Component subtype'))
+
+    def testSampleTables(self):
+        mp4 = Mp4File(self.path)
+        stbl = mp4.find('.//stbl')
+        self.assertEquals(tuple(range(16, 26)),
+                          stbl.find('stsz').get_attribute('Sample_size_table'))
+        self.assertEquals((10, 100), stbl.find('stts')
+                          .get_attribute('Time_to_sample_table'))
+        self.assertEquals((1, 2, 1), stbl.find('stsc')
+                          .get_attribute('Sample_to_chunk_table'))
+        self.assertEquals((1, 4, 7, 10),
+                          stbl.find('stss').get_attribute('Sync_sample_table'))
+
+    def testArrays(self):
+        plain = Mp4File(self.path)
+        for mp4 in (Mp4File(self.path, arrays=True),
+                    Mp4File(self.path, use_mmap=True, arrays=True)):
+            for type in ('stsz', 'stco', 'stts', 'stsc', 'stss'):
+                atom = mp4.find('.//' + type)
+                for key, value in plain.find('.//' + type).attrs.items():
+                    got = atom.get_attribute(key)
+                    if isinstance(value, tuple):
+                        self.assertFalse(isinstance(got, tuple))
+                        got = tuple(got)
+                    self.assertEquals(value, got)
+
+    def testLazyMatchesEager(self):
+        self.assertEquals(dump(Mp4File(self.path)),
+                          dump(Mp4File(self.path, lazy=True)))
+        # an atom that cannot be decoded has no attrs either way
+        path = write_temp(break_stsz(open(self.path, 'rb').read()))
+        try:
+            eager = Mp4File(path)
+            self.assertEquals({}, eager.find('.//stsz').attrs)
+            for lazy in (Mp4File(path, lazy=True),
+                         Mp4File(path, lazy=True, use_mmap=True)):
+                self.assertEquals({}, lazy.find('.//stsz').attrs)
+                self.assertEquals(dump(eager), dump(lazy))
+                lazy.close()
+            eager.close()
+        finally:
+            os.unlink(path)
+
+    def testFailedOpenCloses(self):
+        opened = []
+        open_file = mp4file.open_file
+        parse_atoms = mp4file.parse_atoms
+
+        def tracked(*args):
+            opened.append(open_file(*args))
+            return opened[-1]
+
+        def fail(*args):
+            raise IOError('cannot parse')
+
+        mp4file.open_file = tracked
+        mp4file.parse_atoms = fail
+        try:
+            self.assertRaises(IOError, Mp4File, self.path, use_mmap=True)
+        finally:
+            mp4file.open_file = open_file
+            mp4file.parse_atoms = parse_atoms
+        self.assertRaises(ValueError, opened[0].__getitem__, 0)
+
+    def testLazyReadsOnDemand(self):
+        mp4, counter = open_counting(self.path, lazy=True)
+        self.assertEquals(0, counter.reads)
+        moov = mp4.find('moov')
+        top = counter.reads
+        self.assertTrue(top > 0)
+        self.assertEquals(None, moov._children)
+        self.assertEquals(None, mp4.find('ftyp')._attrs)
+        mp4.find('ftyp').get_attribute('Major_Brand')
+        self.assertTrue(counter.reads > top)
+
+    def testCoalescedReads(self):
+        mp4, counter = open_counting(self.path, lazy=True)
+        atoms = dump(mp4)
+        self.assertEquals(dump(Mp4File(self.path)), atoms)
+
+        def count(atoms):
+            return sum(1 + count(children)
+                       for _, _, _, _, _, children in atoms)
+        # a read per top level header, one for the payload of ftyp and
+        # one for all of moov
+        self.assertEquals(30, count(atoms))
+        self.assertEquals(5, counter.reads)
+
+    def testMmap(self):
+        plain = Mp4File(self.path)
+        mapped = Mp4File(self.path, use_mmap=True)
+        self.assertEquals([a.type for a in plain.get_atoms()],
+                          [a.type for a in mapped.get_atoms()])
+        self.assertEquals(plain.find('.//stco').attrs,
+                          mapped.find('.//stco').attrs)
+        self.assertEquals(u'Test title',
+                          mapped.find('.//title/data').get_attribute('data'))
+        art = mapped.find('.//coverart/data').get_attribute('data').read()
+        self.assertFalse(isinstance(art, str))
+        self.assertEquals(
+            plain.find('.//coverart/data').get_attribute('data').read(),
+            art[:])
+        mdat = mapped.find('mdat')
+        self.assertEquals(plain.find('mdat').read_data(), mdat.read_data()[:])
+
+        out = StringIO()
+        mdat.write(out)
+        self.assertEquals(plain.find('mdat').read_data(), out.getvalue())
+
+    def testCompact(self):
+        mp4 = Mp4File(self.path)
+        atoms = mp4.findall('.//*')
+        self.assertTrue(atoms)
+        for atom in atoms:
+            self.assertFalse(hasattr(atom, '__dict__'), atom.type)
+        mdat = mp4.find('mdat')
+        moov = mp4.find('moov')
+        self.assertTrue(mdat.children is mp4.find('ftyp').children)
+        self.assertTrue(mdat.attrs is moov.attrs)
+        self.assertRaises(TypeError, moov.attrs.update, {'a': 1})
+        moov._set_attr('a', 1)
+        self.assertEquals({'a': 1}, moov.attrs)
+        self.assertEquals({}, mdat.attrs)
+
+    def testCoverArt(self):
+        art = '\xff\xd8\xff\xe0' + os.urandom(300000)
+        path = write_temp(build_movie(tags=[('covr', art)]))
+        try:
+            mp4, counter = open_counting(path, lazy=True)
+            data = mp4.find('moov/udta/meta/ilst/covr/data')
+            counter.largest = 0
+            payload = data.get_attribute('data')
+            # recorded, not read
+            self.assertEquals(13, data.get_attribute('data_type'))
+            self.assertEquals(len(art), len(payload))
+            self.assertTrue(counter.largest < 100)
+            self.assertEquals(art, payload.read())
+            reader = payload.open()
+            reader.seek(100)
+            self.assertEquals(art[100:200], reader.read(100))
+            self.assertEquals(art[200:], reader.read())
+            out = StringIO()
+            payload.write(out)
+            self.assertEquals(art, out.getvalue())
+            mp4.close()
+        finally:
+            os.unlink(path)
+
+    def testRefresh(self):
+        data = build_fragmented(samples_per_fragment=2, mfra=False)
+        full = Mp4File(write_temp(data))
+        os.unlink(full.filename)
+        offsets = [a.offset for a in full.get_atoms()]
+        # ftyp, moov, the first pair and half of the second moof
+        cut = (offsets[4] + offsets[5]) // 2
+        path = write_temp(data[:cut])
+        try:
+            for options in ({}, {'lazy': True}, {'use_mmap': True}):
+                open(path, 'wb').write(data[:cut])
+                mp4 = Mp4File(path, **options)
+                self.assertTrue(mp4.is_truncated())
+                self.assertEquals(offsets[:5],
+                                  [a.offset for a in mp4.get_atoms()])
+                # nothing new
+                self.assertEquals(offsets[4:5],
+                                  [a.offset for a in mp4.refresh()])
+                f = open(path, 'ab')
+                f.write(data[cut:offsets[7] + 3])
+                f.close()
+                # the truncated moof is parsed again, not the partial header
+                self.assertEquals(offsets[4:7],
+                                  [a.offset for a in mp4.refresh()])
+                f = open(path, 'ab')
+                f.write(data[offsets[7] + 3:])
+                f.close()
+                self.assertEquals(offsets[7:],
+                                  [a.offset for a in mp4.refresh()])
+                self.assertFalse(mp4.is_truncated())
+                self.assertEquals(dump(full), dump(mp4))
+                mappings = [mp4.file] + mp4._old_files
+                if options.get('use_mmap'):
+                    # one mapping per growth of the file
+                    self.assertEquals(3, len(mappings))
+                mp4.close()
+                for mapping in mappings[1:]:
+                    self.assertRaises(ValueError, mapping.__getitem__, 0)
+        finally:
+            os.unlink(path)
+
+    def testOpenEnded(self):
+        # an mdat running to the end of the file, and a truncated header
+        data = open(self.path, 'rb').read()
+        moov = Mp4File(self.path).find('moov')
+        end = moov.offset + moov.size
+        path = write_temp(data[:end] + '\0\0\0\0mdat' + 'x' * 100)
+        try:
+            mp4 = Mp4File(path)
+            self.assertEquals(['ftyp', 'moov', 'mdat'],
+                              [a.type for a in mp4.get_atoms()])
+            self.assertFalse(mp4.is_truncated())
+            open(path, 'wb').write(data[:end] + '\0\0')
+            self.assertEquals(['ftyp', 'moov'],
+                              [a.type for a in Mp4File(path).get_atoms()])
+        finally:
+            os.unlink(path)
+
+    def testWriteChunked(self):
+        data = build_movie()
+        path = write_temp(data)
+        try:
+            mp4, counter = open_counting(path, lazy=True)
+            # small containers are read at once while parsing
+            mp4.write(StringIO())
+            counter.reads = counter.largest = 0
+            out = StringIO()
+            copier = mp4.write(out, Copier(64, use_kernel=False))
+            self.assertEquals(data, out.getvalue())
+            self.assertTrue(counter.reads > mp4.find('mdat').size / 64)
+            self.assertEquals(64, counter.largest)
+            self.assertTrue(copier.bytes_copied > mp4.find('mdat').size - 8)
+
+            out = StringIO()
+            Mp4File(path, use_mmap=True).write(out, buffer_size=64)
+            self.assertEquals(data, out.getvalue())
+        finally:
+            os.unlink(path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,190 @@
+'''
+Per track sample index: maps presentation times to samples, chunks and
+byte offsets.
+
+Samples and chunks are numbered from 0 here, while the tables of the
+file number them from 1.  Times are in media ticks of the track
+(see `timescale`) unless stated otherwise.  Edit lists are not applied.
+'''
+import array
+from bisect import bisect_right
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from atom import ARRAY_TYPECODES
+
+
+def _prefix_sums(values, arrays):
+    '''Return the len(values) + 1 cumulative sums of values, from 0.
+
+    When arrays is true, this is a numpy array of 64 bit integers, summed
+    by numpy, or an array.array when numpy is not installed; a list
+    otherwise.
+    '''
+    count = len(values)
+    if arrays and numpy is not None:
+        sums = numpy.zeros(count + 1, dtype=numpy.int64)
+        numpy.cumsum(values, dtype=numpy.int64, out=sums[1:])
+        return sums
+    typecode = ARRAY_TYPECODES['Q']
+    if arrays and typecode is not None:
+        sums = array.array(typecode, [0]) * (count + 1)
+    else:
+        sums = [0] * (count + 1)
+    total = 0
+    for i in xrange(count):
+        total += int(values[i])
+        sums[i + 1] = total
+    return sums
+
+
+class SampleIndex(object):
+    '''Index of the samples of one trak atom.
+
+    The index is built once from the stts, stsc, stco (or co64), stsz and
+    stss tables using cumulative sums; every lookup is then O(log n).
+    When the tables were decoded into arrays (see Mp4File), the index is
+    made of arrays too, built by numpy when it is installed.
+    '''
+    def __init__(self, trak):
+        self.track_id = trak.find('tkhd').get_attribute('Track ID')
+        self.timescale = trak.find('mdia/mdhd').get_attribute('Time scale')
+        stbl = trak.find('mdia/minf/stbl')
+
+        # sample sizes, and the file position of each sample relative to
+        # the first one: sample_pos[i + 1] - sample_pos[i] is its size
+        arrays = trak.arrays
+        use_numpy = arrays and numpy is not None
+        stsz = stbl.find('stsz')
+        self.sample_count = count = stsz.get_attribute('Number_of_entries')
+        sample_size = stsz.get_attribute('Sample_size')
+        if sample_size and use_numpy:
+            self.sample_pos = numpy.arange(count + 1,
+                                           dtype=numpy.int64) * sample_size
+        else:
+            if sample_size:
+                sizes = [sample_size] * count
+            else:
+                sizes = stsz.get_attribute('Sample_size_table')
+            self.sample_pos = _prefix_sums(sizes, arrays)
+
+        # time-to-sample runs
+        self.run_sample = []
+        self.run_time = []
+        self.run_delta = []
+        table = stbl.find('stts').get_attribute('Time_to_sample_table')
+        sample = time = 0
+        for i in xrange(0, len(table), 2):
+            run_count, delta = int(table[i]), int(table[i + 1])
+            self.run_sample.append(sample)
+            self.run_time.append(time)
+            self.run_delta.append(delta)
+            sample += run_count
+            time += run_count * delta
+        self.duration = time
+
+        # first sample of every chunk, and one past the last chunk
+        chunk_offsets = stbl.find('stco')
+        if chunk_offsets is None:
+            chunk_offsets = stbl.find('co64')
+        table = chunk_offsets.get_attribute('Chunk_offset_table')
+        if use_numpy:
+            self.chunk_offset = table.astype(numpy.int64)
+        elif arrays:
+            self.chunk_offset = table
+        else:
+            self.chunk_offset = [int(o) for o in table]
+        chunk_count = len(self.chunk_offset)
+        # samples per chunk, set a run of chunks at a time
+        if use_numpy:
+            per_chunk = numpy.zeros(chunk_count, dtype=numpy.int64)
+        else:
+            per_chunk = [0] * chunk_count
+        table = stbl.find('stsc').get_attribute('Sample_to_chunk_table')
+        entries = [(int(table[i]) - 1, int(table[i + 1]))
+                   for i in xrange(0, len(table), 3)]
+        for i, (first, samples) in enumerate(entries):
+            if i + 1 < len(entries):
+                last = min(entries[i + 1][0], chunk_count)
+            else:
+                last = chunk_count
+            if first >= last:
+                continue
+            if use_numpy:
+                per_chunk[first:last] = samples
+            else:
+                per_chunk[first:last] = [samples] * (last - first)
+        self.chunk_sample = _prefix_sums(per_chunk, arrays)
+
+        # sync samples; every sample is a sync sample without stss
+        stss = stbl.find('stss')
+        if stss is None:
+            self.sync = None
+        else:
+            table = stss.get_attribute('Sync_sample_table')
+            if use_numpy:
+                self.sync = table.astype(numpy.int64) - 1
+            elif arrays:
+                self.sync = array.array(table.typecode,
+                                        [s - 1 for s in table])
+            else:
+                self.sync = [int(s) - 1 for s in table]
+
+    def time_to_sample(self, time):
+        '''Return the sample presented at the given time.'''
+        if time <= 0 or not self.sample_count:
+            return 0
+        run = bisect_right(self.run_time, time) - 1
+        delta = self.run_delta[run]
+        sample = self.run_sample[run]
+        if delta:
+            sample += (time - self.run_time[run]) // delta
+        if run + 1 < len(self.run_sample):
+            sample = min(sample, self.run_sample[run + 1] - 1)
+        return min(int(sample), self.sample_count - 1)
+
+    def sample_time(self, sample):
+        '''Return the decoding time of a sample.'''
+        run = bisect_right(self.run_sample, sample) - 1
+        return int(self.run_time[run] +
+                   (sample - self.run_sample[run]) * self.run_delta[run])
+
+    def sample_chunk(self, sample):
+        '''Return the chunk holding a sample.'''
+        return bisect_right(self.chunk_sample, sample) - 1
+
+    def sample_size(self, sample):
+        return int(self.sample_pos[sample + 1] - self.sample_pos[sample])
+
+    def sample_offset(self, sample):
+        '''Return the absolute file offset of a sample.'''
+        chunk = self.sample_chunk(sample)
+        first = self.chunk_sample[chunk]
+        return int(self.chunk_offset[chunk] +
+                   self.sample_pos[sample] - self.sample_pos[first])
+
+    def is_sync(self, sample):
+        if self.sync is None:
+            return True
+        i = bisect_right(self.sync, sample) - 1
+        return i >= 0 and self.sync[i] == sample
+
+    def sync_sample_before(self, sample):
+        '''Return the nearest sync sample at or before a sample, or the
+        first sync sample if there is none before it.
+        '''
+        if self.sync is None:
+            return sample
+        i = bisect_right(self.sync, sample) - 1
+        return int(self.sync[max(i, 0)])
+
+    def seek(self, seconds):
+        '''Return (sample, chunk, offset) of the nearest sync sample at or
+        before a presentation time given in seconds.
+        '''
+        sample = self.time_to_sample(int(seconds * self.timescale))
+        sample = self.sync_sample_before(sample)
+        return (sample, self.sample_chunk(sample), self.sample_offset(sample))
@@ -0,0 +1,71 @@
+'''
+Tests for the per track sample index.
+'''
+import os
+import unittest
+
+from mp4file import Mp4File
+from testutil import Track, build_movie, write_temp
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.tracks = [Track(1, sample_sizes=range(10, 21), delta=100,
+                             samples_per_chunk=3, sync_every=4),
+                       Track(2, sample_sizes=[7] * 8, delta=250,
+                             samples_per_chunk=2, timescale=2000)]
+        self.path = write_temp(build_movie(self.tracks))
+        self.data = open(self.path, 'rb').read()
+        self.mp4 = Mp4File(self.path)
+
+    def tearDown(self):
+        self.mp4.close()
+        os.unlink(self.path)
+
+    def testOffsets(self):
+        for track in self.tracks:
+            index = self.mp4.get_sample_index(track.track_id)
+            self.assertEquals(len(track.sample_sizes), index.sample_count)
+            for sample in range(index.sample_count):
+                offset = index.sample_offset(sample)
+                size = index.sample_size(sample)
+                self.assertEquals(track.sample_data(sample),
+                                  self.data[offset:offset + size])
+
+    def testTimes(self):
+        index = self.mp4.get_sample_index(1)
+        self.assertEquals(1100, index.duration)
+        self.assertEquals(0, index.time_to_sample(0))
+        self.assertEquals(0, index.time_to_sample(99))
+        self.assertEquals(1, index.time_to_sample(100))
+        self.assertEquals(10, index.time_to_sample(10 ** 6))
+        self.assertEquals(500, index.sample_time(5))
+        self.assertEquals(1, index.sample_chunk(5))
+
+    def testSeek(self):
+        index = self.mp4.get_sample_index(1)
+        self.assertTrue(index.is_sync(4))
+        self.assertFalse(index.is_sync(5))
+        self.assertEquals(4, index.sync_sample_before(7))
+        # 0.75s is sample 7, whose sync sample is 4 in chunk 1
+        self.assertEquals((4, 1, index.sample_offset(4)), index.seek(0.75))
+        self.assertTrue(index is self.mp4.get_sample_index(1))
+
+    def testArrays(self):
+        with Mp4File(self.path, arrays=True) as mp4:
+            for index in mp4.get_sample_indexes():
+                plain = self.mp4.get_sample_index(index.track_id)
+                for name in ('sample_pos', 'chunk_sample', 'chunk_offset'):
+                    # built as arrays, not lists
+                    self.assertFalse(isinstance(getattr(index, name), list))
+                    self.assertEquals(getattr(plain, name),
+                                      [int(n) for n in getattr(index, name)])
+                self.assertEquals(plain.seek(0.3), index.seek(0.3))
+                for sample in range(index.sample_count):
+                    self.assertEquals(plain.sample_offset(sample),
+                                      index.sample_offset(sample))
+                    self.assertEquals(plain.sample_size(sample),
+                                      index.sample_size(sample))
+
+if __name__ == "__main__":
+    unittest.main()
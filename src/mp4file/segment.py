@@ -0,0 +1,295 @@
+'''
+Fragmenting progressive files: init segment and media segments.
+
+A Segmenter cuts the tracks of a progressive file at the sync samples of
+a reference track, about every `duration` seconds, and produces the
+segments of a fragmented file, as served by DASH or HLS with fMP4:
+
+    segmenter = Segmenter(mp4, duration=4)
+    init = segmenter.init_segment()
+    for data in segmenter.iter_segments():
+        ...
+
+The init segment is the ftyp and the moov with empty sample tables, no
+durations in its headers and an mvex atom whose mehd holds the duration
+of the movie.  Every media segment is one moof and mdat pair; segments
+are built one at a time, from the sample tables and with batched reads
+of the media data, so memory use is bounded by the size of a segment.
+segment(n) builds a single segment on demand.
+'''
+import struct
+from bisect import bisect_right
+
+from demux import BATCH_SIZE, Sample, read_samples
+from edit import header_bytes, render
+
+# Target segment duration in seconds, by default
+DURATION = 4.0
+
+# Brands of the ftyp of the init segment
+MAJOR_BRAND = 'iso5'
+COMPATIBLE_BRANDS = ('iso5', 'iso6', 'mp41')
+
+# Sample flags of sync samples, and of the samples depending on others
+SYNC_FLAGS = 0x02000000
+NON_SYNC_FLAGS = 0x01010000
+
+# Sample tables emptied in the init segment
+EMPTY_TABLES = {'stts': struct.pack('>I', 0),
+                'stsc': struct.pack('>I', 0),
+                'stsz': struct.pack('>II', 0, 0),
+                'stco': struct.pack('>I', 0),
+                'co64': struct.pack('>I', 0)}
+
+# Sample tables left out of the init segment
+DROPPED_TABLES = ('ctts', 'stss', 'sdtp', 'stps')
+
+# Offset and size of the duration in the payload of the headers whose
+# duration is 0 in the init segment, indexed by version
+DURATION_FIELDS = {'mvhd': ((12, 4), (20, 8)),
+                   'tkhd': ((16, 4), (24, 8))}
+
+
+def _box(type, payload):
+    return struct.pack('>I4s', 8 + len(payload), type) + payload
+
+
+def _full_box(type, payload, version=0, flags=0):
+    return _box(type, struct.pack('>I', (version << 24) | flags) + payload)
+
+
+def _without_duration(atom):
+    '''Return the bytes of an mvhd or tkhd atom with its duration set to
+    0, the duration of the fragments being unknown to the moov.
+    '''
+    data = str(atom.read_data())
+    offset, size = DURATION_FIELDS[atom.type][atom.version]
+    offset += atom.header_size
+    return data[:offset] + '\0' * size + data[offset + size:]
+
+
+class _Track(object):
+    '''A track being segmented: its trak, SampleIndex and composition
+    offsets.
+    '''
+    def __init__(self, trak, index):
+        self.trak = trak
+        self.index = index
+        self.ctts_sample = None
+        self.ctts_offset = None
+        self.ctts_version = 0
+        ctts = trak.find('mdia/minf/stbl/ctts')
+        if ctts is not None:
+            table = ctts.get_attribute('Composition_offset_table')
+            self.ctts_sample = []
+            self.ctts_offset = []
+            sample = 0
+            for i in xrange(0, len(table), 2):
+                self.ctts_sample.append(sample)
+                self.ctts_offset.append(int(table[i + 1]))
+                sample += int(table[i])
+            if ctts.version or min(self.ctts_offset or [0]) < 0:
+                self.ctts_version = 1
+
+    def composition_offset(self, sample):
+        run = bisect_right(self.ctts_sample, sample) - 1
+        if run < 0:
+            return 0
+        return self.ctts_offset[run]
+
+    def first_sample_at(self, ticks):
+        '''Return the first sample decoded at or after ticks.'''
+        index = self.index
+        if not index.sample_count:
+            return 0
+        sample = index.time_to_sample(ticks)
+        if index.sample_time(sample) < ticks:
+            sample += 1
+        return sample
+
+    def samples(self, first, end):
+        '''Return the demux.Samples from first to end, in sample order.'''
+        index = self.index
+        samples = []
+        if first >= end:
+            return samples
+        chunk = index.sample_chunk(first)
+        offset = index.sample_offset(first)
+        for n in xrange(first, end):
+            while n >= index.chunk_sample[chunk + 1]:
+                chunk += 1
+                offset = index.chunk_offset[chunk]
+            size = index.sample_size(n)
+            samples.append(Sample(index.track_id, n, index.sample_time(n),
+                                  offset, size, index.is_sync(n)))
+            offset += size
+        return samples
+
+
+class Segmenter(object):
+    '''Segments of the fragmented version of a progressive Mp4File.
+
+    :param duration: target segment duration in seconds.  Segments start
+        at sync samples of the reference track, the first track with a
+        sync sample table, and last at least duration seconds but the
+        last one.
+    :param track_ids: the IDs of the tracks kept, all of them by default.
+    :param batch_size: largest read of media data, see demux.read_samples.
+    '''
+    def __init__(self, mp4, duration=DURATION, track_ids=None,
+                 batch_size=BATCH_SIZE):
+        self.mp4 = mp4
+        self.duration = duration
+        self.batch_size = batch_size
+        traks = mp4.findall('moov/trak')
+        self.tracks = [_Track(trak, index) for trak, index in
+                       zip(traks, mp4.get_sample_indexes())
+                       if track_ids is None or index.track_id in track_ids]
+        if not self.tracks:
+            raise ValueError('no track to segment')
+        self.reference = self.tracks[0]
+        for track in self.tracks:
+            if track.index.sync is not None:
+                self.reference = track
+                break
+        self._cut()
+
+    def _cut(self):
+        '''Compute the first sample of every segment, for every track.'''
+        reference = self.reference.index
+        target = self.duration * reference.timescale
+        # first samples of the reference track
+        starts = [0]
+        if reference.sync is None:
+            candidates = xrange(1, reference.sample_count)
+        else:
+            candidates = [s for s in reference.sync
+                          if 0 < s < reference.sample_count]
+        for sample in candidates:
+            if reference.sample_time(sample) - \
+                    reference.sample_time(starts[-1]) >= target:
+                starts.append(sample)
+        # times of the cuts, in seconds, as (ticks, timescale)
+        cuts = [(reference.sample_time(s), reference.timescale)
+                for s in starts[1:]]
+        self.start_times = [0.0] + [float(t) / scale for t, scale in cuts]
+        # per segment, per track, the (first, end) samples
+        bounds = []
+        for track in self.tracks:
+            index = track.index
+            if track is self.reference:
+                firsts = starts[1:]
+            else:
+                # ceiling of the cut time in ticks of the track
+                firsts = [track.first_sample_at(
+                    -(-ticks * index.timescale // scale))
+                    for ticks, scale in cuts]
+            firsts = [0] + firsts + [index.sample_count]
+            bounds.append(zip(firsts, firsts[1:]))
+        self.segments = zip(*bounds)
+
+    def __len__(self):
+        return len(self.segments)
+
+    def segment_time(self, number):
+        '''Return the start time in seconds of a segment.'''
+        return self.start_times[number]
+
+    def init_segment(self):
+        '''Return the bytes of the init segment.'''
+        brands = ''.join(COMPATIBLE_BRANDS)
+        ftyp = _box('ftyp', MAJOR_BRAND + struct.pack('>I', 0) + brands)
+        kept = set(id(track.trak) for track in self.tracks)
+
+        def replace(atom):
+            if atom.type == 'trak' and id(atom) not in kept:
+                return ''
+            if atom.type in DROPPED_TABLES:
+                return ''
+            if atom.type in DURATION_FIELDS:
+                return _without_duration(atom)
+            empty = EMPTY_TABLES.get(atom.type)
+            if empty is not None:
+                return header_bytes(atom, len(empty)) + empty
+
+        moov = self.mp4.find('moov')
+        payload = ''.join(render(child, replace)
+                          for child in moov.children
+                          if child.type != 'mvex')
+        # the duration of the whole movie goes to mehd instead
+        duration = moov.find('mvhd').get_attribute('Duration')
+        if duration > 0xFFFFFFFF:
+            mehd = _full_box('mehd', struct.pack('>Q', duration), version=1)
+        else:
+            mehd = _full_box('mehd', struct.pack('>I', duration))
+        trex = ''.join(_full_box('trex', struct.pack(
+            '>IIIII', track.index.track_id, 1, 0, 0, 0))
+                       for track in self.tracks)
+        payload += _box('mvex', mehd + trex)
+        return ftyp + header_bytes(moov, len(payload)) + payload
+
+    def _moof(self, number, runs, data_offsets):
+        trafs = ''
+        for (track, samples), data_offset in zip(runs, data_offsets):
+            index = track.index
+            tfhd = _full_box('tfhd', struct.pack('>I', index.track_id),
+                             flags=0x020000)
+            tfdt = _full_box('tfdt', struct.pack('>Q', samples[0].dts),
+                             version=1)
+            flags = 0x001 | 0x100 | 0x200 | 0x400
+            fmt = 'III'
+            if track.ctts_sample is not None:
+                flags |= 0x800
+                fmt += track.ctts_version and 'i' or 'I'
+            values = []
+            for sample in samples:
+                n = sample.sample_index
+                values.append(index.sample_time(n + 1) - sample.dts)
+                values.append(sample.size)
+                values.append(sample.is_sync and SYNC_FLAGS or NON_SYNC_FLAGS)
+                if track.ctts_sample is not None:
+                    values.append(track.composition_offset(n))
+            trun = _full_box('trun', struct.pack(
+                '>Ii' + fmt * len(samples), len(samples), data_offset,
+                *values), version=track.ctts_version, flags=flags)
+            trafs += _box('traf', tfhd + tfdt + trun)
+        mfhd = _full_box('mfhd', struct.pack('>I', number + 1))
+        return _box('moof', mfhd + trafs)
+
+    def segment(self, number):
+        '''Return the bytes of a media segment, a moof and mdat pair;
+        segments are numbered from 0.
+        '''
+        runs = []
+        for track, (first, end) in zip(self.tracks, self.segments[number]):
+            if first < end:
+                runs.append((track, track.samples(first, end)))
+        # data offsets are relative to the moof, whose size does not
+        # depend on them
+        moof_size = len(self._moof(number, runs, [0] * len(runs)))
+        data_offsets = []
+        offset = moof_size + 8
+        for track, samples in runs:
+            data_offsets.append(offset)
+            offset += sum(sample.size for sample in samples)
+        moof = self._moof(number, runs, data_offsets)
+        chunks = []
+        for track, samples in runs:
+            for sample, data in read_samples(self.mp4.file, samples,
+                                             self.batch_size):
+                chunks.append(str(data))
+        payload = ''.join(chunks)
+        return moof + _box('mdat', payload)
+
+    def iter_segments(self):
+        '''Yield the bytes of every media segment, in order.'''
+        for number in xrange(len(self.segments)):
+            yield self.segment(number)
+
+    def write(self, stream):
+        '''Write out the fragmented file: the init segment followed by
+        every media segment.
+        '''
+        stream.write(self.init_segment())
+        for data in self.iter_segments():
+            stream.write(data)
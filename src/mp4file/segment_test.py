@@ -0,0 +1,114 @@
+'''
+Tests for fragmenting progressive files.
+'''
+import os
+import unittest
+from StringIO import StringIO
+
+from mp4file import Mp4File
+from segment import Segmenter
+from testutil import Track, build_movie, write_temp
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.tracks = [Track(1, sample_sizes=[100 + i for i in range(30)],
+                             delta=100, samples_per_chunk=4, sync_every=6),
+                       Track(2, sample_sizes=[20] * 40, delta=512,
+                             samples_per_chunk=5, timescale=6000)]
+        self.path = write_temp(build_movie(self.tracks))
+        self.mp4 = Mp4File(self.path)
+        self.paths = [self.path]
+
+    def tearDown(self):
+        self.mp4.close()
+        for path in self.paths:
+            os.unlink(path)
+
+    def parse(self, data):
+        path = write_temp(data)
+        self.paths.append(path)
+        return Mp4File(path)
+
+    def testCuts(self):
+        segmenter = Segmenter(self.mp4, duration=1.0)
+        # sync samples of track 1 every 0.6s: cuts at 1.2s and 2.4s
+        self.assertEquals(3, len(segmenter))
+        self.assertEquals([0.0, 1.2, 2.4],
+                          [segmenter.segment_time(n) for n in range(3)])
+        self.assertEquals([((0, 12), (0, 15)), ((12, 24), (15, 29)),
+                           ((24, 30), (29, 40))], segmenter.segments)
+
+    def testFragmentedFile(self):
+        out = StringIO()
+        segmenter = self.mp4.write_fragmented(out, duration=1.0)
+        fragmented = self.parse(out.getvalue())
+        self.assertEquals(['ftyp', 'moov', 'moof', 'mdat', 'moof', 'mdat',
+                           'moof', 'mdat'],
+                          [a.type for a in fragmented.get_atoms()])
+        # empty sample tables and one trex per track
+        for stsz in fragmented.findall('moov/trak/mdia/minf/stbl/stsz'):
+            self.assertEquals(0, stsz.get_attribute('Number_of_entries'))
+        self.assertEquals(None,
+                          fragmented.find('moov/trak/mdia/minf/stbl/stss'))
+        self.assertEquals([1, 2], [t.get_attribute('Track ID') for t in
+                                   fragmented.findall('moov/mvex/trex')])
+        # the duration is that of the fragments, given by mehd
+        self.assertEquals([0, 0, 0], [h.get_attribute('Duration') for h in
+                                      fragmented.findall('moov/mvhd') +
+                                      fragmented.findall('moov/trak/tkhd')])
+        self.assertEquals(self.mp4.find('moov/mvhd').get_attribute('Duration'),
+                          fragmented.find('moov/mvex/mehd')
+                          .get_attribute('Fragment duration'))
+        # the other fields are kept
+        self.assertEquals(320 << 16, fragmented.find('moov/trak/tkhd')
+                          .get_attribute('Track width'))
+        self.assertEquals(u'Test title', fragmented.find('.//title/data')
+                          .get_attribute('data'))
+
+        # every sample at its data offset, with its duration and flags
+        data = out.getvalue()
+        moofs = fragmented.findall('moof')
+        for number, moof in enumerate(moofs):
+            self.assertEquals(number + 1, moof.find('mfhd')
+                              .get_attribute('Sequence number'))
+            for traf, (first, end) in zip(moof.findall('traf'),
+                                          segmenter.segments[number]):
+                track_id = traf.find('tfhd').get_attribute('Track ID')
+                track = self.tracks[track_id - 1]
+                self.assertEquals(
+                    first * track.delta,
+                    traf.find('tfdt').get_attribute('Base media decode time'))
+                trun = traf.find('trun')
+                sizes = trun.get_attribute('Sample_size_table')
+                self.assertEquals(track.sample_sizes[first:end], list(sizes))
+                self.assertEquals([track.delta] * (end - first), list(
+                    trun.get_attribute('Sample_duration_table')))
+                if track_id == 1:
+                    # segments start at sync samples of track 1
+                    flags = trun.get_attribute('Sample_flags_table')
+                    self.assertEquals(0x02000000, flags[0])
+                pos = moof.offset + trun.get_attribute('Data offset')
+                for n in range(first, end):
+                    size = track.sample_sizes[n]
+                    self.assertEquals(track.sample_data(n),
+                                      data[pos:pos + size])
+                    pos += size
+
+    def testSingleSegment(self):
+        segmenter = Segmenter(self.mp4, duration=1.0, track_ids=[2])
+        self.assertEquals(1, len(segmenter.tracks))
+        # sync samples every 0.256s: 12 samples per segment
+        self.assertEquals((12, 24), segmenter.segments[1][0])
+        segment = self.parse(segmenter.segment(1))
+        self.assertEquals(['moof', 'mdat'],
+                          [a.type for a in segment.get_atoms()])
+        trun = segment.find('moof/traf/trun')
+        self.assertEquals(12, trun.get_attribute('Sample count'))
+        self.assertEquals(12 * 20, segment.find('mdat').size - 8)
+        init = self.parse(segmenter.init_segment())
+        self.assertEquals(1, len(init.findall('moov/trak')))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+'''
+Selective parsing: decode only the atoms a caller asks for.
+
+A Selection is a list of find paths to decode and a list of find paths
+to skip, with the syntax of Mp4File.find:
+
+    Selection(['moov/udta/meta/ilst'])
+    Selection(['ftyp', 'moov/mvhd'])
+    Selection(['moov'], skip=['moov/trak/mdia/minf/stbl'])
+
+The tree is parsed lazily, then apply() walks down the containers on the
+way to the selected atoms.  Every selected atom is decoded with all its
+descendants, except the skipped subtrees.  The other atoms, skipped ones
+included, are recorded by type, offset and size only; their children
+and attributes are read if they are accessed later, as with lazy=True.
+'''
+from atomsearch import compile_path
+
+
+class Selection(object):
+    '''Find paths of the atoms to decode, and of the subtrees to skip.
+
+    :param decode: find paths, or bare atom types at the top level.  A
+        path starting with '//' selects its type at any depth, at the cost
+        of walking every container not skipped.
+    :param skip: find paths of subtrees left undecoded, even below a
+        selected atom.
+    '''
+    def __init__(self, decode, skip=()):
+        if isinstance(decode, basestring):
+            decode = [decode]
+        if isinstance(skip, basestring):
+            skip = [skip]
+        self.decode = [compile_path(path) for path in decode]
+        self.skip = [compile_path(path) for path in skip]
+
+    def _advance(self, queries, states, node):
+        '''Advance every query of queries over node.  Returns whether one
+        of them matches node, and the states left for its children.
+        '''
+        matched = False
+        pending = []
+        for query, query_states in zip(queries, states):
+            if query_states:
+                hit, query_states = query.advance(query_states, node)
+                matched = matched or hit
+            pending.append(query_states)
+        return matched, pending
+
+    def apply(self, root):
+        '''Decode the selected atoms below root.  Returns the number of
+        atoms decoded.
+        '''
+        decoded = 0
+        start = ([(0,)] * len(self.decode), [(0,)] * len(self.skip), False)
+        stack = [(child, start) for child in reversed(root.children)]
+        while stack:
+            node, (decode, skip, inside) = stack.pop()
+            skipped, skip = self._advance(self.skip, skip, node)
+            if skipped:
+                continue
+            if not inside:
+                inside, decode = self._advance(self.decode, decode, node)
+                if not inside and not any(decode):
+                    # nothing selected below node
+                    continue
+            if inside:
+                node.attrs
+                decoded += 1
+            state = (decode, skip, inside)
+            for child in reversed(node.children):
+                stack.append((child, state))
+        return decoded
+
+
+def as_selection(select):
+    '''Return select as a Selection, given one or find paths.'''
+    if isinstance(select, Selection):
+        return select
+    return Selection(select)
@@ -0,0 +1,83 @@
+'''
+Tests for selective parsing.
+'''
+import os
+import unittest
+
+from mp4file import Mp4File
+from selection import Selection
+from testutil import break_stsz, build_movie, write_temp
+
+
+def decoded(atom):
+    '''Return the paths of the atoms below atom with decoded attrs.'''
+    paths = []
+    for child in atom._children or ():
+        path = child.type
+        if child._attrs is not None:
+            paths.append(path)
+        paths.extend(path + '/' + p for p in decoded(child))
+    return paths
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.path = write_temp(build_movie())
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def testMetadataOnly(self):
+        mp4 = Mp4File(self.path, select=['moov/udta/meta/ilst'])
+        moov = mp4.find('moov')
+        # traks are recorded, not descended into
+        trak = moov.children[1]
+        self.assertEquals('trak', trak.type)
+        self.assertEquals(None, trak._children)
+        self.assertTrue(trak.size > 0)
+        paths = decoded(mp4)
+        self.assertTrue('moov/udta/meta/ilst/tmpo/data' in paths)
+        self.assertFalse('moov/mvhd' in paths)
+        self.assertFalse('moov/udta/meta' in paths)
+        self.assertEquals(u'Test title',
+                          mp4.find('.//title/data').get_attribute('data'))
+
+    def testSkip(self):
+        selection = Selection(['ftyp', 'moov'],
+                              skip=['moov/trak/mdia/minf/stbl', '//ilst'])
+        mp4 = Mp4File(self.path, select=selection)
+        paths = decoded(mp4)
+        self.assertTrue('ftyp' in paths)
+        self.assertTrue('moov/mvhd' in paths)
+        self.assertTrue('moov/trak/mdia/minf' in paths)
+        self.assertEquals(None, mp4.find('moov/trak/mdia/minf/stbl')._children)
+        self.assertEquals(None, mp4.find('moov/udta/meta/ilst')._children)
+        self.assertFalse('mdat' in paths)
+        # skipped atoms still decode on access
+        eager = Mp4File(self.path)
+        self.assertEquals(eager.find('.//stsz').attrs,
+                          mp4.find('.//stsz').attrs)
+
+    def testCorruptLeaf(self):
+        path = write_temp(break_stsz(open(self.path, 'rb').read()))
+        try:
+            mp4 = Mp4File(path, select=['moov'])
+            self.assertEquals({}, mp4.find('.//stsz').attrs)
+            self.assertEquals(5, mp4.find('.//stco')
+                              .get_attribute('Number_of_entries'))
+            self.assertEquals(u'Test title', mp4.find('.//title/data')
+                              .get_attribute('data'))
+            mp4.close()
+        finally:
+            os.unlink(path)
+
+    def testAnyDepth(self):
+        mp4 = Mp4File(self.path, select=Selection('//tkhd', skip='//stbl'))
+        self.assertEquals(['moov/trak/tkhd'],
+                          [p for p in decoded(mp4) if p.endswith('tkhd')])
+        self.assertEquals(1, mp4.find('moov/trak/tkhd')
+                          .get_attribute('Track ID'))
+
+
+if __name__ == "__main__":
+    unittest.main()
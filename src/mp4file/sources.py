@@ -0,0 +1,266 @@
+'''
+Byte sources: where the parser reads the bytes of a file from.
+
+A byte source has a size() and a read_range(offset, length) method.
+HTTPSource reads an object served over HTTP, one range request at a
+time; local files are read directly (see handles).  BlockFile turns a
+source into the file object the parser reads, through an LRU cache of
+fixed size blocks; a miss fetches the missing blocks in one request,
+plus read_ahead blocks after them.  Inspecting a remote file therefore
+only fetches the blocks holding the atom headers and moov.
+'''
+import httplib
+import urlparse
+
+from defs import *
+
+BLOCK_SIZE = 1 << 16
+
+# Number of blocks kept by default
+CACHE_BLOCKS = 64
+
+# Number of blocks fetched after a missing one by default
+READ_AHEAD = 1
+
+
+class HTTPSource(object):
+    '''Byte source over an object served over HTTP(S), read with range
+    requests on a persistent connection.
+
+    :param url: http or https URL of the object.
+    :param headers: extra request headers, e.g. for authorization.
+    '''
+    def __init__(self, url, headers=None, timeout=30):
+        self.url = url
+        parts = urlparse.urlsplit(url)
+        if parts.scheme == 'https':
+            self._connection_class = httplib.HTTPSConnection
+        elif parts.scheme == 'http':
+            self._connection_class = httplib.HTTPConnection
+        else:
+            raise ValueError('not an http(s) URL: %r' % url)
+        self._netloc = parts.netloc
+        self._path = parts.path or '/'
+        if parts.query:
+            self._path += '?' + parts.query
+        self.headers = dict(headers or {})
+        self.timeout = timeout
+        self._connection = None
+        self._size = None
+        # number of requests sent, and bytes received
+        self.requests = 0
+        self.bytes_read = 0
+
+    def _request(self, method, headers, statuses=(206, 416)):
+        '''Send a request; return the response and its body, or None for
+        the body of a response whose status is not in statuses.  That body
+        is not read: the connection is closed instead, so that a server
+        ignoring Range never sends the whole object.
+        '''
+        for attempt in (0, 1):
+            if self._connection is None:
+                self._connection = self._connection_class(
+                    self._netloc, timeout=self.timeout)
+            try:
+                self._connection.request(method, self._path,
+                                         headers=headers)
+                response = self._connection.getresponse()
+                if response.status not in statuses:
+                    self.close()
+                    data = None
+                    break
+                data = response.read()
+                break
+            except (httplib.HTTPException, IOError):
+                # the server may have closed the kept alive connection
+                self.close()
+                if attempt:
+                    raise
+        self.requests += 1
+        if data is not None:
+            self.bytes_read += len(data)
+        return response, data
+
+    def size(self):
+        if self._size is None:
+            headers = dict(self.headers, Range='bytes=0-0')
+            response, data = self._request('GET', headers, (206,))
+            content_range = response.getheader('content-range')
+            if data is None or not content_range:
+                raise IOError('%s: range requests are not supported'
+                              % self.url)
+            # bytes 0-0/size
+            self._size = int(content_range.rsplit('/', 1)[1])
+        return self._size
+
+    def refresh(self):
+        '''Forget the size, for objects that grow.'''
+        self._size = None
+
+    def read_range(self, offset, length):
+        if length <= 0:
+            return ''
+        headers = dict(self.headers,
+                       Range='bytes=%d-%d' % (offset, offset + length - 1))
+        response, data = self._request('GET', headers)
+        if response.status == 416:
+            # past the end
+            return ''
+        if data is None:
+            raise IOError('%s: unexpected status %d for a range request'
+                          % (self.url, response.status))
+        return data
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def open_source(name):
+    '''Return a byte source for name, a source already or an http(s) URL.
+    '''
+    if hasattr(name, 'read_range'):
+        return name
+    if name.startswith(('http://', 'https://')):
+        return HTTPSource(name)
+    raise ValueError('not a byte source or an http(s) URL: %r' % (name,))
+
+
+def is_remote(name):
+    '''Return whether name is a byte source or a URL, rather than a local
+    path.
+    '''
+    return hasattr(name, 'read_range') or \
+        name.startswith(('http://', 'https://'))
+
+
+class BlockFile(object):
+    '''Read-only file object over a byte source, with an LRU cache of
+    block_size blocks.
+
+    :param cache_blocks: number of blocks kept.
+    :param read_ahead: number of blocks fetched after a missing block,
+        in the same request.
+    '''
+    def __init__(self, source, block_size=BLOCK_SIZE,
+                 cache_blocks=CACHE_BLOCKS, read_ahead=READ_AHEAD):
+        self.source = source
+        self.block_size = block_size
+        self.cache_blocks = max(1, cache_blocks)
+        self.read_ahead = read_ahead
+        self._size = source.size()
+        self._pos = 0
+        # block number -> [bytes, last use]
+        self._blocks = {}
+        self._clock = 0
+        # blocks served from the cache, and fetched from the source
+        self.hits = 0
+        self.misses = 0
+
+    def seek(self, pos, whence=SEEK_SET):
+        if whence == SEEK_CUR:
+            pos += self._pos
+        elif whence == SEEK_END:
+            pos += self._size
+        if pos < 0:
+            raise IOError('negative seek position %d' % pos)
+        self._pos = pos
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size=-1):
+        end = self._size
+        if size >= 0:
+            end = min(end, self._pos + size)
+        if end <= self._pos:
+            return ''
+        start = self._pos
+        self._pos = end
+        if end - start > self.block_size * self.cache_blocks // 2:
+            # too large to cache, e.g. while copying mdat
+            return self.source.read_range(start, end - start)
+        first = start // self.block_size
+        last = (end - 1) // self.block_size
+        self._fetch(first, last)
+        data = ''.join(self._block(n) for n in xrange(first, last + 1))
+        offset = start - first * self.block_size
+        return data[offset:offset + end - start]
+
+    def _block(self, number):
+        entry = self._blocks[number]
+        self._clock += 1
+        entry[1] = self._clock
+        return entry[0]
+
+    def _fetch(self, first, last):
+        '''Fetch the missing blocks from first to last, read ahead
+        included, with one request per run of missing blocks.
+        '''
+        missing = []
+        for n in xrange(first, last + 1):
+            if n in self._blocks:
+                self._block(n)
+            else:
+                missing.append(n)
+        self.hits += last + 1 - first - len(missing)
+        if not missing:
+            return
+        self.misses += len(missing)
+        final = (self._size - 1) // self.block_size
+        stop = min(last + self.read_ahead, final)
+        run = None
+        for n in missing + range(last + 1, stop + 1):
+            if n in self._blocks:
+                continue
+            if run is not None and n == run[1] + 1:
+                run[1] = n
+                continue
+            if run is not None:
+                self._load(*run)
+            run = [n, n]
+        self._load(*run)
+        self._evict(first, last)
+
+    def _load(self, first, last):
+        offset = first * self.block_size
+        data = self.source.read_range(offset,
+                                      (last + 1 - first) * self.block_size)
+        for n in xrange(first, last + 1):
+            start = (n - first) * self.block_size
+            self._clock += 1
+            self._blocks[n] = [data[start:start + self.block_size],
+                               self._clock]
+
+    def _evict(self, first, last):
+        '''Drop the least recently used blocks over cache_blocks, except
+        for the blocks from first to last, being read.
+        '''
+        excess = len(self._blocks) - self.cache_blocks
+        if excess <= 0:
+            return
+        oldest = sorted(self._blocks.iteritems(), key=lambda item: item[1][1])
+        for n, entry in oldest:
+            if excess <= 0:
+                break
+            if not first <= n <= last:
+                del self._blocks[n]
+                excess -= 1
+
+    def refresh(self):
+        '''Read the size of the source again, for sources that grow.  The
+        last block, which may have been short, is dropped from the cache.
+        '''
+        refresh = getattr(self.source, 'refresh', None)
+        if refresh is not None:
+            refresh()
+        if self._size:
+            self._blocks.pop((self._size - 1) // self.block_size, None)
+        self._size = self.source.size()
+
+    def close(self):
+        self._blocks.clear()
+        close = getattr(self.source, 'close', None)
+        if close is not None:
+            close()
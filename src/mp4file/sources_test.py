@@ -0,0 +1,167 @@
+'''
+Tests for byte sources, against a local HTTP server serving ranges.
+'''
+import BaseHTTPServer
+import threading
+import unittest
+
+from mp4file import Mp4File
+from sampleindex import SampleIndex
+from sources import BlockFile, HTTPSource
+from testutil import Track, build_movie
+
+
+class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serves the bytes of the server, honouring single byte ranges.'''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        data = self.server.data
+        self.server.requests.append(self.headers.get('range'))
+        ranges = self.headers.get('range')
+        if ranges is None or self.server.ignore_range:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        start, end = ranges.split('=', 1)[1].split('-')
+        start, end = int(start), min(int(end), len(data) - 1)
+        if start >= len(data):
+            self.send_response(416)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(206)
+        self.send_header('Content-Range',
+                         'bytes %d-%d/%d' % (start, end, len(data)))
+        self.send_header('Content-Length', str(end + 1 - start))
+        self.end_headers()
+        self.wfile.write(data[start:end + 1])
+
+    def log_message(self, *args):
+        pass
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        # a large mdat after moov
+        self.track = Track(sample_sizes=[4096] * 100)
+        self.data = build_movie([self.track])
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                RangeHandler)
+        self.server.data = self.data
+        self.server.requests = []
+        self.server.ignore_range = False
+        # the client hangs up on purpose in testRangeIgnored
+        self.server.handle_error = lambda request, address: None
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/movie.mp4' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testHTTPSource(self):
+        source = HTTPSource(self.url)
+        self.assertEquals(len(self.data), source.size())
+        self.assertEquals(self.data[100:200], source.read_range(100, 100))
+        self.assertEquals('', source.read_range(len(self.data), 10))
+        source.close()
+
+    def testRangeIgnored(self):
+        self.server.data = self.data * 50
+        self.server.ignore_range = True
+        source = HTTPSource(self.url)
+        self.assertRaises(IOError, source.size)
+        self.assertRaises(IOError, source.read_range, 0, 100)
+        # the bodies of the 200 responses are not read
+        self.assertEquals(0, source.bytes_read)
+        source.close()
+
+    def testRemoteMoov(self):
+        source = HTTPSource(self.url)
+        mp4 = Mp4File(source, lazy=True, block_size=4096, cache_blocks=16,
+                      read_ahead=0)
+        self.assertEquals((4096, 16, 0), (mp4.file.block_size,
+                                          mp4.file.cache_blocks,
+                                          mp4.file.read_ahead))
+        stsz = mp4.find('moov/trak/mdia/minf/stbl/stsz')
+        self.assertEquals([4096] * 100,
+                          list(stsz.get_attribute('Sample_size_table')))
+        # only the blocks of the headers and moov are fetched
+        self.assertTrue(source.bytes_read < len(self.data) / 10)
+        self.assertTrue(source.requests <= 4)
+
+        # samples read through the same source
+        index = SampleIndex(mp4.find('moov/trak'))
+        mp4.file.seek(index.sample_offset(42))
+        self.assertEquals(self.track.sample_data(42), mp4.file.read(4096))
+        mp4.close()
+
+    def testURL(self):
+        mp4 = Mp4File(self.url)
+        self.assertEquals(['ftyp', 'moov', 'mdat'],
+                          [a.type for a in mp4.get_atoms()])
+        mp4.close()
+
+
+class BytesSource(object):
+    '''Byte source over a string, which may grow.'''
+    def __init__(self, data):
+        self.data = data
+
+    def size(self):
+        return len(self.data)
+
+    def read_range(self, offset, length):
+        return self.data[offset:offset + length]
+
+
+class BlockFileTest(unittest.TestCase):
+    def setUp(self):
+        self.data = ''.join(chr(i % 251) for i in range(10000))
+
+    def testReads(self):
+        source = BytesSource(self.data)
+        reads = []
+        read_range = source.read_range
+        source.read_range = lambda offset, length: (
+            reads.append((offset, length)) or read_range(offset, length))
+        f = BlockFile(source, block_size=100, cache_blocks=4, read_ahead=1)
+        f.seek(150)
+        self.assertEquals(self.data[150:260], f.read(110))
+        # blocks 1 and 2, and block 3 read ahead, in one request
+        self.assertEquals([(100, 300)], reads)
+        f.seek(300)
+        self.assertEquals(self.data[300:400], f.read(100))
+        self.assertEquals(1, len(reads))
+        # too large to cache
+        f.seek(1000)
+        self.assertEquals(self.data[1000:1500], f.read(500))
+        self.assertEquals((1000, 500), reads[-1])
+        # the end of the file
+        f.seek(-10, 2)
+        self.assertEquals(self.data[-10:], f.read())
+        self.assertEquals('', f.read(10))
+        self.assertTrue(len(f._blocks) <= 4)
+        f.close()
+
+    def testRefresh(self):
+        source = BytesSource(self.data)
+        f = BlockFile(source, block_size=4096)
+        f.seek(8000)
+        self.assertEquals(self.data[8000:], f.read())
+        more = 'x' * 5000
+        source.data += more
+        f.refresh()
+        # the short last block is fetched again
+        f.seek(8000)
+        self.assertEquals(self.data[8000:] + more, f.read())
+        f.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
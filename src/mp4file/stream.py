@@ -0,0 +1,152 @@
+'''
+Forward-only parsing of mp4 streams.
+
+iterparse() reads atoms from any object with a read() method, such as a
+pipe, a socket file or an upload body, and never seeks.  It reports every
+atom with a 'start' and an 'end' event, in the manner of
+xml.etree.ElementTree.iterparse.
+'''
+import struct
+
+from defs import *
+from atom import (ATOM_WITH_CHILDREN, FULL_BOX, NO_ATTRS, NO_CHILDREN,
+                  EndOFFile, Window, create_atom)
+
+# Payloads of these atoms are never read into memory
+SKIP_PAYLOADS = ('mdat', 'free', 'skip')
+
+# Payloads larger than this are skipped rather than read for decoding
+MAX_PAYLOAD = 1 << 20
+
+CHUNK_SIZE = 1 << 16
+
+
+def _read(stream, size):
+    data = stream.read(size)
+    while len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            raise EndOFFile()
+        data += more
+    return data
+
+
+def _skip(stream, size, chunk_size):
+    '''Consume size bytes of stream, chunk_size bytes at a time.  A None
+    size consumes the rest of the stream.
+    '''
+    while size is None or size > 0:
+        if size is None:
+            want = chunk_size
+        else:
+            want = min(size, chunk_size)
+        data = stream.read(want)
+        if not data:
+            if size is None:
+                return
+            raise EndOFFile()
+        if size is not None:
+            size -= len(data)
+
+
+def _read_header(stream):
+    '''Return the bytes of the header of the next atom, or None at the
+    end of the stream.
+    '''
+    first = stream.read(8)
+    if not first:
+        return None
+    header = first
+    if len(header) < 8:
+        header += _read(stream, 8 - len(header))
+    size, type = struct.unpack('>I4s', header)
+    if size == 1:
+        header += _read(stream, 8)
+    if type in FULL_BOX:
+        header += _read(stream, 4)
+    if type == 'uuid':
+        header += _read(stream, 16)
+    return header
+
+
+def iterparse(stream, events=('start', 'end'), skip=SKIP_PAYLOADS,
+              max_payload=MAX_PAYLOAD, chunk_size=CHUNK_SIZE):
+    '''Parse the atoms of stream in a single forward pass.
+
+    Yields (event, atom) pairs, where event is 'start' or 'end' and atom
+    an Atom with its absolute offset and decoded header.  Atoms are not
+    kept: their children are only reported through events, and `parent`
+    links to the enclosing atom, None at the top level.  The attrs of leaf
+    atoms are decoded from their payload, except for the atom types in
+    skip and payloads over max_payload bytes, which are consumed
+    chunk_size bytes at a time and discarded.  Memory use therefore does
+    not depend on the input size.
+
+    :param stream: object with a read() method.
+    :param events: the events to report.
+    '''
+    report_start = 'start' in events
+    report_end = 'end' in events
+    offset = 0
+    # open containers, as (atom, end offset) pairs
+    stack = []
+    while True:
+        while stack and stack[-1][1] is not None and offset >= stack[-1][1]:
+            atom = stack.pop()[0]
+            if report_end:
+                yield 'end', atom
+        header = _read_header(stream)
+        if header is None:
+            break
+        size = struct.unpack('>I', header[:4])[0]
+        type = header[4:8]
+        if size == 1:
+            end = offset + struct.unpack('>Q', header[8:16])[0]
+        elif size == 0:
+            end = None
+        else:
+            end = offset + size
+        if end is not None and end - offset < len(header):
+            # a negative payload size would read the rest of the stream
+            raise ValueError('%r atom at %d is smaller than its header'
+                             % (type, offset))
+        container = type in ATOM_WITH_CHILDREN
+        payload = ''
+        if end is None:
+            remaining = None
+        else:
+            remaining = end - offset - len(header)
+        if not container and remaining is not None and \
+                type not in skip and remaining <= max_payload:
+            payload = _read(stream, remaining)
+        atom = create_atom(size, type, offset, Window(header + payload,
+                                                       offset), lazy=True)
+        # children are reported through events, never kept
+        atom._children = NO_CHILDREN
+        if stack:
+            atom.parent = stack[-1][0]
+        else:
+            atom.parent = None
+        if not container and not payload and remaining != 0:
+            # the payload is not available to decode
+            atom._attrs = NO_ATTRS
+        if report_start:
+            yield 'start', atom
+        if container:
+            stack.append((atom, end))
+            offset += len(header)
+            continue
+        if not payload:
+            _skip(stream, remaining, chunk_size)
+        if end is None:
+            offset = None
+        else:
+            offset = end
+        if report_end:
+            yield 'end', atom
+        if offset is None:
+            break
+    while stack:
+        atom = stack.pop()[0]
+        if report_end:
+            yield 'end', atom
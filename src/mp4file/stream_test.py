@@ -0,0 +1,90 @@
+'''
+Tests for the forward-only stream parser.
+'''
+import os
+import struct
+import unittest
+from StringIO import StringIO
+
+from atom import EndOFFile
+from mp4file import Mp4File
+from stream import iterparse
+from testutil import Track, build_movie, write_temp
+
+
+class Pipe(object):
+    '''A stream that can only be read, recording the largest read.'''
+    def __init__(self, data):
+        self.data = StringIO(data)
+        self.largest = 0
+
+    def read(self, size):
+        self.largest = max(self.largest, size)
+        return self.data.read(size)
+
+
+def walk(atom):
+    for child in atom.get_atoms():
+        yield 'start', child
+        for event in walk(child):
+            yield event
+        yield 'end', child
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.data = build_movie([Track(sample_sizes=[5000] * 40)])
+        self.path = write_temp(self.data)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def testEvents(self):
+        expected = [(event, atom.type, atom.offset, atom.size)
+                    for event, atom in walk(Mp4File(self.path, lazy=True))]
+        got = [(event, atom.type, atom.offset, atom.size)
+               for event, atom in iterparse(Pipe(self.data))]
+        self.assertEquals(expected, got)
+
+    def testAttrs(self):
+        mp4 = Mp4File(self.path)
+        for event, atom in iterparse(Pipe(self.data), events=('end',)):
+            if atom.type in ('mvhd', 'stsz', 'ftyp'):
+                self.assertEquals(mp4.find('.//' + atom.type).attrs,
+                                  atom.attrs)
+            elif atom.name == 'data' and atom.parent.name == 'title':
+                self.assertEquals(u'Test title', atom.get_attribute('data'))
+            if atom.type in ('ftyp', 'moov', 'mdat'):
+                self.assertEquals(None, atom.parent)
+            elif atom.type == 'trak':
+                self.assertEquals('moov', atom.parent.type)
+
+    def testBoundedSkip(self):
+        pipe = Pipe(self.data)
+        for event, atom in iterparse(pipe, chunk_size=4096):
+            if atom.type == 'mdat':
+                self.assertEquals({}, atom.attrs)
+        self.assertEquals(4096, pipe.largest)
+        self.assertEquals('', pipe.data.read())
+
+    def testTruncated(self):
+        starts = []
+        def parse():
+            for event, atom in iterparse(Pipe(self.data[:40])):
+                if event == 'start':
+                    starts.append(atom.type)
+        self.assertRaises(EndOFFile, parse)
+        self.assertEquals(['ftyp', 'moov'], starts)
+
+    def testBrokenSize(self):
+        rest = 'x' * 100000
+        for header in (struct.pack('>I4s', 4, 'free'),
+                       struct.pack('>I4sQ', 1, 'free', 12)):
+            pipe = Pipe(self.data + header + rest)
+            self.assertRaises(ValueError, list, iterparse(pipe))
+            # the rest of the stream is not read
+            self.assertTrue(pipe.largest < len(rest))
+
+
+if __name__ == "__main__":
+    unittest.main()
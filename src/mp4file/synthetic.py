@@ -0,0 +1,218 @@
+'''
+Synthetic mp4 files built in memory, for the unit tests and the
+benchmarks.
+
+build_movie returns a progressive file and build_fragmented a fragmented
+one, both made of Track descriptions; every sample payload is derived
+from its track and index, so files are deterministic.
+'''
+import os
+import struct
+import tempfile
+
+
+def box(type, payload=''):
+    '''Return a plain box of the given type wrapping payload.'''
+    return struct.pack('>I', 8 + len(payload)) + type + payload
+
+
+def full_box(type, payload='', version=0, flags=0):
+    '''Return a full box (version and flags) wrapping payload.'''
+    return box(type, struct.pack('>I', (version << 24) | flags) + payload)
+
+
+def u32(*values):
+    return struct.pack('>' + 'I' * len(values), *values)
+
+
+MATRIX = u32(0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+
+
+class Track(object):
+    '''Description of a synthetic track.
+
+    Every chunk holds `samples_per_chunk` samples, each sample lasts
+    `delta` media ticks and every `sync_every` th sample is a sync sample.
+    '''
+    def __init__(self, track_id=1, sample_sizes=None, delta=100,
+                 samples_per_chunk=2, sync_every=3, timescale=1000,
+                 width=320, height=240):
+        self.track_id = track_id
+        if sample_sizes is None:
+            sample_sizes = [16 + i for i in range(10)]
+        self.sample_sizes = sample_sizes
+        self.delta = delta
+        self.samples_per_chunk = samples_per_chunk
+        self.sync_every = sync_every
+        self.timescale = timescale
+        self.width = width
+        self.height = height
+
+    def chunks(self):
+        '''Return the list of chunks, as lists of sample indices.'''
+        n = len(self.sample_sizes)
+        return [range(i, min(i + self.samples_per_chunk, n))
+                for i in range(0, n, self.samples_per_chunk)]
+
+    def sample_data(self, index):
+        '''Deterministic payload of the given sample.'''
+        return chr(self.track_id) * self.sample_sizes[index]
+
+    def duration(self):
+        return self.delta * len(self.sample_sizes)
+
+
+def trak(track, chunk_offsets, fragmented=False):
+    '''Return the trak of a track.  The sample tables of fragmented
+    tracks are empty.
+    '''
+    n = len(track.sample_sizes)
+    chunks = track.chunks()
+    tkhd = full_box('tkhd', u32(0, 0, track.track_id, 0, track.duration(),
+                                0, 0, 0, 0) + MATRIX +
+                    u32(track.width << 16, track.height << 16), flags=7)
+    mdhd = full_box('mdhd', u32(0, 0, track.timescale, track.duration()) +
+                    struct.pack('>HH', 0x55c4, 0))
+    hdlr = full_box('hdlr', u32(0) + 'vide' + u32(0, 0, 0) + 'video\0')
+    stsd = full_box('stsd', u32(1) + box('avc1', '\0' * 8))
+    if fragmented:
+        stbl = box('stbl', stsd + full_box('stts', u32(0)) +
+                   full_box('stsc', u32(0)) + full_box('stsz', u32(0, 0)) +
+                   full_box('stco', u32(0)))
+        minf = box('minf', full_box('vmhd', '\0' * 8, flags=1) + stbl)
+        return box('trak', tkhd + box('mdia', mdhd + hdlr + minf))
+    stts = full_box('stts', u32(1, n, track.delta))
+    stss = full_box('stss', u32(*([len(range(0, n, track.sync_every))] +
+                                  [i + 1 for i in range(0, n,
+                                                        track.sync_every)])))
+    stsc_entries = [(1, len(chunks[0]), 1)]
+    if len(chunks[-1]) != len(chunks[0]):
+        stsc_entries.append((len(chunks), len(chunks[-1]), 1))
+    stsc = full_box('stsc', u32(len(stsc_entries)) +
+                    ''.join(u32(*e) for e in stsc_entries))
+    stsz = full_box('stsz', u32(0, n, *track.sample_sizes))
+    stco = full_box('stco', u32(len(chunk_offsets), *chunk_offsets))
+    stbl = box('stbl', stsd + stts + stss + stsc + stsz + stco)
+    minf = box('minf', full_box('vmhd', struct.pack('>HHHH', 0, 0, 0, 0),
+                                flags=1) + stbl)
+    return box('trak', tkhd + box('mdia', mdhd + hdlr + minf))
+
+
+def ilst_item(type, data_type, payload):
+    return box(type, box('data', u32(data_type, 0) + payload))
+
+
+def udta(tags):
+    items = ''
+    for type, value in tags:
+        if isinstance(value, int):
+            items += ilst_item(type, 21, u32(value))
+        elif type == 'covr':
+            items += ilst_item(type, 13, value)
+        else:
+            items += ilst_item(type, 1, value)
+    meta = full_box('meta', full_box('hdlr', u32(0) + 'mdir' +
+                                     u32(0, 0, 0) + '\0') +
+                    box('ilst', items))
+    return box('udta', meta)
+
+
+DEFAULT_TAGS = [('\xa9nam', 'Test title'),
+                ('\xa9alb', 'Test album'),
+                ('tmpo', 120),
+                ('covr', '\xff\xd8\xff\xe0' + 'JFIF' * 64)]
+
+
+def build_movie(tracks=None, tags=DEFAULT_TAGS, moov_first=True):
+    '''Return the bytes of a progressive mp4 file.
+
+    Chunks of all tracks are interleaved in the mdat in chunk order.
+    '''
+    if tracks is None:
+        tracks = [Track()]
+    ftyp = box('ftyp', 'isom' + u32(512) + 'isomiso2mp41')
+
+    # interleave the chunks of every track
+    layout = []
+    chunks = dict((t.track_id, t.chunks()) for t in tracks)
+    for index in range(max(len(c) for c in chunks.values())):
+        for track in tracks:
+            if index < len(chunks[track.track_id]):
+                layout.append((track, chunks[track.track_id][index]))
+
+    def moov(mdat_payload_offset):
+        offsets = dict((t.track_id, []) for t in tracks)
+        pos = mdat_payload_offset
+        for track, samples in layout:
+            offsets[track.track_id].append(pos)
+            pos += sum(track.sample_sizes[i] for i in samples)
+        duration = max(t.duration() for t in tracks)
+        mvhd = full_box('mvhd', u32(0, 0, 1000, duration, 0x10000) +
+                        struct.pack('>H', 0x100) + '\0' * 10 + MATRIX +
+                        u32(0, 0, 0, 0, 0, 0, len(tracks) + 1))
+        traks = ''.join(trak(t, offsets[t.track_id]) for t in tracks)
+        return box('moov', mvhd + traks + (udta(tags) if tags else ''))
+
+    mdat = box('mdat', ''.join(track.sample_data(i)
+                               for track, samples in layout
+                               for i in samples))
+    moov_size = len(moov(0))
+    if moov_first:
+        return ftyp + moov(len(ftyp) + moov_size + 8) + mdat
+    return ftyp + mdat + moov(len(ftyp) + 8)
+
+
+def moof(track, sequence, samples):
+    '''Return a moof and mdat pair holding the given samples of a track.
+    The first sample is a sync sample.
+    '''
+    tfhd = full_box('tfhd', u32(track.track_id, track.delta),
+                    flags=0x020008)
+    tfdt = full_box('tfdt', struct.pack('>Q', samples[0] * track.delta),
+                    version=1)
+
+    def build(data_offset):
+        trun = full_box('trun', u32(len(samples), data_offset, 0x02000000) +
+                        u32(*[track.sample_sizes[i] for i in samples]),
+                        flags=0x205)
+        return box('moof', full_box('mfhd', u32(sequence)) +
+                   box('traf', tfhd + tfdt + trun))
+    size = len(build(0))
+    mdat = box('mdat', ''.join(track.sample_data(i) for i in samples))
+    return build(size + 8) + mdat
+
+
+def build_fragmented(track=None, samples_per_fragment=3, mfra=True):
+    '''Return the bytes of a fragmented mp4 file, closed by an mfra
+    indexing every fragment unless mfra is false.
+    '''
+    if track is None:
+        track = Track()
+    ftyp = box('ftyp', 'iso6' + u32(0) + 'iso6dash')
+    mvhd = full_box('mvhd', u32(0, 0, 1000, 0, 0x10000) +
+                    struct.pack('>H', 0x100) + '\0' * 10 + MATRIX +
+                    u32(0, 0, 0, 0, 0, 0, track.track_id + 1))
+    trex = full_box('trex', u32(track.track_id, 1, track.delta, 0, 0))
+    data = ftyp + box('moov', mvhd + trak(track, [], fragmented=True) +
+                      box('mvex', trex))
+    points = []
+    n = len(track.sample_sizes)
+    for sequence, first in enumerate(range(0, n, samples_per_fragment)):
+        samples = range(first, min(first + samples_per_fragment, n))
+        points.append((first * track.delta, len(data)))
+        data += moof(track, sequence + 1, samples)
+    if mfra:
+        tfra = full_box('tfra', u32(track.track_id, 0, len(points)) +
+                        ''.join(struct.pack('>QQBBB', time, offset, 1, 1, 1)
+                                for time, offset in points), version=1)
+        size = 8 + len(tfra) + 16
+        data += box('mfra', tfra + full_box('mfro', u32(size)))
+    return data
+
+
+def write_temp(data):
+    '''Write data into a temporary file and return its path.'''
+    fd, path = tempfile.mkstemp(suffix='.mp4')
+    os.write(fd, data)
+    os.close(fd)
+    return path
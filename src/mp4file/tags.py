@@ -0,0 +1,257 @@
+'''
+In-place editing of the iTunes style metadata items of a file.
+
+Items live in moov/udta/meta/ilst, usually in front of the media data.
+When the edited moov atom still fits in the space it occupied, together
+with the free atoms inside it and right after it, it is written over the
+old one and the space left is kept as a free atom inside meta.  Only when
+it does not fit is the file rewritten, with the chunk offsets moved and
+PADDING bytes of free space reserved for later edits.
+'''
+import os
+import shutil
+import struct
+import tempfile
+
+from atom import ATOM_TYPE_MAP
+from edit import FREE_TYPES, free_atom, header_bytes, render, \
+     shift_chunk_offsets
+from mp4file import Mp4File
+from transfer import Copier
+
+# Free space reserved inside meta when the file has to be rewritten
+PADDING = 1024
+
+# Byte sizes of integer items; other integer items take 4 bytes
+INT_SIZES = {'tmpo': 2, 'cpil': 1, 'pgap': 1, 'pcst': 1, 'rtng': 1}
+
+# Image data types, by the signature of the image
+PNG_SIGNATURE = '\x89PNG'
+
+
+def item_types(key):
+    '''Return the ilst item types a key stands for.  A key is either an
+    item type, such as '\\xa9nam', or one of the names of ATOM_TYPE_MAP,
+    such as 'title'.  The type to write comes first.
+    '''
+    if key in ATOM_TYPE_MAP:
+        return [key]
+    types = [t for t, name in ATOM_TYPE_MAP.iteritems() if name == key]
+    if not types:
+        raise KeyError(key)
+    # prefer the text items of the '\xa9' family
+    types.sort(key=lambda t: (not t.startswith('\xa9'), t))
+    return types
+
+
+def encode_item(type, value):
+    '''Return the ilst item of the given type holding value.
+
+    Unicode and str values are stored as UTF-8 text, except for cover
+    art, which is stored as a JPEG or PNG image.  Integers are stored as
+    signed integers; 'trkn' and 'disk' take an int or a (number, total)
+    pair.
+    '''
+    if type in ('trkn', 'disk'):
+        if isinstance(value, tuple):
+            number, total = value
+        else:
+            number, total = value, 0
+        data_type = 0
+        payload = struct.pack('>HHHH', 0, number, total, 0)
+        if type == 'disk':
+            payload = payload[:6]
+    elif isinstance(value, (int, long)):
+        data_type = 21
+        size = INT_SIZES.get(type, 4)
+        payload = ''.join(chr((value >> (8 * i)) & 0xFF)
+                          for i in reversed(range(size)))
+    elif isinstance(value, unicode):
+        data_type = 1
+        payload = value.encode('utf-8')
+    elif type == 'covr':
+        payload = str(value)
+        data_type = payload.startswith(PNG_SIGNATURE) and 14 or 13
+    else:
+        data_type = 1
+        payload = str(value)
+    data = struct.pack('>I4sII', 16 + len(payload), 'data', data_type, 0)
+    return struct.pack('>I4s', 8 + len(data) + len(payload), type) + \
+        data + payload
+
+
+def _ilst_payload(ilst, tags):
+    '''Return the items of ilst, given as an atom or None, with the tags
+    applied.
+    '''
+    updates = {}
+    removed = set()
+    for key, value in tags.iteritems():
+        types = item_types(key)
+        removed.update(types)
+        if value is not None:
+            updates[types[0]] = encode_item(types[0], value)
+    items = []
+    if ilst is not None:
+        for item in ilst.children:
+            if item.type in updates:
+                # replace the first occurrence, in place
+                items.append(updates.pop(item.type))
+            elif item.type not in removed:
+                items.append(render(item))
+    for type in sorted(updates):
+        items.append(updates[type])
+    return ''.join(items)
+
+
+def _meta(ilst_payload):
+    '''Return the payload of a new meta atom holding the given items.'''
+    hdlr = struct.pack('>I4sII4sIII', 33, 'hdlr', 0, 0, 'mdir', 0, 0, 0) + \
+        '\0'
+    return hdlr + struct.pack('>I4s', 8 + len(ilst_payload), 'ilst') + \
+        ilst_payload
+
+
+class _MoovRenderer(object):
+    '''Renders a moov atom with new ilst items, all free atoms dropped and
+    a free atom of a given size appended to meta.
+    '''
+    def __init__(self, moov, tags):
+        self.moov = moov
+        self.udta = moov.find('udta')
+        self.meta = self.udta is not None and self.udta.find('meta') or None
+        ilst = self.meta is not None and self.meta.find('ilst') or None
+        self.ilst = ilst
+        self.items = _ilst_payload(ilst, tags)
+        self.padding = 0
+        # (start, delta) pairs, see shift_chunk_offsets
+        self.shifts = []
+
+    def _children(self, atom):
+        return ''.join(render(child, self.replace)
+                       for child in atom.children)
+
+    def replace(self, atom):
+        if atom.type in FREE_TYPES:
+            return ''
+        if atom is self.ilst:
+            return header_bytes(atom, len(self.items)) + self.items
+        if atom.type in ('stco', 'co64') and self.shifts:
+            return shift_chunk_offsets(atom, self.shifts)
+        extra = ''
+        if atom is self.moov and self.udta is None:
+            extra = self._new_meta(self._meta_payload())
+            extra = struct.pack('>I4s', 8 + len(extra), 'udta') + extra
+        elif atom is self.udta and self.meta is None:
+            extra = self._new_meta(self._meta_payload())
+        elif atom is self.meta:
+            payload = self._children(atom)
+            if self.ilst is None:
+                payload += struct.pack('>I4s', 8 + len(self.items),
+                                       'ilst') + self.items
+            payload += self._padding()
+            return header_bytes(atom, len(payload)) + payload
+        elif atom not in (self.moov, self.udta):
+            return None
+        payload = self._children(atom) + extra
+        return header_bytes(atom, len(payload)) + payload
+
+    def _meta_payload(self):
+        return _meta(self.items) + self._padding()
+
+    def _new_meta(self, payload):
+        return struct.pack('>I4sI', 12 + len(payload), 'meta', 0) + payload
+
+    def _padding(self):
+        return self.padding and free_atom(self.padding) or ''
+
+    def render(self, padding=0, delta=0, start=0):
+        self.padding = padding
+        self.shifts = delta and [(start, delta)] or []
+        return render(self.moov, self.replace)
+
+
+def update_tags(filename, tags, padding=PADDING):
+    '''Set the metadata items of the file in place.
+
+    :param tags: dict of item types or ATOM_TYPE_MAP names to values (see
+        encode_item); a None value removes the item.
+    :param padding: free space, in bytes, reserved inside meta when the
+        file has to be rewritten.
+    :return: True if only the moov atom was rewritten, False if the whole
+        file was.
+    '''
+    mp4 = Mp4File(filename, lazy=True)
+    try:
+        top = mp4.get_atoms()
+        for index, moov in enumerate(top):
+            if moov.type == 'moov':
+                break
+        else:
+            raise ValueError('%s has no moov atom' % filename)
+        start = moov.offset
+        end = start + moov.get_actual_size()
+        index += 1
+        # free atoms right after moov are room to grow into
+        while index < len(top) and top[index].type in FREE_TYPES and \
+                top[index].size >= 8:
+            end += top[index].size
+            index += 1
+        at_end = index == len(top)
+
+        renderer = _MoovRenderer(moov, tags)
+        data = renderer.render()
+        room = end - start - len(data)
+        if at_end:
+            # nothing follows, the file may grow or shrink
+            if room != 0 and room < 8:
+                room = padding
+            data = renderer.render(room)
+        elif room == 0 or room >= 8:
+            data = renderer.render(room)
+        else:
+            _rewrite(mp4, renderer, start, end, padding)
+            return False
+    finally:
+        mp4.close()
+
+    f = open(filename, 'r+b')
+    try:
+        f.seek(start)
+        f.write(data)
+        if at_end:
+            f.truncate()
+    finally:
+        f.close()
+    return True
+
+
+def _rewrite(mp4, renderer, start, end, padding):
+    '''Rewrite the file of mp4, the region from start to end replaced by
+    the rendered moov atom.
+    '''
+    delta = 0
+    while True:
+        data = renderer.render(padding, delta, end)
+        if len(data) - (end - start) == delta:
+            break
+        # offsets grew to 64 bits, moving the media data further
+        delta = len(data) - (end - start)
+
+    filename = mp4.filename
+    fd, tmp = tempfile.mkstemp(suffix='.tmp',
+                               dir=os.path.dirname(os.path.abspath(filename)))
+    out = os.fdopen(fd, 'wb')
+    try:
+        try:
+            copier = Copier()
+            copier.copy(mp4.file, 0, start, out)
+            out.write(data)
+            copier.copy(mp4.file, end, None, out)
+        finally:
+            out.close()
+        shutil.copymode(filename, tmp)
+        os.rename(tmp, filename)
+    except:
+        os.unlink(tmp)
+        raise
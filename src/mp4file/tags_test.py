@@ -0,0 +1,121 @@
+'''
+Tests for in-place metadata editing.
+'''
+import os
+import unittest
+
+from atom import Payload
+from mp4file import Mp4File
+from sampleindex import SampleIndex
+from tags import PADDING, update_tags
+from testutil import build_movie, u32, write_temp
+
+
+def read_tags(path):
+    mp4 = Mp4File(path)
+    try:
+        tags = {}
+        for data in mp4.findall('moov/udta/meta/ilst/*/data'):
+            value = data.get_attribute('data')
+            if isinstance(value, Payload):
+                value = str(value)
+            tags[data.parent.name] = value
+        return tags
+    finally:
+        mp4.close()
+
+
+def samples(path):
+    '''Return the payload of every sample of the first track.'''
+    mp4 = Mp4File(path)
+    try:
+        index = SampleIndex(mp4.find('moov/trak'))
+        result = []
+        for i in range(index.sample_count):
+            mp4.file.seek(index.sample_offset(i))
+            result.append(mp4.file.read(index.sample_size(i)))
+        return result
+    finally:
+        mp4.close()
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.paths = []
+
+    def tearDown(self):
+        for path in self.paths:
+            os.unlink(path)
+
+    def temp(self, data):
+        path = write_temp(data)
+        self.paths.append(path)
+        return path
+
+    def testRewriteThenInPlace(self):
+        path = self.temp(build_movie())
+        before = samples(path)
+        size = os.path.getsize(path)
+        # no free space yet: the file is rewritten with padding
+        self.assertFalse(update_tags(path, {'title': u'A longer title'}))
+        self.assertEquals(size + len('A longer title') - len('Test title') +
+                          PADDING, os.path.getsize(path))
+        self.assertEquals(before, samples(path))
+        tags = read_tags(path)
+        self.assertEquals(u'A longer title', tags['title'])
+        self.assertEquals(u'Test album', tags['album'])
+        self.assertEquals(120, tags['bpm'])
+
+        # later edits fit the padding
+        size = os.path.getsize(path)
+        self.assertTrue(update_tags(path, {'\xa9alb': None,
+                                           'artist': u'Somebody',
+                                           'tracknum': (3, 12)}))
+        self.assertEquals(size, os.path.getsize(path))
+        self.assertEquals(before, samples(path))
+        tags = read_tags(path)
+        self.assertFalse('album' in tags)
+        self.assertEquals(u'Somebody', tags['artist'])
+        self.assertEquals(3, tags['tracknum'])
+        self.assertEquals(u'A longer title', tags['title'])
+
+    def testMoovLast(self):
+        path = self.temp(build_movie(moov_first=False))
+        before = samples(path)
+        self.assertTrue(update_tags(path, {'title': u'\xe9t\xe9'}))
+        self.assertEquals(before, samples(path))
+        self.assertEquals(u'\xe9t\xe9', read_tags(path)['title'])
+
+        # the space freed is kept as padding
+        self.assertTrue(update_tags(path, {'coverart': None}))
+        self.assertFalse('coverart' in read_tags(path))
+
+    def testCreateIlst(self):
+        path = self.temp(build_movie(tags=None))
+        before = samples(path)
+        self.assertFalse(update_tags(path, {'bpm': 90, 'coverart':
+                                            '\x89PNG' + 'x' * 20}))
+        self.assertEquals(before, samples(path))
+        tags = read_tags(path)
+        self.assertEquals(90, tags['bpm'])
+        self.assertEquals('\x89PNG' + 'x' * 20, tags['coverart'])
+
+    def testTruncatedChunkOffsets(self):
+        # moov in front of the media data, so that its offsets move
+        data = build_movie()
+        # the count follows the type, version and flags
+        pos = data.index('stco') + 8
+        for count in (8, 100000):
+            path = self.temp(data[:pos] + u32(count) + data[pos + 4:])
+            before = open(path, 'rb').read()
+            self.assertRaises(ValueError, update_tags, path,
+                              {'title': u'A longer title'})
+            self.assertEquals(before, open(path, 'rb').read())
+
+    def testUnknownKey(self):
+        path = self.temp(build_movie())
+        self.assertRaises(KeyError, update_tags, path, {'nosuchtag': u'x'})
+
+
+if __name__ == "__main__":
+    unittest.main()
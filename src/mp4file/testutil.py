@@ -0,0 +1,36 @@
+'''
+Helpers to build small mp4 files in memory for the unit tests.
+'''
+import mp4file
+from instrument import CountingFile
+from synthetic import DEFAULT_TAGS, MATRIX, Track, box, build_fragmented, \
+     build_movie, full_box, ilst_item, moof, trak, u32, udta, write_temp
+
+
+def break_stsz(data, count=1000):
+    '''Return data with the entry count of its first stsz set to count,
+    past the end of the entries it holds.
+    '''
+    # the count follows the type, version and flags, and sample size
+    pos = data.index('stsz') + 12
+    return data[:pos] + u32(count) + data[pos + 4:]
+
+
+def open_counting(path, record=False, **kwargs):
+    '''Return (mp4, counter): an Mp4File of path, and the
+    instrument.CountingFile its file is wrapped in before any atom is
+    parsed, so that every atom reads through it.
+    '''
+    counters = []
+    open_file = mp4file.open_file
+
+    def counting_open_file(*args, **kwargs):
+        counters.append(CountingFile(open_file(*args, **kwargs),
+                                     record=record))
+        return counters[-1]
+    mp4file.open_file = counting_open_file
+    try:
+        mp4 = mp4file.Mp4File(path, **kwargs)
+    finally:
+        mp4file.open_file = open_file
+    return mp4, counters[0]
@@ -0,0 +1,137 @@
+'''
+Copying byte ranges of a source file into an output stream.
+
+Ranges are copied in bounded chunks, read into a buffer and written
+out.  Only where os.copy_file_range or os.sendfile exist, which is not
+the case on Python 2, and when both ends are regular files, does the
+kernel copy the bytes instead, without passing them through user space.
+'''
+import errno
+import mmap
+import os
+import stat
+
+from defs import *
+
+BUFFER_SIZE = 1 << 20
+
+# os.copy_file_range (Python 3.8) and os.sendfile (Python 3.3) do not
+# exist on Python 2, where every copy goes through the buffer
+_copy_file_range = getattr(os, 'copy_file_range', None)
+_sendfile = getattr(os, 'sendfile', None)
+
+
+def kernel_copy_available():
+    '''Return whether the kernel can copy between regular files here.'''
+    return _copy_file_range is not None or _sendfile is not None
+
+
+def _regular_fileno(f):
+    '''Return the descriptor of f if it is a regular file, else None.'''
+    fileno = getattr(f, 'fileno', None)
+    if fileno is None or isinstance(f, mmap.mmap):
+        return None
+    try:
+        fd = fileno()
+        if stat.S_ISREG(os.fstat(fd).st_mode):
+            return fd
+    except (IOError, OSError, ValueError, AttributeError):
+        pass
+    return None
+
+
+class Copier(object):
+    '''Copies byte ranges into a stream and counts the bytes copied.
+
+    :param buffer_size: largest chunk read into memory, or handed to the
+        kernel, at once.
+    :param use_kernel: whether to let the kernel copy between regular
+        files when the platform allows it.
+    '''
+    def __init__(self, buffer_size=BUFFER_SIZE, use_kernel=True):
+        self.buffer_size = buffer_size
+        self.use_kernel = use_kernel
+        self.bytes_copied = 0
+        # part of bytes_copied copied by the kernel
+        self.kernel_bytes = 0
+
+    def copy(self, src, offset, length, stream):
+        '''Copy length bytes of src, from offset, into stream.  A None
+        length copies up to the end of src.
+        '''
+        if length is None:
+            src.seek(0, SEEK_END)
+            length = src.tell() - offset
+        done = 0
+        if self.use_kernel and kernel_copy_available():
+            done = self._kernel_copy(src, offset, length, stream)
+        if done < length:
+            self._buffer_copy(src, offset + done, length - done, stream)
+        self.bytes_copied += length
+
+    def _buffer_copy(self, src, offset, length, stream):
+        if isinstance(src, mmap.mmap):
+            # write slices of the mapping, no copy needed
+            end = offset + length
+            while offset < end:
+                size = min(self.buffer_size, end - offset)
+                stream.write(buffer_view(src, offset, size))
+                offset += size
+            return
+        pread = getattr(src, 'pread', None)
+        if pread is not None:
+            # positional reads leave the position of src alone, for the
+            # threads sharing it
+            end = offset + length
+            while offset < end:
+                data = pread(offset, min(self.buffer_size, end - offset))
+                if not data:
+                    raise IOError(errno.EIO, 'unexpected end of file')
+                stream.write(data)
+                offset += len(data)
+            return
+        src.seek(offset, SEEK_SET)
+        while length > 0:
+            data = src.read(min(self.buffer_size, length))
+            if not data:
+                raise IOError(errno.EIO, 'unexpected end of file')
+            stream.write(data)
+            length -= len(data)
+
+    def _kernel_copy(self, src, offset, length, stream):
+        '''Copy as much as the kernel accepts; return the number of bytes
+        copied.
+        '''
+        src_fd = _regular_fileno(src)
+        dst_fd = _regular_fileno(stream)
+        if src_fd is None or dst_fd is None:
+            return 0
+        # hand the buffered output over to the descriptor
+        stream.flush()
+        done = 0
+        copy_file_range = _copy_file_range
+        while done < length:
+            count = min(self.buffer_size, length - done)
+            try:
+                if copy_file_range is not None:
+                    n = copy_file_range(src_fd, dst_fd, count, offset + done)
+                else:
+                    n = _sendfile(dst_fd, src_fd, offset + done, count)
+            except OSError as e:
+                if copy_file_range is not None and \
+                        e.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                    errno.EOPNOTSUPP):
+                    # e.g. across filesystems; try sendfile instead
+                    copy_file_range = None
+                    if _sendfile is not None:
+                        continue
+                if e.errno in (errno.EINVAL, errno.ENOSYS):
+                    break
+                raise
+            if n == 0:
+                break
+            done += n
+        # the stream object has to learn its new position
+        stream.seek(os.lseek(dst_fd, 0, SEEK_CUR), SEEK_SET)
+        self.kernel_bytes += done
+        return done
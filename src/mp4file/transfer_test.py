@@ -0,0 +1,157 @@
+'''
+Tests for copying byte ranges between files.
+'''
+import errno
+import mmap
+import os
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+import transfer
+from transfer import Copier, kernel_copy_available
+from testutil import write_temp
+
+DATA = ''.join(chr(n % 251) for n in range(1000))
+
+
+def fake_sendfile(calls):
+    '''Return an os.sendfile working with reads and writes, recording the
+    counts it is called with.
+    '''
+    def sendfile(out_fd, in_fd, offset, count):
+        calls.append(count)
+        pos = os.lseek(in_fd, 0, os.SEEK_CUR)
+        os.lseek(in_fd, offset, os.SEEK_SET)
+        data = os.read(in_fd, count)
+        os.lseek(in_fd, pos, os.SEEK_SET)
+        return os.write(out_fd, data)
+    return sendfile
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.path = write_temp(DATA)
+        self.src = open(self.path, 'rb')
+        fd, self.out_path = tempfile.mkstemp()
+        os.close(fd)
+        self.out = open(self.out_path, 'w+b')
+        self.kernel = transfer._copy_file_range, transfer._sendfile
+
+    def tearDown(self):
+        transfer._copy_file_range, transfer._sendfile = self.kernel
+        self.src.close()
+        self.out.close()
+        os.unlink(self.path)
+        os.unlink(self.out_path)
+
+    def output(self):
+        self.out.close()
+        return open(self.out_path, 'rb').read()
+
+    def copy(self, copier, offset, length):
+        # unflushed bytes before, and writes after, the copied range
+        self.out.write('head')
+        copier.copy(self.src, offset, length, self.out)
+        self.out.write('tail')
+        return self.output()
+
+    def testBuffered(self):
+        copier = Copier(buffer_size=7, use_kernel=False)
+        self.assertEquals('head' + DATA[10:110] + 'tail',
+                          self.copy(copier, 10, 100))
+        self.assertEquals((100, 0), (copier.bytes_copied, copier.kernel_bytes))
+
+    def testToEnd(self):
+        copier = Copier(use_kernel=False)
+        self.assertEquals('head' + DATA[900:] + 'tail',
+                          self.copy(copier, 900, None))
+        self.assertEquals(100, copier.bytes_copied)
+
+    def testMapped(self):
+        src = mmap.mmap(self.src.fileno(), 0, access=mmap.ACCESS_READ)
+        copier = Copier(buffer_size=64)
+        stream = StringIO()
+        copier.copy(src, 100, 500, stream)
+        src.close()
+        self.assertEquals(DATA[100:600], stream.getvalue())
+        self.assertEquals(0, copier.kernel_bytes)
+
+    def testShortSource(self):
+        self.assertRaises(IOError, Copier(use_kernel=False).copy,
+                          self.src, 900, 200, StringIO())
+
+    def testKernel(self):
+        calls = []
+        transfer._copy_file_range = None
+        transfer._sendfile = fake_sendfile(calls)
+        copier = Copier(buffer_size=64)
+        # the buffered head is flushed first, and the stream positioned
+        # after the copied bytes
+        self.assertEquals('head' + DATA[10:510] + 'tail',
+                          self.copy(copier, 10, 500))
+        self.assertEquals((500, 500), (copier.bytes_copied,
+                                       copier.kernel_bytes))
+        self.assertEquals([64] * 7 + [52], calls)
+
+    def testKernelToEnd(self):
+        transfer._copy_file_range = None
+        transfer._sendfile = fake_sendfile([])
+        copier = Copier(buffer_size=64)
+        self.assertEquals('head' + DATA[900:] + 'tail',
+                          self.copy(copier, 900, None))
+        self.assertEquals(100, copier.kernel_bytes)
+
+    def testKernelRefused(self):
+        def sendfile(out_fd, in_fd, offset, count):
+            raise OSError(errno.EINVAL, 'not supported')
+        transfer._copy_file_range = None
+        transfer._sendfile = sendfile
+        copier = Copier(buffer_size=64)
+        self.assertEquals('head' + DATA[10:510] + 'tail',
+                          self.copy(copier, 10, 500))
+        self.assertEquals((500, 0), (copier.bytes_copied,
+                                     copier.kernel_bytes))
+
+    def testKernelNotRegular(self):
+        calls = []
+        transfer._copy_file_range = None
+        transfer._sendfile = fake_sendfile(calls)
+        copier = Copier()
+        stream = StringIO()
+        copier.copy(self.src, 10, 500, stream)
+        self.assertEquals(DATA[10:510], stream.getvalue())
+        self.assertEquals([], calls)
+        self.assertEquals(0, copier.kernel_bytes)
+
+    @unittest.skipIf(getattr(os, 'sendfile', None) is None,
+                     'os.sendfile is not available')
+    def testSendfile(self):
+        transfer._copy_file_range = None
+        transfer._sendfile = os.sendfile
+        copier = Copier(buffer_size=64)
+        self.assertEquals('head' + DATA[10:510] + 'tail',
+                          self.copy(copier, 10, 500))
+        self.assertEquals(500, copier.kernel_bytes)
+
+    @unittest.skipIf(getattr(os, 'copy_file_range', None) is None,
+                     'os.copy_file_range is not available')
+    def testCopyFileRange(self):
+        transfer._copy_file_range = os.copy_file_range
+        copier = Copier(buffer_size=64)
+        self.assertEquals('head' + DATA[10:510] + 'tail',
+                          self.copy(copier, 10, 500))
+        self.assertEquals(500, copier.kernel_bytes)
+
+    def testPlatform(self):
+        copier = Copier()
+        self.assertEquals('head' + DATA[10:510] + 'tail',
+                          self.copy(copier, 10, 500))
+        if kernel_copy_available():
+            self.assertEquals(500, copier.kernel_bytes)
+        else:
+            self.assertEquals(0, copier.kernel_bytes)
+
+
+if __name__ == "__main__":
+    unittest.main()